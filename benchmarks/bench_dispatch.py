@@ -0,0 +1,85 @@
+"""
+Стоимость диспетчеризации нажатия кнопки в зависимости от числа хендлеров:
+цепочка @router.message(F.text == ...) против одной ButtonTable (dict lookup).
+
+    python benchmarks/bench_dispatch.py
+"""
+import asyncio
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, F, Router  # noqa: E402
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+
+import main  # noqa: E402
+
+logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+SIZES = (10, 40, 100, 400)
+UPDATES = 2000
+
+
+def _update(update_id: int, text: str) -> Update:
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=1, type="private"),
+            from_user=User(id=1, is_bot=False, first_name="bench"),
+            text=text,
+        ),
+    )
+
+
+async def _noop(message: Message):
+    return
+
+
+def linear_router(texts: list) -> Router:
+    router = Router()
+    for text in texts:
+        router.message.register(_noop, F.text == text)
+    return router
+
+
+def table_router(texts: list) -> Router:
+    router = Router()
+    table = main.ButtonTable()
+    table.button(*texts)(_noop)
+    router.message.register(main.dispatch_button, main.ButtonFilter(table))
+    return router
+
+
+async def run(router: Router, text: str) -> float:
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot("42:BENCH")
+    updates = [_update(i, text) for i in range(UPDATES)]
+    started = time.perf_counter()
+    for upd in updates:
+        await dp.feed_update(bot, upd)
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+    return elapsed / UPDATES * 1e6
+
+
+async def bench():
+    print(f"{'handlers':>8} | {'F.text chain, us':>16} | {'ButtonTable, us':>15}")
+    for n in SIZES:
+        texts = [f"button {i}" for i in range(n)]
+        # худший случай для цепочки — последняя зарегистрированная кнопка
+        linear = await run(linear_router(texts), texts[-1])
+        table = await run(table_router(texts), texts[-1])
+        print(f"{n:>8} | {linear:>16.1f} | {table:>15.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,121 @@
+"""
+Холодный старт: во что обходится `import main` (отчёт в духе
+`python -X importtime`) и сколько проходит от запуска процесса до 200 на /ready.
+
+    python benchmarks/bench_startup.py
+    REDIS_URL=redis://localhost:6379/0 python benchmarks/bench_startup.py
+
+Без REDIS_URL меряется только импорт. Код выхода 1, если превышен бюджет
+(IMPORT_BUDGET_S, READY_BUDGET_S) или при импорте подтянулся модуль, который
+должен грузиться лениво.
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_S = float(os.getenv("IMPORT_BUDGET_S", "8"))
+READY_BUDGET_S = float(os.getenv("READY_BUDGET_S", "12"))
+LAZY_MODULES = ("httpx",)
+TOP = 15
+
+
+def import_report():
+    env = {**os.environ, "DATA_DIR": tempfile.mkdtemp()}
+    code = f"import sys, main; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - started
+
+    # "import time: self [us] | cumulative | imported package", вложенность — отступом
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    leaked = [m for m in proc.stdout.strip().split(",") if m]
+    return wall, rows, leaked
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_to_ready():
+    port = _free_port()
+    env = {
+        **os.environ,
+        "DATA_DIR": tempfile.mkdtemp(),
+        "PORT": str(port),
+        "WORKERS": "1",
+        "BOT_TOKEN": os.getenv("BOT_TOKEN", "42:BENCH"),
+    }
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = started + READY_BUDGET_S * 3
+        while time.perf_counter() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"main.py exited with {proc.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as resp:
+                    return time.perf_counter() - started, json.load(resp)
+            except (urllib.error.URLError, OSError):
+                pass  # ещё не слушает или 503 — прогрев идёт
+            time.sleep(0.05)
+        raise TimeoutError(f"/ready not 200 after {READY_BUDGET_S * 3:.0f}s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    failed = False
+
+    wall, rows, leaked = import_report()
+    total_us = sum(r[2] for r in rows)
+    print(f"import main: {wall:.2f}s wall, {total_us / 1e6:.2f}s in imports (budget {IMPORT_BUDGET_S:.1f}s)")
+    print(f"{'module':<40}{'self ms':>10}{'cumul. ms':>12}")
+    for name, _, self_us, cumulative_us in sorted((r for r in rows if r[1] <= 1), key=lambda r: -r[3])[:TOP]:
+        print(f"{name:<40}{self_us / 1000:>10.1f}{cumulative_us / 1000:>12.1f}")
+    if wall > IMPORT_BUDGET_S:
+        print(f"FAIL: import over budget by {wall - IMPORT_BUDGET_S:.2f}s")
+        failed = True
+    if leaked:
+        print(f"FAIL: imported eagerly: {', '.join(leaked)}")
+        failed = True
+
+    if os.getenv("REDIS_URL"):
+        ready_s, report = start_to_ready()
+        print(f"\nstart -> /ready: {ready_s:.2f}s (budget {READY_BUDGET_S:.1f}s)")
+        for step, value in report.get("steps", {}).items():
+            print(f"  {step:<12}{value}")
+        if ready_s > READY_BUDGET_S:
+            print(f"FAIL: start-to-ready over budget by {ready_s - READY_BUDGET_S:.2f}s")
+            failed = True
+    else:
+        print("\nREDIS_URL not set: start -> /ready skipped")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
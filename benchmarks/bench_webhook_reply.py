@@ -0,0 +1,145 @@
+"""
+Ответ телом вебхука против отдельного sendMessage: сколько апдейт «Часы
+работы» / /myid занимает от POST вебхука до момента, когда ответ отдан
+Telegram, в обоих режимах WEBHOOK_REPLY_INLINE.
+
+    python benchmarks/bench_webhook_reply.py
+    BOT_API_LATENCY_MS=120 ROUNDS=200 python benchmarks/bench_webhook_reply.py
+
+Bot API подменяется локальным сервером, который отвечает с задержкой
+BOT_API_LATENCY_MS (RTT до api.telegram.org). В фоновом режиме ответ отдан,
+когда завершился sendMessage; в inline — когда вернулся ответ на вебхук.
+Redis не нужен: апдейты идут через MemoryStorage и профиль кафе по умолчанию.
+"""
+import asyncio
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler  # noqa: E402
+
+import main  # noqa: E402
+
+BOT_API_LATENCY_MS = float(os.getenv("BOT_API_LATENCY_MS", "80"))
+ROUNDS = int(os.getenv("ROUNDS", "100"))
+HOST = "127.0.0.1"
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = 0
+        self.delivered: asyncio.Queue = asyncio.Queue()
+
+    async def handle(self, request: web.Request):
+        form = await request.post()
+        await asyncio.sleep(BOT_API_LATENCY_MS / 1000)
+        self.calls += 1
+        now = int(time.time())
+        message = {
+            "message_id": self.calls,
+            "date": now,
+            "chat": {"id": int(form.get("chat_id", 0)), "type": "private"},
+            "text": form.get("text", ""),
+        }
+        self.delivered.put_nowait(time.perf_counter())
+        return web.json_response({"ok": True, "result": message})
+
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(datetime.datetime.now().timestamp()),
+            "chat": {"id": 100, "type": "private"},
+            "from": {"id": 100, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+async def start_site(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, 0).start()
+    return runner
+
+
+def site_url(runner: web.AppRunner) -> str:
+    port = runner.addresses[0][1]
+    return f"http://{HOST}:{port}"
+
+
+async def run_mode(client: aiohttp.ClientSession, url: str, api: FakeBotAPI, inline: bool, text: str):
+    samples = []
+    calls_before = api.calls
+    for i in range(ROUNDS):
+        started = time.perf_counter()
+        async with client.post(url, json=make_update(i + 1, text)) as resp:
+            body = await resp.read()
+            answered = time.perf_counter()
+        if inline:
+            if b"sendMessage" not in body:
+                raise RuntimeError("webhook response carries no method")
+            samples.append(answered - started)
+        else:
+            samples.append(await asyncio.wait_for(api.delivered.get(), 10) - started)
+    return samples, api.calls - calls_before
+
+
+def summary(samples) -> str:
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    return f"mean {statistics.mean(ms):7.1f} ms   p50 {statistics.median(ms):7.1f} ms   p95 {p95:7.1f} ms"
+
+
+async def bench():
+    api = FakeBotAPI()
+    api_app = web.Application()
+    api_app.router.add_post("/bot{token}/{method}", api.handle)
+    api_runner = await start_site(api_app)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(site_url(api_runner)))
+    bot = Bot(token="42:BENCH", session=session)
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.update.outer_middleware(main.MetricsMiddleware())
+    dp.include_router(main.router)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True).register(app, path="/background")
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=False).register(app, path="/inline")
+    app_runner = await start_site(app)
+    base = site_url(app_runner)
+
+    print(f"Bot API RTT {BOT_API_LATENCY_MS:g} ms, {ROUNDS} updates per case\n")
+    try:
+        async with aiohttp.ClientSession() as client:
+            for label, text in (("hours", main.BTN_HOURS), ("/myid", "/myid")):
+                bg, bg_calls = await run_mode(client, f"{base}/background", api, False, text)
+                inline, inline_calls = await run_mode(client, f"{base}/inline", api, True, text)
+                saved = statistics.mean(bg) - statistics.mean(inline)
+                print(f"{label}")
+                print(f"  background  {summary(bg)}   Bot API calls {bg_calls}")
+                print(f"  inline      {summary(inline)}   Bot API calls {inline_calls}")
+                print(f"  saved       {saved * 1000:.1f} ms per update\n")
+    finally:
+        await app_runner.cleanup()
+        await session.close()
+        await api_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
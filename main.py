@@ -5,24 +5,43 @@ import asyncio
 import time
 import random
 import re
+import copy
+import csv
+import io
+import tempfile
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, Mapping, Optional, Tuple, Union
+from types import MappingProxyType
+from dataclasses import dataclass, replace
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import weakref
 import base64
+import hashlib
+import hmac
+import signal
+import socket
+from collections import OrderedDict, deque
 
 import redis.asyncio as redis
+from redis.exceptions import NoScriptError
 from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F, Router, html
+from aiogram import Bot, Dispatcher, F, Router, html, BaseMiddleware
 from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.middleware import FSMContextMiddleware
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update, FSInputFile
+from aiogram.filters import CommandStart, Command, StateFilter, BaseFilter
+from aiogram.dispatcher.event.handler import CallableObject
 from aiogram.client.default import DefaultBotProperties
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import BaseRequestHandler, SimpleRequestHandler, setup_application
 
 import uuid
-import httpx  # не забудь в requirements.txt: httpx>=0.27.0,<1.0
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -38,14 +57,30 @@ DATA_DIR = os.getenv("DATA_DIR", "/data")
 CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 
 # --- Redis keys ---
-MENU_REDIS_KEY = "menu:items"  # hash: {drink_name: price}
+MENU_REDIS_KEY = "menu:items"  # legacy hash: {drink_name: price}
+MENU_ITEMS_KEY = "menu:item_ids"  # hash: {item_id: json {"name", "price", "active"}}
+MENU_ITEM_SEQ_KEY = "menu:item_seq"  # counter for new item ids
+MIGRATION_ITEM_IDS_KEY = "migrations:item_ids_v1"
+MIGRATION_DRINKS_ZSET_KEY = "migrations:drinks_zset_v1"
+MIGRATION_RFM_KEY = "migrations:rfm_v2"  # v2: заодно ставит каждому клиенту return_offer в планировщик
 
 # Stats keys
 STATS_TOTAL_ORDERS = "stats:total_orders"
 STATS_TOTAL_REVENUE = "stats:total_revenue"
+STATS_ITEM_PREFIX = "stats:item:"
+STATS_ITEM_REV_PREFIX = "stats:item_rev:"
+STATS_HOUR_KEY = "stats:hour"            # hash: {0..23 (МСК): orders}
+STATS_WEEKDAY_KEY = "stats:weekday"      # hash: {0..6 (пн=0): orders}
+STATS_BASKET_KEY = "stats:basket_size"   # hash: {items in order: orders}
+# legacy (by drink name), only read by the item id migration
 STATS_DRINK_PREFIX = "stats:drink:"
 STATS_DRINK_REV_PREFIX = "stats:drink_revenue:"
 
+# Order ledger (per cafe, via cafe_key)
+ORDERS_STREAM_KEY = "orders:stream"  # stream: one entry per finalized order
+ORDER_SEQ_PREFIX = "orders:seq:"     # + YYYYMMDD, daily order number counter
+ORDERS_STREAM_MAXLEN = int(os.getenv("ORDERS_STREAM_MAXLEN", "200000"))
+
 # Per-user "repeat last order"
 LAST_SEEN_KEY_PREFIX = "last_seen:"   # string timestamp
 LAST_ORDER_KEY_PREFIX = "last_order:" # string json snapshot
@@ -59,17 +94,39 @@ def _pay_draft_key(draft_id: str) -> str:
 # Smart return
 CUSTOMERS_SET_KEY = "customers:set"
 CUSTOMER_KEY_PREFIX = "customer:"
-CUSTOMER_DRINKS_PREFIX = "customer:drinks:"
+CUSTOMER_DRINKS_PREFIX = "customer:drinks:"  # legacy hash {item_id: qty}, only read by the zset migration
+CUSTOMER_TOP_PREFIX = "customer:top:"        # zset {item_id: qty}
+
+# RFM indexes (zset {user_id: score})
+RFM_RECENCY_KEY = "rfm:recency"      # last_order_ts
+RFM_FREQUENCY_KEY = "rfm:frequency"  # total_orders
+RFM_MONETARY_KEY = "rfm:monetary"    # total_spent
+RFM_LAPSE_DUE_KEY = "rfm:lapse_due"  # last_order_ts + RFM_LAPSE_FACTOR * avg interval (2+ orders)
+RFM_LAPSE_FACTOR = float(os.getenv("RFM_LAPSE_FACTOR", "2"))
+RFM_FREQUENT_MIN_ORDERS = int(os.getenv("RFM_FREQUENT_MIN_ORDERS", "3"))
 
 DEFAULT_RETURN_CYCLE_DAYS = 7
 RETURN_COOLDOWN_DAYS = 30
-RETURN_CHECK_EVERY_SECONDS = 6 * 60 * 60
 RETURN_SEND_FROM_HOUR = 10
 RETURN_SEND_TO_HOUR = 20
 RETURN_DISCOUNT_PERCENT = 10
 
+# Bookings (per cafe, via cafe_key)
+DEFAULT_BOOKING_TABLES = int(os.getenv("BOOKING_TABLES", "5"))  # броней на один слот
+BOOKING_SLOT_MINUTES = 30
+BOOKING_DURATION_MINUTES = 90
+BOOKING_HISTORY_DAYS = 30
+BOOKINGS_BY_TIME_KEY = "bookings:by_time"  # zset {booking_id: start_ts}
+BOOKING_KEY_PREFIX = "booking:"            # + id, hash
+BOOKING_SLOT_PREFIX = "bookings:slot:"     # + slot start_ts, counter of active bookings
+BOOKING_SEQ_KEY = "bookings:seq"
+BOOKING_GRID_PREFIX = "bookings:grid:"     # + YYYYMMDD, json cache of the day's slot grid
+BOOKING_GRID_TTL = 3600
+BOOKING_DAYS_AHEAD = 7
+BOOKING_LEAD_MINUTES = 30
+BOOKING_REMIND_MINUTES = int(os.getenv("BOOKING_REMIND_MINUTES", "120"))  # напоминание гостю до начала
+
 # Подписки Cafebotify
-SUBS_CHECK_EVERY_SECONDS = 24 * 60 * 60  # раз в сутки
 SUBS_REMIND_DAYS_BEFORE = 3
 
 
@@ -88,8 +145,8 @@ def _parse_work_hours(obj: Any) -> Optional[Tuple[int, int]]:
     return None
 
 
-def load_config() -> Dict[str, Any]:
-    default_config = {
+def _config_defaults() -> Dict[str, Any]:
+    return {
         "name": "Кофейня «Уют» ☕",
         "phone": "+7 989 000-00-00",
         "admin_chat_id": 1471275603,
@@ -103,8 +160,66 @@ def load_config() -> Dict[str, Any]:
             "⚡ Эспрессо": 200,
         },
         "return_cycle_days": DEFAULT_RETURN_CYCLE_DAYS,
+        "booking_tables": DEFAULT_BOOKING_TABLES,
     }
 
+
+def parse_config(data: Dict[str, Any]) -> Dict[str, Any]:
+    # отсутствующие поля берутся по умолчанию, кривые — ValueError
+    cfg = _config_defaults()
+    cafe = data.get("cafe", {})
+    if not isinstance(cafe, dict):
+        raise ValueError("cafe: ожидается объект")
+    try:
+        for field in ("name", "phone", "address"):
+            if field in cafe:
+                cfg[field] = str(cafe[field])
+        for field in ("admin_chat_id", "work_start", "work_end", "return_cycle_days", "booking_tables"):
+            if field in cafe:
+                cfg[field] = int(cafe[field])
+        if "menu" in cafe:
+            if not isinstance(cafe["menu"], dict) or not cafe["menu"]:
+                raise ValueError("menu: ожидается непустой объект {название: цена}")
+            cfg["menu"] = {str(name): int(price) for name, price in cafe["menu"].items()}
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"config.json: {e}") from None
+
+    if "work_hours" in cafe:
+        wh = _parse_work_hours(cafe["work_hours"])
+        if not wh:
+            raise ValueError("config.json: work_hours — [начало, конец], часы 0..23")
+        cfg["work_start"], cfg["work_end"] = wh
+    if not _parse_work_hours([cfg["work_start"], cfg["work_end"]]):
+        raise ValueError("config.json: work_start/work_end — часы 0..23, не равные друг другу")
+    if cfg["return_cycle_days"] <= 0:
+        raise ValueError("config.json: return_cycle_days должен быть > 0")
+    if cfg["booking_tables"] < 1:
+        raise ValueError("config.json: booking_tables должен быть >= 1")
+    if any(price < 0 for price in cfg["menu"].values()):
+        raise ValueError("config.json: цены в menu не могут быть отрицательными")
+    return cfg
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    data: Mapping[str, Any]
+    mtime: float = 0.0
+    version: int = 0  # значение CONFIG_VERSION_KEY, на котором снимок собран
+
+
+def _freeze_config(cfg: Dict[str, Any]) -> Mapping[str, Any]:
+    return MappingProxyType({**cfg, "menu": MappingProxyType(dict(cfg["menu"]))})
+
+
+def read_config_file() -> Tuple[float, Dict[str, Any]]:
+    # блокирующее чтение: из event loop вызывать через asyncio.to_thread
+    mtime = os.stat(CONFIG_PATH).st_mtime
+    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return mtime, parse_config(data)
+
+
+def load_config() -> ConfigSnapshot:
     # гарантируем, что /data существует
     try:
         os.makedirs(DATA_DIR, exist_ok=True)
@@ -112,54 +227,112 @@ def load_config() -> Dict[str, Any]:
         pass
 
     try:
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            cafe = data.get("cafe", {})
-
-            default_config.update(
-                name=cafe.get("name", default_config["name"]),
-                phone=cafe.get("phone", default_config["phone"]),
-                admin_chat_id=cafe.get("admin_chat_id", default_config["admin_chat_id"]),
-                address=cafe.get("address", default_config["address"]),
-                menu=cafe.get("menu", default_config["menu"]),
-                return_cycle_days=int(cafe.get("return_cycle_days", default_config["return_cycle_days"])),
-            )
+        mtime, cfg = read_config_file()
+    except FileNotFoundError:
+        mtime, cfg = 0.0, _config_defaults()
+    except Exception as e:
+        logger.error(f"load_config: {e}, using defaults")
+        mtime, cfg = 0.0, _config_defaults()
+    return ConfigSnapshot(data=_freeze_config(cfg), mtime=mtime)
+
+
+# ---------------- Menu items ----------------
+# Позиция меню идентифицируется маленьким целым id: корзины, снапшоты,
+# статистика и customer:drinks хранят id, а имя/цена — атрибуты позиции.
+# Удалённые позиции остаются в реестре неактивными, чтобы история не ломалась.
+# Реестр после создания не меняется: правка меню строит новый реестр (with_item)
+# и новый профиль кафе, а апдейты, начатые со старым, дорабатывают на нём.
+@dataclass(frozen=True)
+class MenuItem:
+    id: int
+    name: str
+    price: int
+    active: bool = True
+
+
+class MenuRegistry:
+    def __init__(self, items: Optional[list] = None):
+        self.items: Dict[int, MenuItem] = {}
+        self._by_name: Dict[str, int] = {}
+        for item in items or []:
+            self._put(item)
+
+    def _put(self, item: MenuItem):
+        old = self.items.get(item.id)
+        if old is not None and self._by_name.get(old.name) == old.id:
+            self._by_name.pop(old.name, None)
+        self.items[item.id] = item
+        if item.active:
+            self._by_name[item.name] = item.id
+
+    def with_item(self, item: MenuItem) -> "MenuRegistry":
+        menu = MenuRegistry(list(self.items.values()))
+        menu._put(item)
+        return menu
+
+    def get(self, item_id: int) -> Optional[MenuItem]:
+        return self.items.get(item_id)
+
+    def by_name(self, name: str, include_inactive: bool = False) -> Optional[MenuItem]:
+        item_id = self._by_name.get(name)
+        if item_id is not None:
+            return self.items[item_id]
+        if include_inactive:
+            for item in self.items.values():
+                if item.name == name:
+                    return item
+        return None
 
-            wh = _parse_work_hours(cafe.get("work_hours"))
-            if wh:
-                default_config["work_start"], default_config["work_end"] = wh
-            else:
-                try:
-                    default_config["work_start"] = int(cafe.get("work_start", default_config["work_start"]))
-                    default_config["work_end"] = int(cafe.get("work_end", default_config["work_end"]))
-                except Exception:
-                    pass
-    except Exception:
-        pass
+    def active(self) -> list:
+        return [it for it in self.items.values() if it.active]
+
+    def names(self) -> list:
+        return [it.name for it in self.items.values() if it.active]
+
+    def name(self, item_id: int) -> str:
+        item = self.items.get(item_id)
+        return item.name if item else f"#{item_id}"
+
+    def price(self, item_id: int) -> int:
+        item = self.items.get(item_id)
+        return int(item.price) if item else 0
+
+    def next_id(self) -> int:
+        return max(self.items.keys(), default=0) + 1
+
+
+def _menu_registry_from_config(menu: Mapping[str, Any]) -> MenuRegistry:
+    items = []
+    for i, (name, price) in enumerate(menu.items(), start=1):
+        try:
+            items.append(MenuItem(id=i, name=str(name), price=int(price)))
+        except Exception:
+            continue
+    return MenuRegistry(items)
 
-    try:
-        if int(default_config["return_cycle_days"]) <= 0:
-            default_config["return_cycle_days"] = DEFAULT_RETURN_CYCLE_DAYS
-    except Exception:
-        default_config["return_cycle_days"] = DEFAULT_RETURN_CYCLE_DAYS
 
-    return default_config
+def _menu_item_dump(item: MenuItem) -> str:
+    return json.dumps({"name": item.name, "price": item.price, "active": int(item.active)}, ensure_ascii=False)
 
 
-cafe_config = load_config()
+def _menu_item_load(item_id: Any, raw: str) -> Optional[MenuItem]:
+    try:
+        obj = json.loads(raw)
+        return MenuItem(
+            id=int(item_id),
+            name=str(obj["name"]),
+            price=int(obj.get("price", 0)),
+            active=bool(int(obj.get("active", 1))),
+        )
+    except Exception:
+        return None
 
-CAFE_NAME = cafe_config["name"]
-CAFE_PHONE = cafe_config["phone"]
-ADMIN_ID = int(cafe_config["admin_chat_id"])
-CAFE_ADDRESS = cafe_config.get("address", "")
 
-MENU: Dict[str, int] = dict(cafe_config["menu"])
-WORK_START = int(cafe_config["work_start"])
-WORK_END = int(cafe_config["work_end"])
-RETURN_CYCLE_DAYS = int(cafe_config.get("return_cycle_days", DEFAULT_RETURN_CYCLE_DAYS))
+# текущий снимок config.json; перечитывается на лету (см. «Config reload»)
+config_snapshot = load_config()
 
-# суперадмин (можешь вынести в отдельную переменную/ENV)
-SUPERADMIN_ID = ADMIN_ID
+# суперадмин платформы; по умолчанию — админ кафе из config.json
+SUPERADMIN_ID = int(os.getenv("SUPERADMIN_ID") or config_snapshot.data["admin_chat_id"])
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 REDIS_URL = os.getenv("REDIS_URL")
@@ -169,8 +342,13 @@ PORT = int(os.getenv("PORT", 10000))
 
 WEBHOOK_PATH = f"/{WEBHOOK_SECRET}/webhook"
 WEBHOOK_URL = f"https://{HOSTNAME}{WEBHOOK_PATH}"
-
-DEFAULT_CAFE_CODE = "cafe_001"  # меняешь только это
+# WEBHOOK_REPLY_INLINE=1: вебхук отвечает Telegram только после хендлера, и
+# метод, который хендлер вернул (а не отправил сам), уходит телом ответа —
+# без отдельного запроса к Bot API. Так отвечают простые хендлеры (часы,
+# телефон, /myid, «закрыто»); остальные отправки идут обычными запросами.
+# Без флага апдейт обрабатывается в фоне, а возвращённый метод aiogram
+# отправляет сам.
+WEBHOOK_REPLY_INLINE = os.getenv("WEBHOOK_REPLY_INLINE", "0") == "1"
 
 # ЮKassa
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
@@ -209,11 +387,247 @@ def build_links_text(cafe_code: str) -> str:
 router = Router()
 
 
+# ---------------- Time budget ----------------
+# У апдейта общий бюджет UPDATE_BUDGET_SECONDS: MetricsMiddleware (первое
+# outer-middleware после штатных) кладёт дедлайн в contextvar, а команды Redis
+# и запросы к Bot API / ЮKassa внутри middleware и хендлера ждут не дольше
+# min(своего таймаута, остатка бюджета). Если бюджет уже исчерпан, вызов сразу
+# падает с BudgetExceeded. Спустя
+# UPDATE_BUDGET_GRACE_SECONDS после дедлайна хендлер снимается, чтобы при
+# медленной зависимости не копились висящие задачи. Вне апдейтов (планировщик,
+# вебхук ЮKassa, фоновые задачи) действуют только собственные таймауты вызовов.
+UPDATE_BUDGET_SECONDS = float(os.getenv("UPDATE_BUDGET_SECONDS", "20"))
+UPDATE_BUDGET_GRACE_SECONDS = float(os.getenv("UPDATE_BUDGET_GRACE_SECONDS", "5"))
+REDIS_COMMAND_TIMEOUT = float(os.getenv("REDIS_COMMAND_TIMEOUT", "5"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "3"))
+TELEGRAM_REQUEST_TIMEOUT = float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", "15"))
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+
+
+class BudgetExceeded(TimeoutError):
+    pass
+
+
+@dataclass
+class UpdateBudget:
+    deadline: float
+    handler: str = "unhandled"
+
+
+_update_budget: ContextVar[Optional[UpdateBudget]] = ContextVar("update_budget", default=None)
+
+
+def budget_timeout(cap: float) -> float:
+    budget = _update_budget.get()
+    if budget is None:
+        return cap
+    left = budget.deadline - time.monotonic()
+    if left <= 0:
+        raise BudgetExceeded(f"update budget exhausted in {budget.handler}")
+    return min(cap, left)
+
+
+class BudgetSession(AiohttpSession):
+    async def make_request(self, bot: Bot, method, timeout: Optional[int] = None):
+        return await super().make_request(bot, method, budget_timeout(self.timeout if timeout is None else timeout))
+
+
 # ---------------- Redis ----------------
+# Все клиенты идут через предохранитель: после REDIS_BREAKER_FAILURES подряд
+# сетевых ошибок он размыкается, и команды сразу падают с RedisUnavailable,
+# не дожидаясь таймаутов подключения. Через REDIS_BREAKER_RESET_SECONDS одна
+# команда пропускается пробной: удалась — цепь замкнута и отложенные записи
+# (write_or_defer) доигрываются, нет — снова разомкнута. Профили и меню в это
+# время отдаются из памяти (TenantCache.peek).
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "3"))
+REDIS_BREAKER_RESET_SECONDS = float(os.getenv("REDIS_BREAKER_RESET_SECONDS", "5"))
+REDIS_DEFERRED_WRITES_MAX = int(os.getenv("REDIS_DEFERRED_WRITES_MAX", "10000"))
+REDIS_REPLAY_BATCH = 500
+
+_redis_pool: Optional[redis.ConnectionPool] = None
+
+
+class RedisUnavailable(redis.ConnectionError):
+    pass
+
+
+class RedisCircuitBreaker:
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                metrics.incr("redis_fast_fail")
+                raise RedisUnavailable("redis circuit open")
+            self.state = "half_open"
+        if self._probe_in_flight:
+            metrics.incr("redis_fast_fail")
+            raise RedisUnavailable("redis circuit half-open")
+        self._probe_in_flight = True
+
+    def on_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            self.state = "closed"
+            logger.warning("redis circuit closed")
+            spawn_background(replay_deferred_writes())
+
+    def on_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            metrics.incr("redis_circuit_open")
+            logger.error(f"redis circuit open for {self.reset_seconds:g}s after {self.failures} failures")
+
+    def on_cancel(self):
+        self._probe_in_flight = False
+
+
+redis_breaker = RedisCircuitBreaker(REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET_SECONDS)
+
+
+async def _guarded(call, cap: float = REDIS_COMMAND_TIMEOUT):
+    # таймаут чтения ставится здесь, а не socket_timeout пула: pubsub.listen()
+    # и XREADGROUP BLOCK ждут на тех же соединениях дольше любого таймаута
+    limit = budget_timeout(cap)
+    redis_breaker.before_call()
+    deadline = asyncio.timeout(limit)
+    try:
+        async with deadline:
+            result = await call()
+    except TimeoutError as e:
+        if not deadline.expired():
+            redis_breaker.on_failure()
+            raise
+        if limit < cap:
+            # Redis ни при чём: кончился бюджет апдейта
+            redis_breaker.on_cancel()
+            raise BudgetExceeded(f"redis call cut by update budget ({limit:.2f}s)") from e
+        redis_breaker.on_failure()
+        raise redis.TimeoutError(f"redis call timed out after {cap:g}s") from e
+    except (redis.ConnectionError, redis.TimeoutError, OSError):
+        redis_breaker.on_failure()
+        raise
+    except asyncio.CancelledError:
+        redis_breaker.on_cancel()
+        raise
+    except Exception:
+        redis_breaker.on_success()  # сервер ответил, пусть и ошибкой
+        raise
+    redis_breaker.on_success()
+    return result
+
+
+class GuardedPipeline(redis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        return await _guarded(lambda: super(GuardedPipeline, self).execute(raise_on_error))
+
+
+def _command_timeout(args) -> float:
+    # XREAD(GROUP) ... BLOCK <ms> законно молчит всё время блокировки
+    if args and str(args[0]).upper() in ("XREAD", "XREADGROUP") and "BLOCK" in args:
+        return REDIS_COMMAND_TIMEOUT + int(args[args.index("BLOCK") + 1]) / 1000
+    return REDIS_COMMAND_TIMEOUT
+
+
+class GuardedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        return await _guarded(lambda: super(GuardedRedis, self).execute_command(*args, **options), _command_timeout(args))
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> GuardedPipeline:
+        return GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def get_redis_pool() -> redis.ConnectionPool:
+    # один пул соединений на процесс: его делят хелперы, FSM-хранилище и все боты
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis.ConnectionPool.from_url(
+            REDIS_URL, decode_responses=True, socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        )
+    return _redis_pool
+
+
 async def get_redis_client():
-    client = redis.from_url(REDIS_URL, decode_responses=True)
-    await client.ping()
-    return client
+    # aclose() у такого клиента возвращает соединение в пул, а не закрывает его
+    return GuardedRedis(connection_pool=get_redis_pool())
+
+
+# некритичные записи (last_seen, снимок заказа, журнал заказов), которые
+# при недоступном Redis копятся в памяти и доигрываются после восстановления
+_deferred_writes: "deque" = deque(maxlen=REDIS_DEFERRED_WRITES_MAX)
+
+
+async def write_or_defer(op) -> bool:
+    # op(pipe) ставит команды в pipeline; ключи должны быть вычислены заранее
+    try:
+        r = await get_redis_client()
+        try:
+            pipe = r.pipeline(transaction=False)
+            op(pipe)
+            await pipe.execute()
+        finally:
+            await r.aclose()
+        return True
+    except (redis.ConnectionError, redis.TimeoutError):
+        if len(_deferred_writes) == _deferred_writes.maxlen:
+            metrics.incr("redis_deferred_dropped")
+        _deferred_writes.append(op)
+        metrics.incr("redis_deferred")
+        return False
+
+
+async def replay_deferred_writes():
+    replayed = 0
+    while _deferred_writes:
+        batch = [_deferred_writes.popleft() for _ in range(min(REDIS_REPLAY_BATCH, len(_deferred_writes)))]
+        try:
+            r = await get_redis_client()
+            try:
+                pipe = r.pipeline(transaction=False)
+                for op in batch:
+                    op(pipe)
+                await pipe.execute(raise_on_error=False)
+            finally:
+                await r.aclose()
+        except (redis.ConnectionError, redis.TimeoutError):
+            _deferred_writes.extendleft(reversed(batch))
+            break
+        replayed += len(batch)
+    if replayed:
+        logger.info(f"redis: replayed {replayed} deferred writes, {len(_deferred_writes)} left")
+
+
+def script_sha(script: str) -> str:
+    return hashlib.sha1(script.encode("utf-8")).hexdigest()
+
+
+async def lua_eval(r: redis.Redis, script: str, numkeys: int, *keys_and_args: Any):
+    # EVALSHA без пересылки тела скрипта; после рестарта Redis — обычный EVAL
+    try:
+        return await r.evalsha(script_sha(script), numkeys, *keys_and_args)
+    except NoScriptError:
+        return await r.eval(script, numkeys, *keys_and_args)
+
+
+def pipe_lua(pipe, script: str, numkeys: int, *keys_and_args: Any):
+    # в пайплайне упавший EVALSHA не повторить EVAL-ом, поэтому скрипт
+    # регистрируется в пайплайне: перед execute redis-py проверит SCRIPT EXISTS
+    # и загрузит скрипт, если Redis его не знает
+    if not any(s.script == script for s in pipe.scripts):
+        pipe.scripts.add(pipe.register_script(script))
+    pipe.evalsha(script_sha(script), numkeys, *keys_and_args)
 
 
 def k_admin_subscription(cafe_id: str) -> str:
@@ -232,19 +646,354 @@ async def get_effective_admin_id(r: redis.Redis, cafe_id: str) -> int:
             return int(raw)
     except Exception:
         pass
-    return ADMIN_ID
-    
+    return SUPERADMIN_ID
+
+
+# ---------------- Tenants (cafes) ----------------
+# Один процесс обслуживает много кафе. Профиль кафе лежит в cafe:<id>:profile,
+# меню и остальные данные кафе — по ключам cafe_key(...). Профили лениво
+# грузятся из Redis в LRU (TenantCache). Кафе текущего апдейта определяет
+# TenantMiddleware (deep-link /start или сохранённая привязка чата), хендлеры
+# читают его через cafe(), фоновые задачи выставляют его через cafe_scope().
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "256"))
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "300"))
+CAFES_SET_KEY = "cafes:set"
+_CAFE_CODE_RE = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+def k_chat_cafe(chat_id: int) -> str:
+    return f"chat:{chat_id}:cafe"
+
+
+def cafe_key(key: str, cafe_id: Optional[str] = None) -> str:
+    # данные кафе по умолчанию остаются на прежних глобальных ключах
+    cafe_id = cafe_id or cafe().cafe_id
+    if cafe_id == DEFAULT_CAFE_CODE:
+        return key
+    return f"cafe:{cafe_id}:{key}"
+
+
+@dataclass(frozen=True)
+class CafeProfile:
+    cafe_id: str
+    name: str
+    phone: str
+    address: str
+    work_start: int
+    work_end: int
+    admin_id: int
+    return_cycle_days: int
+    menu: MenuRegistry
+    booking_tables: int = DEFAULT_BOOKING_TABLES
+
+
+def _profile_from_hash(cafe_id: str, raw: Dict[str, Any], base: CafeProfile, menu: MenuRegistry) -> CafeProfile:
+    def _int(field: str, default: int) -> int:
+        try:
+            return int(raw[field])
+        except Exception:
+            return default
+
+    work_start = _int("work_start", base.work_start)
+    work_end = _int("work_end", base.work_end)
+    if not _parse_work_hours([work_start, work_end]):
+        work_start, work_end = base.work_start, base.work_end
+    return_cycle_days = _int("return_cycle_days", base.return_cycle_days)
+
+    return CafeProfile(
+        cafe_id=cafe_id,
+        name=raw.get("name") or base.name,
+        phone=raw.get("phone") or base.phone,
+        address=raw.get("address") or base.address,
+        work_start=work_start,
+        work_end=work_end,
+        admin_id=_int("admin_id", base.admin_id),
+        return_cycle_days=return_cycle_days if return_cycle_days > 0 else base.return_cycle_days,
+        menu=menu,
+        booking_tables=max(1, _int("booking_tables", base.booking_tables)),
+    )
+
+
+def _default_profile_from_config(cfg: Mapping[str, Any]) -> CafeProfile:
+    return CafeProfile(
+        cafe_id=DEFAULT_CAFE_CODE,
+        name=cfg["name"],
+        phone=cfg["phone"],
+        address=cfg.get("address", ""),
+        work_start=int(cfg["work_start"]),
+        work_end=int(cfg["work_end"]),
+        admin_id=int(cfg["admin_chat_id"]),
+        return_cycle_days=int(cfg.get("return_cycle_days", DEFAULT_RETURN_CYCLE_DAYS)),
+        menu=_menu_registry_from_config(cfg["menu"]),
+        booking_tables=max(1, int(cfg.get("booking_tables", DEFAULT_BOOKING_TABLES))),
+    )
+
+
+class TenantCache:
+    def __init__(self, default: CafeProfile, maxsize: int, ttl: float):
+        self.default = default
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._default_loaded_at = 0.0
+        # cafe_id -> (loaded_at, profile)
+        self._profiles: "OrderedDict[str, Tuple[float, CafeProfile]]" = OrderedDict()
+        # chat_id -> (loaded_at, cafe_id или "" если чат не привязан)
+        self._bindings: "OrderedDict[int, Tuple[float, str]]" = OrderedDict()
+        self._loading: Dict[str, Tuple[asyncio.Task, int]] = {}
+        self._migrating: set = set()
+        # cafe_id -> счётчик invalidate(): загрузка, начатая до него, устарела
+        self._generations: Dict[str, int] = {}
+
+    def peek(self, cafe_id: str) -> Optional[CafeProfile]:
+        if cafe_id == self.default.cafe_id:
+            return self.default
+        entry = self._profiles.get(cafe_id)
+        return entry[1] if entry else None
+
+    def put(self, profile: CafeProfile, stale: bool = False):
+        now = float("-inf") if stale else time.monotonic()
+        if profile.cafe_id == self.default.cafe_id:
+            self.default = profile
+            self._default_loaded_at = now
+            return
+        self._profiles[profile.cafe_id] = (now, profile)
+        self._profiles.move_to_end(profile.cafe_id)
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+
+    def _fresh(self, cafe_id: str) -> Optional[CafeProfile]:
+        now = time.monotonic()
+        if cafe_id == self.default.cafe_id:
+            return self.default if now - self._default_loaded_at < self.ttl else None
+        entry = self._profiles.get(cafe_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            self._profiles.move_to_end(cafe_id)
+            return entry[1]
+        return None
+
+    async def get(self, cafe_id: Optional[str]) -> CafeProfile:
+        cafe_id = cafe_id or self.default.cafe_id
+        profile = self._fresh(cafe_id)
+        if profile is not None:
+            return profile
+
+        # одна загрузка на кафе, даже если апдейты пришли пачкой
+        loading = self._loading.get(cafe_id)
+        if loading is None:
+            task = asyncio.ensure_future(self._load(cafe_id))
+            loading = (task, self._generations.get(cafe_id, 0))
+            self._loading[cafe_id] = loading
+            task.add_done_callback(lambda _t, k=cafe_id: self._loading.pop(k, None))
+        task, generation = loading
+        profile = await asyncio.shield(task)
+
+        if profile is None:
+            # Redis недоступен или кафе неизвестно: отдаём то, что есть в памяти
+            return self.peek(cafe_id) or self.default
+        self.put(profile, stale=generation != self._generations.get(cafe_id, 0))
+        return profile
+
+    def invalidate(self, cafe_id: str):
+        # профиль остаётся доступен через peek(), но следующий get() перечитает Redis
+        self._generations[cafe_id] = self._generations.get(cafe_id, 0) + 1
+        if cafe_id == self.default.cafe_id:
+            self._default_loaded_at = 0.0
+            return
+        entry = self._profiles.get(cafe_id)
+        if entry is not None:
+            self._profiles[cafe_id] = (float("-inf"), entry[1])
+
+    async def _load(self, cafe_id: str, base: Optional[CafeProfile] = None) -> Optional[CafeProfile]:
+        is_default = cafe_id == self.default.cafe_id
+        try:
+            r = await get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            pipe.hgetall(k_cafe_profile(cafe_id))
+            pipe.hgetall(cafe_key(MENU_ITEMS_KEY, cafe_id))
+            pipe.get(cafe_key(MIGRATION_DRINKS_ZSET_KEY, cafe_id))
+            pipe.get(cafe_key(MIGRATION_RFM_KEY, cafe_id))
+            raw, menu_raw, drinks_migrated, rfm_migrated = await pipe.execute()
+            await r.aclose()
+        except RedisUnavailable:
+            return None  # цепь разомкнута — отдаём профиль из памяти молча
+        except Exception as e:
+            logger.error(f"tenant load {cafe_id}: {e}")
+            return None
+        if not raw and not is_default:
+            return None
+        if not menu_raw or drinks_migrated is None or rfm_migrated is None:
+            # пока миграции не прошли, меню берётся из текущего профиля / fallback
+            self.migrate_later(cafe_id)
+
+        items = [it for it in (_menu_item_load(k, v) for k, v in menu_raw.items()) if it]
+        if items:
+            menu = MenuRegistry(sorted(items, key=lambda it: it.id))
+        else:
+            # меню ещё не мигрировано: остаётся прежний (неизменяемый) реестр
+            current = self.peek(cafe_id)
+            menu = current.menu if current is not None else MenuRegistry()
+
+        if base is None:
+            base = self.default if is_default else replace(
+                self.default, cafe_id=cafe_id, name=cafe_id, phone="", address="", admin_id=0,
+            )
+        return _profile_from_hash(cafe_id, raw, base, menu)
+
+    async def reload_default(self, base: CafeProfile):
+        # новый профиль по умолчанию (поля config.json + Redis) собирается
+        # целиком и подменяется одним присваиванием. Без Redis остаётся текущий
+        # реестр меню: id позиций из config.json могут не совпадать с Redis.
+        self.invalidate(base.cafe_id)
+        profile = await self._load(base.cafe_id, base)
+        self.put(profile or replace(base, menu=self.default.menu))
+
+    def migrate_later(self, cafe_id: str):
+        # миграции — полные проходы по клиентам кафе: не в апдейте и не под его
+        # бюджетом, а фоновой задачей; по окончании профиль перечитывается
+        if cafe_id in self._migrating:
+            return
+        self._migrating.add(cafe_id)
+        spawn_background(self._migrate(cafe_id))
+
+    async def _migrate(self, cafe_id: str):
+        try:
+            r = await get_redis_client()
+            try:
+                await migrate_item_ids(r, cafe_id, self.default.menu)
+                await migrate_customer_drinks(r, cafe_id)
+                await migrate_rfm(r, cafe_id)
+            finally:
+                await r.aclose()
+        except Exception as e:
+            logger.error(f"tenant migrations {cafe_id}: {e}")
+        finally:
+            self._migrating.discard(cafe_id)
+        self.invalidate(cafe_id)
+
+    async def resolve_chat(self, chat_id: int) -> Optional[str]:
+        entry = self._bindings.get(chat_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._bindings.move_to_end(chat_id)
+            return entry[1] or None
+        try:
+            r = await get_redis_client()
+            cafe_id = await r.get(k_chat_cafe(chat_id)) or ""
+            await r.aclose()
+        except Exception:
+            if entry is not None:
+                return entry[1] or None
+            return None
+        self._remember_binding(chat_id, cafe_id)
+        return cafe_id or None
+
+    def _remember_binding(self, chat_id: int, cafe_id: str):
+        self._bindings[chat_id] = (time.monotonic(), cafe_id)
+        self._bindings.move_to_end(chat_id)
+        while len(self._bindings) > self.maxsize * 16:
+            self._bindings.popitem(last=False)
+
+    async def bind_chat(self, chat_id: int, cafe_id: str):
+        self._remember_binding(chat_id, cafe_id)
+        try:
+            r = await get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            pipe.set(k_chat_cafe(chat_id), cafe_id)
+            pipe.sadd(CAFES_SET_KEY, cafe_id)
+            await pipe.execute()
+            await r.aclose()
+        except Exception:
+            pass
+
+    async def known_ids(self) -> list:
+        ids = {self.default.cafe_id}
+        try:
+            r = await get_redis_client()
+            ids.update(str(x) for x in await r.smembers(CAFES_SET_KEY))
+            await r.aclose()
+        except Exception:
+            pass
+        return sorted(ids)
+
+
+tenants = TenantCache(_default_profile_from_config(config_snapshot.data), TENANT_CACHE_SIZE, TENANT_CACHE_TTL)
+_current_cafe: ContextVar[Optional[CafeProfile]] = ContextVar("current_cafe", default=None)
+
+
+def cafe() -> CafeProfile:
+    return _current_cafe.get() or tenants.default
+
+
+def set_current_cafe(profile: CafeProfile):
+    # после изменения профиля в хендлере: остаток апдейта видит новую версию
+    tenants.put(profile)
+    _current_cafe.set(profile)
+
+
+@contextmanager
+def cafe_scope(profile: CafeProfile):
+    token = _current_cafe.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_cafe.reset(token)
+
+
+def _decode_start_payload(payload: str) -> Optional[str]:
+    # ссылки из build_links_text: base64(cafe_code) или base64("admin:" + cafe_code)
+    payload = payload.strip()
+    try:
+        code = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode("utf-8")
+    except Exception:
+        code = payload
+    if code.startswith("admin:"):
+        code = code[len("admin:"):]
+    return code if _CAFE_CODE_RE.match(code) else None
+
+
+def _start_payload(update: Update) -> Optional[str]:
+    message = update.message
+    if message is None or not message.text or not message.text.startswith("/start"):
+        return None
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or parts[0].split("@", 1)[0] != "/start":
+        return None
+    return parts[1]
+
+
+class TenantMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        chat = data.get("event_chat")
+        cafe_id: Optional[str] = None
+
+        payload = _start_payload(event) if isinstance(event, Update) else None
+        if payload and chat is not None:
+            code = _decode_start_payload(payload)
+            if code:
+                profile = await tenants.get(code)
+                if profile.cafe_id == code:
+                    await tenants.bind_chat(chat.id, code)
+                    cafe_id = code
 
-def _rate_limit_key(user_id: int) -> str:
-    return f"rate_limit:{user_id}"
+        # бот, подключённый под конкретное кафе, всегда работает от его имени
+        bot = data.get("bot")
+        if bot is not None and bot_registry is not None:
+            cafe_id = bot_registry.cafe_for(bot.id) or cafe_id
+
+        if cafe_id is None and chat is not None:
+            cafe_id = await tenants.resolve_chat(chat.id)
+
+        profile = await tenants.get(cafe_id)
+        data["cafe"] = profile
+        with cafe_scope(profile):
+            return await handler(event, data)
 
 
 def _last_seen_key(user_id: int) -> str:
-    return f"{LAST_SEEN_KEY_PREFIX}{user_id}"
+    return cafe_key(f"{LAST_SEEN_KEY_PREFIX}{user_id}")
 
 
 def _last_order_key(user_id: int) -> str:
-    return f"{LAST_ORDER_KEY_PREFIX}{user_id}"
+    return cafe_key(f"{LAST_ORDER_KEY_PREFIX}{user_id}")
 
 
 async def is_user_paid(user_id: int) -> bool:
@@ -257,6 +1006,303 @@ async def is_user_paid(user_id: int) -> bool:
         return False
 
 
+# ---------------- FSM context cache ----------------
+# state/data читаются из storage один раз за апдейт, все set_state/update_data
+# копятся в памяти и в конце апдейта пишутся одним пайплайном (или не пишутся вовсе).
+# Если хендлер упал, накопленные изменения отбрасываются.
+_FSM_UNSET = object()
+
+
+def _fsm_state_name(state: Any) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+async def fsm_load(storage: BaseStorage, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+    if isinstance(storage, LocalCacheStorage):
+        return await storage.load(key)
+
+    if isinstance(storage, RedisStorage):
+        pipe = storage.redis.pipeline(transaction=False)
+        pipe.get(storage.key_builder.build(key, "state"))
+        pipe.get(storage.key_builder.build(key, "data"))
+        raw_state, raw_data = await pipe.execute()
+        if isinstance(raw_state, bytes):
+            raw_state = raw_state.decode("utf-8")
+        if isinstance(raw_data, bytes):
+            raw_data = raw_data.decode("utf-8")
+        return raw_state, (storage.json_loads(raw_data) if raw_data else {})
+
+    return await storage.get_state(key), await storage.get_data(key)
+
+
+def _fsm_queue_flush(pipe, storage: RedisStorage, key: StorageKey, state: Any, data: Any):
+    if state is not _FSM_UNSET:
+        state_key = storage.key_builder.build(key, "state")
+        if state is None:
+            pipe.delete(state_key)
+        else:
+            pipe.set(state_key, state, ex=storage.state_ttl)
+    if data is not _FSM_UNSET:
+        data_key = storage.key_builder.build(key, "data")
+        if not data:
+            pipe.delete(data_key)
+        else:
+            pipe.set(data_key, storage.json_dumps(data), ex=storage.data_ttl)
+
+
+async def fsm_flush(storage: BaseStorage, key: StorageKey, state: Any = _FSM_UNSET, data: Any = _FSM_UNSET):
+    if isinstance(storage, LocalCacheStorage):
+        await storage.flush(key, state, data)
+        return
+
+    if isinstance(storage, RedisStorage):
+        pipe = storage.redis.pipeline(transaction=False)
+        _fsm_queue_flush(pipe, storage, key, state, data)
+        await pipe.execute()
+        return
+
+    if state is not _FSM_UNSET:
+        await storage.set_state(key, state)
+    if data is not _FSM_UNSET:
+        await storage.set_data(key, data)
+
+
+# ---------------- FSM local cache ----------------
+# Опциональный слой перед RedisStorage: state/data недавно активных чатов лежат
+# в памяти процесса (LRU + TTL), любая запись сразу уходит в Redis (write-through).
+#
+# Предположение о маршрутизации: апдейты одного чата почти всегда обрабатывает
+# один и тот же процесс (один webhook URL на реплику или sticky routing по chat_id
+# на балансировщике). Если ключ всё же пишет другая реплика, она публикует его
+# в FSM_INVALIDATE_CHANNEL и остальные выкидывают запись из LRU. Между записью и
+# доставкой pub/sub сообщения чужая реплика может прочитать устаревший state;
+# TTL ограничивает это окно даже при потере сообщения. Инвалидация, пришедшая
+# пока ключ читается из Redis, сдвигает его поколение, и прочитанное значение
+# в кэш уже не попадает.
+FSM_LOCAL_CACHE_SIZE = int(os.getenv("FSM_LOCAL_CACHE_SIZE", "0"))  # 0 — выключено
+FSM_LOCAL_CACHE_TTL = float(os.getenv("FSM_LOCAL_CACHE_TTL", "300"))
+FSM_INVALIDATE_CHANNEL = "fsm:invalidate"
+
+
+class LocalCacheStorage(BaseStorage):
+    def __init__(self, inner: RedisStorage, maxsize: int, ttl: float):
+        self.inner = inner
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.replica_id = uuid.uuid4().hex[:12]
+        self.hits = 0
+        self.misses = 0
+        # cache_key -> (loaded_at, state, data)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], Dict[str, Any]]]" = OrderedDict()
+        # cache_key -> поколение последней инвалидации; _epoch сдвигает все сразу
+        self._generations: Dict[str, int] = {}
+        self._clock = 0
+        self._epoch = 0
+        self._listener: Optional[asyncio.Task] = None
+
+    def _cache_key(self, key: StorageKey) -> str:
+        return self.inner.key_builder.build(key, "state")
+
+    def _remember(self, cache_key: str, state: Optional[str], data: Dict[str, Any]):
+        self._entries[cache_key] = (time.monotonic(), state, data)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _generation(self, cache_key: str) -> Tuple[int, int]:
+        return self._epoch, self._generations.get(cache_key, 0)
+
+    def invalidate(self, cache_key: str):
+        self._entries.pop(cache_key, None)
+        if len(self._generations) >= self.maxsize:
+            # сброс всех поколений: загрузки в полёте просто не попадут в кэш
+            self._generations.clear()
+            self._epoch += 1
+        self._clock += 1
+        self._generations[cache_key] = self._clock
+
+    def invalidate_all(self):
+        self._entries.clear()
+        self._generations.clear()
+        self._epoch += 1
+
+    async def load(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        cache_key = self._cache_key(key)
+        entry = self._entries.get(cache_key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(cache_key)
+            return entry[1], copy.deepcopy(entry[2])
+
+        self.misses += 1
+        generation = self._generation(cache_key)
+        state, data = await fsm_load(self.inner, key)
+        if self._generation(cache_key) == generation:
+            self._remember(cache_key, state, copy.deepcopy(data))
+        return state, data
+
+    async def flush(self, key: StorageKey, state: Any = _FSM_UNSET, data: Any = _FSM_UNSET):
+        cache_key = self._cache_key(key)
+        pipe = self.inner.redis.pipeline(transaction=False)
+        _fsm_queue_flush(pipe, self.inner, key, state, data)
+        pipe.publish(FSM_INVALIDATE_CHANNEL, f"{self.replica_id}|{cache_key}")
+        generation = self._generation(cache_key)
+        try:
+            await pipe.execute()
+        except Exception:
+            self.invalidate(cache_key)
+            raise
+
+        entry = self._entries.get(cache_key)
+        if entry is None or self._generation(cache_key) != generation:
+            return
+        new_state = entry[1] if state is _FSM_UNSET else state
+        new_data = entry[2] if data is _FSM_UNSET else copy.deepcopy(dict(data or {}))
+        self._remember(cache_key, new_state, new_data)
+
+    async def set_state(self, key: StorageKey, state: Any = None) -> None:
+        await self.flush(key, state=_fsm_state_name(state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self.load(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.flush(key, data=data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self.load(key))[1]
+
+    async def _listen(self):
+        while True:
+            pubsub = self.inner.redis.pubsub()
+            try:
+                await pubsub.subscribe(FSM_INVALIDATE_CHANNEL)
+                # после (пере)подключения мы могли пропустить инвалидации
+                self.invalidate_all()
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    raw = msg.get("data")
+                    if isinstance(raw, bytes):
+                        raw = raw.decode("utf-8")
+                    replica_id, _, cache_key = str(raw).partition("|")
+                    if replica_id != self.replica_id:
+                        self.invalidate(cache_key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"fsm cache invalidation listener: {e}")
+                self.invalidate_all()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def start(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener and not self._listener.done():
+            self._listener.cancel()
+        await self.inner.close()
+
+
+class CachedFSMContext(FSMContext):
+    def __init__(self, storage: BaseStorage, key: StorageKey):
+        super().__init__(storage=storage, key=key)
+        self._loaded = False
+        self._state: Optional[str] = None
+        self._data: Dict[str, Any] = {}
+        self._orig_state: Optional[str] = None
+        self._orig_data: Dict[str, Any] = {}
+
+    async def load(self):
+        if self._loaded:
+            return
+        self._state, self._data = await fsm_load(self.storage, self.key)
+        self._orig_state = self._state
+        self._orig_data = copy.deepcopy(self._data)
+        self._loaded = True
+
+    async def set_state(self, state: Any = None) -> None:
+        await self.load()
+        self._state = _fsm_state_name(state)
+
+    async def get_state(self) -> Optional[str]:
+        await self.load()
+        return self._state
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        await self.load()
+        self._data = copy.deepcopy(dict(data))
+
+    async def get_data(self) -> Dict[str, Any]:
+        await self.load()
+        return copy.deepcopy(self._data)
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        await self.load()
+        return copy.deepcopy(self._data.get(key, default))
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        await self.load()
+        if data:
+            kwargs.update(data)
+        self._data.update(copy.deepcopy(kwargs))
+        return copy.deepcopy(self._data)
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+    async def flush(self):
+        if not self._loaded:
+            return
+        state = self._state if self._state != self._orig_state else _FSM_UNSET
+        data = self._data if self._data != self._orig_data else _FSM_UNSET
+        if state is _FSM_UNSET and data is _FSM_UNSET:
+            return
+        await fsm_flush(self.storage, self.key, state, data)
+        self._orig_state = self._state
+        self._orig_data = copy.deepcopy(self._data)
+
+
+class CachedFSMContextMiddleware(FSMContextMiddleware):
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        bot: Bot = data["bot"]
+        context = self.resolve_event_context(bot, data)
+        data["fsm_storage"] = self.storage
+        if context is None:
+            return await handler(event, data)
+
+        cached = CachedFSMContext(storage=self.storage, key=context.key)
+        async with self.events_isolation.lock(key=context.key):
+            await cached.load()
+            data.update({"state": cached, "raw_state": await cached.get_state()})
+            # изменения упавшего хендлера не сохраняем: полузаписанное состояние
+            # хуже исходного, а ошибка хендлера не подменяется ошибкой flush
+            result = await handler(event, data)
+            await cached.flush()
+            return result
+
+
+def install_cached_fsm(dp: Dispatcher):
+    # подменяем штатный FSMContextMiddleware на кэширующий; он встаёт в конец
+    # уже зарегистрированной цепочки, так что всё, что должно идти до FSM
+    # (метрики с бюджетом, лимитер), регистрируется раньше этого вызова
+    cached = CachedFSMContextMiddleware(
+        storage=dp.fsm.storage,
+        events_isolation=dp.fsm.events_isolation,
+        strategy=dp.fsm.strategy,
+    )
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(cached)
+    dp.fsm = cached
+
+
 # ---------------- States ----------------
 class OrderStates(StatesGroup):
     waiting_for_quantity = State()
@@ -284,27 +1330,30 @@ class MenuEditStates(StatesGroup):
 
 # ---------------- Working hours ----------------
 def is_cafe_open() -> bool:
-    return WORK_START <= get_moscow_time().hour < WORK_END
+    c = cafe()
+    return c.work_start <= get_moscow_time().hour < c.work_end
 
 
 def get_work_status() -> str:
-    h = get_moscow_time().hour
+    c = cafe()
     if is_cafe_open():
-        return f"🟢 <b>Открыто</b> (до {WORK_END}:00 МСК)"
-    return f"🔴 <b>Закрыто</b>\n🕐 Открываемся: {WORK_START}:00 (МСК)"
+        return f"🟢 <b>Открыто</b> (до {c.work_end}:00 МСК)"
+    return f"🔴 <b>Закрыто</b>\n🕐 Открываемся: {c.work_start}:00 (МСК)"
 
 
 def _address_line() -> str:
-    return f"\n📍 <b>Адрес:</b> {html.quote(CAFE_ADDRESS)}" if CAFE_ADDRESS else ""
+    address = cafe().address
+    return f"\n📍 <b>Адрес:</b> {html.quote(address)}" if address else ""
 
 
 def get_closed_message() -> str:
-    menu_text = " • ".join([f"<b>{html.quote(d)}</b> {p}₽" for d, p in MENU.items()])
+    c = cafe()
+    menu_text = " • ".join([f"<b>{html.quote(it.name)}</b> {it.price}₽" for it in c.menu.active()])
     return (
-        f"🔒 <b>{html.quote(CAFE_NAME)} сейчас закрыто!</b>\n\n"
+        f"🔒 <b>{html.quote(c.name)} сейчас закрыто!</b>\n\n"
         f"⏰ {get_work_status()}{_address_line()}\n\n"
         f"☕ <b>Меню:</b>\n{menu_text}\n\n"
-        f"📞 <b>Телефон:</b> <code>{html.quote(CAFE_PHONE)}</code>"
+        f"📞 <b>Телефон:</b> <code>{html.quote(c.phone)}</code>"
     )
 
 
@@ -313,11 +1362,37 @@ def get_user_name(message: Message) -> str:
 
 
 # ---------------- Admin notify ----------------
-async def send_admin_only(bot: Bot, text: str):
+# Независимые отправки (админу, в группу персонала, клиенту) идут параллельно:
+# ответ ждёт самый медленный запрос к Bot API, а не сумму всех. Сообщения в
+# один чат уходят по очереди, в порядке списка.
+async def fan_out(label: str, sends) -> list:
+    # sends: [(chat_id, корутина отправки)]; ошибка одной отправки не мешает
+    # остальным — вместо результата в списке будет исключение
+    chains: Dict[Any, list] = {}
+    for index, (chat_id, coro) in enumerate(sends):
+        chains.setdefault(chat_id, []).append((index, coro))
+    results: list = [None] * len(sends)
+
+    async def run_chain(chat_id, chain):
+        for index, coro in chain:
+            try:
+                results[index] = await coro
+            except Exception as e:
+                results[index] = e
+                logger.error(f"{label}: send to {chat_id} failed: {e}")
+
+    await asyncio.gather(*(run_chain(chat_id, chain) for chat_id, chain in chains.items()))
+    return results
+
+
+async def send_admin_only(bot: Bot, text: str, client_id: Optional[int] = None, kind: str = "") -> Optional[Message]:
     try:
-        await bot.send_message(ADMIN_ID, text, disable_web_page_preview=True)
+        sent = await bot.send_message(cafe().admin_id, text, disable_web_page_preview=True)
     except Exception:
-        pass
+        return None
+    if client_id is not None:
+        await remember_reply_route(bot, [sent], client_id, kind)
+    return sent
 
 
 async def send_admin_demo_to_user(bot: Bot, user_id: int, admin_like_text: str):
@@ -330,57 +1405,245 @@ async def send_admin_demo_to_user(bot: Bot, user_id: int, admin_like_text: str):
         pass
 
 
-# ---------------- Menu sync ----------------
-async def sync_menu_from_redis():
-    global MENU
+# ---------------- Admin reply routing ----------------
+# У каждого уведомления о заказе, брони или оплате запоминаем, о каком
+# клиенте оно: reply:route:<bot>:<chat>:<message_id> -> {client_id, kind, via}
+# на ADMIN_REPLY_TTL. Ответ админа reply'ем на уведомление находит клиента
+# одним GET и уходит ему: via="client" — через клиентского бота
+# (CLIENT_BOT_TOKEN, с ним общается плательщик), иначе — через того же бота.
+ADMIN_REPLY_TTL = int(os.getenv("ADMIN_REPLY_TTL", str(7 * 86400)))
+REPLY_ROUTE_PREFIX = "reply:route"
+
+
+def _reply_route_key(bot_id: int, chat_id: int, message_id: int) -> str:
+    return f"{REPLY_ROUTE_PREFIX}:{bot_id}:{chat_id}:{message_id}"
+
+
+async def remember_reply_route(bot: Bot, sent: list, client_id: int, kind: str, via: str = "bot"):
+    # sent — результаты отправки; неудачные (None, исключения) пропускаются
+    keys = [_reply_route_key(bot.id, m.chat.id, m.message_id) for m in sent if isinstance(m, Message)]
+    if not keys:
+        return
+    value = json.dumps({"client_id": client_id, "kind": kind, "via": via})
+
+    def queue(pipe):
+        for key in keys:
+            pipe.setex(key, ADMIN_REPLY_TTL, value)
+
     try:
-        r = await get_redis_client()
-        data = await r.hgetall(MENU_REDIS_KEY)
-        if data:
-            new_menu: Dict[str, int] = {}
-            for k, v in data.items():
-                try:
-                    new_menu[str(k)] = int(v)
-                except Exception:
-                    continue
-            if new_menu:
-                MENU = new_menu
-        else:
-            if MENU:
-                await r.hset(MENU_REDIS_KEY, mapping={k: str(v) for k, v in MENU.items()})
-        await r.aclose()
+        await write_or_defer(queue)
     except Exception as e:
-        logger.error(f"sync_menu_from_redis: {e}")
+        logger.error(f"remember_reply_route: {e}")
 
 
-async def menu_set_item(drink: str, price: int):
-    global MENU
-    MENU[drink] = price
+async def get_reply_route(bot: Bot, replied: Message) -> Optional[Dict[str, Any]]:
     try:
         r = await get_redis_client()
-        await r.hset(MENU_REDIS_KEY, drink, str(price))
+        raw = await r.get(_reply_route_key(bot.id, replied.chat.id, replied.message_id))
         await r.aclose()
     except Exception:
-        pass
+        return None
+    return json.loads(raw) if raw else None
+
+
+class ReplyRouteFilter(BaseFilter):
+    # срабатывает только на reply админа к уведомлению с известным клиентом,
+    # остальные сообщения админа идут дальше по роутеру
+    async def __call__(self, message: Message) -> Any:
+        if message.reply_to_message is None or message.from_user is None:
+            return False
+        if message.from_user.id not in (SUPERADMIN_ID, cafe().admin_id):
+            return False
+        route = await get_reply_route(message.bot, message.reply_to_message)
+        return {"reply_route": route} if route else False
+
+
+@router.message(ReplyRouteFilter())
+async def admin_reply_to_client(message: Message, reply_route: Dict[str, Any]):
+    text = message.text or message.caption
+    if not text:
+        await message.answer("❌ Ответ клиенту можно отправить только текстом.")
+        return
 
+    client_id = int(reply_route["client_id"])
+    sender = "поддержки Cafebotify" if reply_route.get("kind") == "payment" else html.quote(cafe().name)
+    reply = f"💬 <b>Ответ от {sender}:</b>\n\n{html.quote(text)}"
 
-async def menu_delete_item(drink: str):
-    global MENU
-    MENU.pop(drink, None)
+    client_token = (os.getenv("CLIENT_BOT_TOKEN") or "").strip()
+    via_client = reply_route.get("via") == "client" and client_token
+    bot = Bot(token=client_token) if via_client else message.bot
     try:
-        r = await get_redis_client()
-        await r.hdel(MENU_REDIS_KEY, drink)
-        await r.aclose()
-    except Exception:
-        pass
+        await bot.send_message(client_id, reply, parse_mode="HTML")
+        await message.answer(f"✅ Отправлено клиенту <code>{client_id}</code>")
+    except Exception as e:
+        logger.error(f"admin reply to {client_id}: {e}")
+        await message.answer("❌ Ошибка отправки")
+    finally:
+        if via_client:
+            await bot.session.close()
 
 
-# ---------------- Repeat last order offer ----------------
-BTN_REPEAT_LAST = "🔁 Повторить последний заказ"
-BTN_REPEAT_NO = "❌ Нет, спасибо"
+# ---------------- Menu sync ----------------
+async def migrate_item_ids(r: redis.Redis, cafe_id: str, fallback: MenuRegistry):
+    # одноразовая миграция меню кафе: имя напитка -> id в реестре, статистике,
+    # customer:drinks:*, customer:*.last_drink и last_order:*.
+    # Без старого хэша меню реестр просто заполняется из fallback.
+    if not await r.set(cafe_key(MIGRATION_ITEM_IDS_KEY, cafe_id), "running", nx=True, ex=600):
+        return
 
+    menu: Dict[str, int] = {}
+    for k, v in (await r.hgetall(cafe_key(MENU_REDIS_KEY, cafe_id))).items():
+        try:
+            menu[str(k)] = int(v)
+        except Exception:
+            continue
+    has_legacy = bool(menu)
+    if not menu:
+        menu = {it.name: it.price for it in fallback.active()}
+
+    items: Dict[str, MenuItem] = {}
+    for name, price in menu.items():
+        items[name] = MenuItem(id=len(items) + 1, name=name, price=price)
+
+    def item_id(name: str) -> int:
+        # имена, которых уже нет в меню, получают неактивный id — история сохраняется
+        item = items.get(name)
+        if item is None:
+            item = MenuItem(id=len(items) + 1, name=name, price=0, active=False)
+            items[name] = item
+        return item.id
+
+    pipe = r.pipeline(transaction=False)
+
+    if has_legacy:
+        for old_prefix, new_prefix in (
+            (cafe_key(STATS_DRINK_PREFIX, cafe_id), cafe_key(STATS_ITEM_PREFIX, cafe_id)),
+            (cafe_key(STATS_DRINK_REV_PREFIX, cafe_id), cafe_key(STATS_ITEM_REV_PREFIX, cafe_id)),
+        ):
+            async for key in r.scan_iter(match=f"{old_prefix}*", count=500):
+                try:
+                    val = int(await r.get(key) or 0)
+                except Exception:
+                    continue
+                pipe.incrby(f"{new_prefix}{item_id(key[len(old_prefix):])}", val)
+                pipe.delete(key)
 
-def create_repeat_offer_keyboard() -> ReplyKeyboardMarkup:
+        drinks_prefix = cafe_key(CUSTOMER_DRINKS_PREFIX, cafe_id)
+        async for key in r.scan_iter(match=f"{drinks_prefix}*", count=500):
+            converted: Dict[str, int] = {}
+            for name, cnt in (await r.hgetall(key)).items():
+                try:
+                    field = str(item_id(str(name)))
+                    converted[field] = converted.get(field, 0) + int(cnt)
+                except Exception:
+                    continue
+            pipe.delete(key)
+            if converted:
+                pipe.hset(key, mapping=converted)
+
+        for user_id in await r.smembers(cafe_key(CUSTOMERS_SET_KEY, cafe_id)):
+            customer_key = cafe_key(f"{CUSTOMER_KEY_PREFIX}{user_id}", cafe_id)
+            last_drink = await r.hget(customer_key, "last_drink")
+            if last_drink:
+                pipe.hset(customer_key, "last_drink", str(item_id(last_drink)))
+
+        last_order_prefix = cafe_key(LAST_ORDER_KEY_PREFIX, cafe_id)
+        async for key in r.scan_iter(match=f"{last_order_prefix}*", count=500):
+            try:
+                snap = json.loads(await r.get(key) or "null")
+                cart = snap.get("cart")
+                if not isinstance(cart, dict):
+                    continue
+                snap["cart"] = {str(item_id(str(n))): int(q) for n, q in cart.items()}
+            except Exception:
+                continue
+            pipe.set(key, json.dumps(snap, ensure_ascii=False), keepttl=True)
+
+    pipe.hset(cafe_key(MENU_ITEMS_KEY, cafe_id), mapping={str(it.id): _menu_item_dump(it) for it in items.values()})
+    pipe.set(cafe_key(MENU_ITEM_SEQ_KEY, cafe_id), len(items))
+    pipe.delete(cafe_key(MENU_REDIS_KEY, cafe_id))
+    pipe.set(cafe_key(MIGRATION_ITEM_IDS_KEY, cafe_id), "done")
+    await pipe.execute()
+    logger.info(f"migrate_item_ids {cafe_id}: {len(items)} items")
+
+
+async def migrate_customer_drinks(r: redis.Redis, cafe_id: str):
+    # одноразовая миграция customer:drinks:<id> (hash) -> customer:top:<id> (zset).
+    # ZINCRBY, а не ZADD: заказы, учтённые в zset во время миграции, не теряются.
+    if not await r.set(cafe_key(MIGRATION_DRINKS_ZSET_KEY, cafe_id), "running", nx=True, ex=600):
+        return
+
+    drinks_prefix = cafe_key(CUSTOMER_DRINKS_PREFIX, cafe_id)
+    top_prefix = cafe_key(CUSTOMER_TOP_PREFIX, cafe_id)
+    migrated = 0
+    async for key in r.scan_iter(match=f"{drinks_prefix}*", count=500):
+        user_id = key[len(drinks_prefix):]
+        pipe = r.pipeline(transaction=True)
+        for item_id, cnt in (await r.hgetall(key)).items():
+            try:
+                pipe.zincrby(f"{top_prefix}{user_id}", int(cnt), str(item_id))
+            except Exception:
+                continue
+        pipe.delete(key)
+        await pipe.execute()
+        migrated += 1
+
+    await r.set(cafe_key(MIGRATION_DRINKS_ZSET_KEY, cafe_id), "done")
+    logger.info(f"migrate_customer_drinks {cafe_id}: {migrated} customers")
+
+
+async def sync_menu_from_redis():
+    profile = cafe()
+    try:
+        r = await get_redis_client()
+        data = await r.hgetall(cafe_key(MENU_ITEMS_KEY))
+        await r.aclose()
+        if not data:
+            tenants.migrate_later(profile.cafe_id)
+        items = [it for it in (_menu_item_load(k, v) for k, v in data.items()) if it]
+        if items and {it.id: it for it in items} != profile.menu.items:
+            set_current_cafe(replace(profile, menu=MenuRegistry(sorted(items, key=lambda it: it.id))))
+    except Exception as e:
+        logger.error(f"sync_menu_from_redis: {e}")
+
+
+async def menu_set_item(name: str, price: int):
+    menu = cafe().menu
+    existing = menu.by_name(name, include_inactive=True)
+    item_id = existing.id if existing else None
+    try:
+        r = await get_redis_client()
+        if item_id is None:
+            item_id = int(await r.incr(cafe_key(MENU_ITEM_SEQ_KEY)))
+        await r.hset(cafe_key(MENU_ITEMS_KEY), str(item_id), _menu_item_dump(MenuItem(id=item_id, name=name, price=price)))
+        await r.aclose()
+    except Exception:
+        if item_id is None:
+            item_id = menu.next_id()
+    set_current_cafe(replace(cafe(), menu=menu.with_item(MenuItem(id=item_id, name=name, price=price))))
+
+
+async def menu_delete_item(name: str):
+    menu = cafe().menu
+    item = menu.by_name(name)
+    if item is None:
+        return
+    item = MenuItem(id=item.id, name=item.name, price=item.price, active=False)
+    set_current_cafe(replace(cafe(), menu=menu.with_item(item)))
+    try:
+        r = await get_redis_client()
+        await r.hset(cafe_key(MENU_ITEMS_KEY), str(item.id), _menu_item_dump(item))
+        await r.aclose()
+    except Exception:
+        pass
+
+
+# ---------------- Repeat last order offer ----------------
+BTN_REPEAT_LAST = "🔁 Повторить последний заказ"
+BTN_REPEAT_NO = "❌ Нет, спасибо"
+
+
+def create_repeat_offer_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=BTN_REPEAT_LAST), KeyboardButton(text=BTN_REPEAT_NO)]],
         resize_keyboard=True,
@@ -389,10 +1652,9 @@ def create_repeat_offer_keyboard() -> ReplyKeyboardMarkup:
 
 
 async def set_last_seen(user_id: int):
+    key, value = _last_seen_key(user_id), str(time.time())
     try:
-        r = await get_redis_client()
-        await r.set(_last_seen_key(user_id), str(time.time()))
-        await r.aclose()
+        await write_or_defer(lambda pipe: pipe.set(key, value))
     except Exception:
         pass
 
@@ -428,41 +1690,54 @@ async def get_last_order_snapshot(user_id: int) -> Optional[dict]:
 
 
 async def set_last_order_snapshot(user_id: int, snapshot: dict):
+    key, value = _last_order_key(user_id), json.dumps(snapshot, ensure_ascii=False)
     try:
-        r = await get_redis_client()
-        await r.set(_last_order_key(user_id), json.dumps(snapshot, ensure_ascii=False))
-        await r.aclose()
+        await write_or_defer(lambda pipe: pipe.set(key, value))
     except Exception:
         pass
 
 
 # ---------------- Cart helpers ----------------
-def _get_cart(data: Dict[str, Any]) -> Dict[str, int]:
+# корзина: {item_id: qty}; в FSM/снапшотах хранится как {"<item_id>": qty}
+def _get_cart(data: Dict[str, Any]) -> Dict[int, int]:
     cart = data.get("cart")
     if isinstance(cart, dict):
-        out: Dict[str, int] = {}
+        out: Dict[int, int] = {}
         for k, v in cart.items():
             try:
-                out[str(k)] = int(v)
+                key = str(k)
+                if key.isdigit():
+                    item_id = int(key)
+                else:
+                    # корзина, сохранённая до перехода на id (по имени напитка)
+                    item = cafe().menu.by_name(key)
+                    if item is None:
+                        continue
+                    item_id = item.id
+                out[item_id] = out.get(item_id, 0) + int(v)
             except Exception:
                 continue
         return out
     return {}
 
 
-def _cart_total(cart: Dict[str, int]) -> int:
-    return sum(int(MENU.get(d, 0)) * int(q) for d, q in cart.items())
+def _dump_cart(cart: Dict[int, int]) -> Dict[str, int]:
+    return {str(k): int(v) for k, v in cart.items()}
+
 
+def _cart_total(cart: Dict[int, int]) -> int:
+    return sum(cafe().menu.price(i) * int(q) for i, q in cart.items())
 
-def _cart_lines(cart: Dict[str, int]) -> list[str]:
+
+def _cart_lines(cart: Dict[int, int]) -> list[str]:
     lines = []
-    for d, q in cart.items():
-        p = int(MENU.get(d, 0))
-        lines.append(f"• {html.quote(d)} × {q} = <b>{p * int(q)}₽</b>")
+    for i, q in cart.items():
+        p = cafe().menu.price(i)
+        lines.append(f"• {html.quote(cafe().menu.name(i))} × {q} = <b>{p * int(q)}₽</b>")
     return lines
 
 
-def _cart_text(cart: Dict[str, int]) -> str:
+def _cart_text(cart: Dict[int, int]) -> str:
     if not cart:
         return "🛒 <b>Корзина пустая</b>\n\nЧтобы добавить: нажмите напиток → выберите количество."
     return "🛒 <b>Ваш заказ:</b>\n" + "\n".join(_cart_lines(cart)) + f"\n\n💰 Итого: <b>{_cart_total(cart)}₽</b>"
@@ -471,7 +1746,7 @@ def _cart_text(cart: Dict[str, int]) -> str:
 async def _show_cart(message: Message, state: FSMContext):
     cart = _get_cart(await state.get_data())
     await state.set_state(OrderStates.cart_view)
-    await state.update_data(cart=cart)
+    await state.update_data(cart=_dump_cart(cart))
     await message.answer(_cart_text(cart), reply_markup=create_cart_keyboard(bool(cart)))
 
 
@@ -537,7 +1812,7 @@ def create_start_keyboard() -> ReplyKeyboardMarkup:
 def create_client_menu_keyboard() -> ReplyKeyboardMarkup:
     kb: list[list[KeyboardButton]] = []
 
-    for drink in MENU.keys():
+    for drink in cafe().menu.names():
         kb.append([KeyboardButton(text=drink)])
 
     kb.append([
@@ -586,7 +1861,7 @@ def create_cart_keyboard(cart_has_items: bool) -> ReplyKeyboardMarkup:
     else:
         kb.append([KeyboardButton(text=BTN_CANCEL_ORDER)])
 
-    for drink in MENU.keys():
+    for drink in cafe().menu.names():
         kb.append([KeyboardButton(text=drink)])
 
     kb.append([
@@ -636,8 +1911,8 @@ def create_ready_time_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
-def create_cart_pick_item_keyboard(cart: Dict[str, int]) -> ReplyKeyboardMarkup:
-    rows: list[list[KeyboardButton]] = [[KeyboardButton(text=k)] for k in cart.keys()]
+def create_cart_pick_item_keyboard(cart: Dict[int, int]) -> ReplyKeyboardMarkup:
+    rows: list[list[KeyboardButton]] = [[KeyboardButton(text=cafe().menu.name(i))] for i in cart.keys()]
     rows.append([KeyboardButton(text=BTN_CANCEL), KeyboardButton(text=BTN_CART)])
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=True)
 
@@ -694,7 +1969,7 @@ def create_menu_edit_cancel_keyboard() -> ReplyKeyboardMarkup:
 
 
 def create_pick_menu_item_keyboard() -> ReplyKeyboardMarkup:
-    rows = [[KeyboardButton(text=k)] for k in MENU.keys()]
+    rows = [[KeyboardButton(text=k)] for k in cafe().menu.names()]
     rows.append([KeyboardButton(text=BTN_BACK)])
     return ReplyKeyboardMarkup(
         keyboard=rows,
@@ -703,8 +1978,96 @@ def create_pick_menu_item_keyboard() -> ReplyKeyboardMarkup:
     )
 
 
+# ---------------- Button dispatch ----------------
+# Нажатие кнопки = точный текст сообщения. Вместо цепочки из десятков
+# F.text == BTN_... хендлеров, которые aiogram проверяет по очереди, текст
+# резолвится в обработчик одним dict lookup.
+class ButtonTable:
+    def __init__(self):
+        self._buttons: Dict[str, CallableObject] = {}
+        self._menu_handler: Optional[CallableObject] = None
+        self._generation = 0
+        # menu -> (generation, {text: (handler, menu_item)}); своя таблица на
+        # каждый реестр меню (реестры неизменяемы, новое меню — новый ключ)
+        self._tables: "weakref.WeakKeyDictionary[MenuRegistry, Tuple[int, Dict[str, Tuple[CallableObject, Optional[MenuItem]]]]]" = weakref.WeakKeyDictionary()
+
+    def button(self, *texts: str):
+        def decorator(func):
+            for text in texts:
+                if text in self._buttons:
+                    raise ValueError(f"button {text!r} already registered")
+                self._buttons[text] = CallableObject(callback=func)
+            self._generation += 1
+            return func
+        return decorator
+
+    def menu_items(self, func):
+        self._menu_handler = CallableObject(callback=func)
+        self._generation += 1
+        return func
+
+    def ignore(self, *texts: str):
+        self.button(*[t for t in texts if t not in self._buttons])(_ignore_button)
+
+    def texts(self) -> list:
+        return list(self._buttons.keys())
+
+    def _table_for(self, menu: MenuRegistry) -> Dict[str, Tuple[CallableObject, Optional[MenuItem]]]:
+        stamp = self._generation
+        cached = self._tables.get(menu)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        table: Dict[str, Tuple[CallableObject, Optional[MenuItem]]] = {}
+        if self._menu_handler is not None:
+            for item in menu.active():
+                table[item.name] = (self._menu_handler, item)
+        for text, handler in self._buttons.items():
+            table[text] = (handler, None)
+        self._tables[menu] = (stamp, table)
+        return table
+
+    def warm(self, menu: MenuRegistry):
+        self._table_for(menu)
+
+    def resolve(self, text: Optional[str]) -> Optional[Tuple[CallableObject, Optional[MenuItem]]]:
+        if text is None:
+            return None
+        return self._table_for(cafe().menu).get(text)
+
+
+async def _ignore_button(message: Message):
+    return
+
+
+class ButtonFilter(BaseFilter):
+    def __init__(self, table: ButtonTable, strip: bool = False):
+        self.table = table
+        self.strip = strip
+
+    async def __call__(self, message: Message) -> Any:
+        text = message.text
+        if text is not None and self.strip:
+            text = text.strip()
+        found = self.table.resolve(text)
+        if found is None:
+            return False
+        return {"button_handler": found[0], "menu_item": found[1]}
+
+
+# кнопки, которые работают из любого состояния (проверяются до StateFilter-хендлеров)
+buttons = ButtonTable()
+# позиции меню и «служебные» кнопки состояний — после всех StateFilter-хендлеров
+fallback_buttons = ButtonTable()
+
+
+@router.message(ButtonFilter(buttons))
+async def dispatch_button(message: Message, button_handler: CallableObject, **kwargs):
+    return await button_handler.call(message, **kwargs)
+
+
 # ---- Хендлер: кнопка «🍽 Меню клиента» ----
-@router.message(F.text == BTN_CLIENT_MENU)
+@buttons.button(BTN_CLIENT_MENU)
 async def open_client_menu(message: Message, state: FSMContext):
     await state.clear()
     await sync_menu_from_redis()
@@ -717,7 +2080,7 @@ async def open_client_menu(message: Message, state: FSMContext):
     )
 
 
-@router.message(F.text == BTN_OWNER_MENU)
+@buttons.button(BTN_OWNER_MENU)
 async def open_owner_menu(message: Message, state: FSMContext):
     await state.clear()
 
@@ -730,7 +2093,7 @@ async def open_owner_menu(message: Message, state: FSMContext):
 
 
 # ---- Хендлер: кнопка «🏠 Главное меню» (BTN_TO_START) ----
-@router.message(F.text == BTN_TO_START)
+@buttons.button(BTN_TO_START)
 async def back_to_start(message: Message, state: FSMContext):
     await state.clear()
     await sync_menu_from_redis()
@@ -880,6 +2243,8 @@ FINISH_VARIANTS = [
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
+    if await rate_limit_hit(message, "start"):
+        return
     await state.clear()
     await sync_menu_from_redis()
 
@@ -891,22 +2256,16 @@ async def cmd_start(message: Message, state: FSMContext):
     await set_last_seen(user_id)
 
     if not is_cafe_open():
-        await message.answer(
+        return message.answer(
             get_closed_message(),
             reply_markup=create_start_keyboard(),
         )
-        return
 
     if offer_repeat:
         snap = await get_last_order_snapshot(user_id)
         if snap and isinstance(snap.get("cart"), dict) and snap.get("cart"):
-            cart_preview = snap["cart"]
-            lines = []
-            for d, q in cart_preview.items():
-                try:
-                    lines.append(f"• {html.quote(str(d))} × {int(q)}")
-                except Exception:
-                    continue
+            cart_preview = _get_cart(snap)
+            lines = [f"• {html.quote(cafe().menu.name(i))} × {q}" for i, q in cart_preview.items()]
 
             await state.update_data(repeat_offer_snapshot=snap)
             await message.answer(
@@ -929,7 +2288,7 @@ async def cmd_start(message: Message, state: FSMContext):
 async def myid_cmd(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or ""
-    await message.answer(
+    return message.answer(
         "🆔 <b>Ваш Telegram ID</b>\n\n"
         f"<code>{user_id}</code>\n\n"
         "Скопируйте этот ID и укажите его в форме на лендинге "
@@ -953,14 +2312,14 @@ async def botstart_cmd(message: Message):
     await message.answer(text, disable_web_page_preview=True, reply_markup=create_start_keyboard())
 
 
-@router.message(F.text == BTN_REPEAT_NO)
+@buttons.button(BTN_REPEAT_NO)
 async def repeat_no(message: Message, state: FSMContext):
     await state.update_data(repeat_offer_snapshot=None)
     await message.answer("Ок.", reply_markup=create_start_keyboard())
 
 
 
-@router.message(F.text == BTN_REPEAT_LAST)
+@buttons.button(BTN_REPEAT_LAST)
 async def repeat_last(message: Message, state: FSMContext):
     data = await state.get_data()
     snap = data.get("repeat_offer_snapshot") or await get_last_order_snapshot(message.from_user.id)
@@ -969,23 +2328,21 @@ async def repeat_last(message: Message, state: FSMContext):
         await message.answer("Не нашёл последний заказ.", reply_markup=create_start_keyboard())
         return
 
-    cart = {}
-    for k, v in snap["cart"].items():
-        try:
-            cart[str(k)] = int(v)
-        except Exception:
-            continue
-
-    filtered = {d: q for d, q in cart.items() if d in MENU and q > 0}
+    cart = _get_cart(snap)
+    filtered = {}
+    for i, q in cart.items():
+        item = cafe().menu.get(i)
+        if item and item.active and q > 0:
+            filtered[i] = q
     if not filtered:
         await message.answer("Позиции из прошлого заказа сейчас отсутствуют в меню.", reply_markup=create_start_keyboard())
         return
 
-    await state.update_data(cart=filtered)
+    await state.update_data(cart=_dump_cart(filtered))
     await _show_cart(message, state)
 
 
-@router.message(F.text == BTN_ABOUT_ASSISTANT)
+@buttons.button(BTN_ABOUT_ASSISTANT)
 async def about_assistant(message: Message):
     await message.answer(
         about_assistant_text() + "\n\n"
@@ -996,8 +2353,10 @@ async def about_assistant(message: Message):
 
 
 # ---------------- Pay buttons ----------------
-@router.message(F.text == BTN_PAY_MONTH)
+@buttons.button(BTN_PAY_MONTH)
 async def pay_month_button(message: Message):
+    if await rate_limit_hit(message, "pay"):
+        return
     user_id = message.from_user.id
     url = f"{PAY_LANDING_MONTH}?tg_id={user_id}"
     text = (
@@ -1013,8 +2372,10 @@ async def pay_month_button(message: Message):
     )
 
 
-@router.message(F.text == BTN_PAY_YEAR)
+@buttons.button(BTN_PAY_YEAR)
 async def pay_year_button(message: Message):
+    if await rate_limit_hit(message, "pay"):
+        return
     user_id = message.from_user.id
     url = f"{PAY_LANDING_YEAR}?tg_id={user_id}"
     text = (
@@ -1031,57 +2392,58 @@ async def pay_year_button(message: Message):
 
 
 # ---------------- Info buttons ----------------
-@router.message(F.text == BTN_CALL)
+# ответ возвращается, а не отправляется (см. WEBHOOK_REPLY_INLINE)
+@buttons.button(BTN_CALL)
 async def call_phone(message: Message):
-    await message.answer(
-        f"📞 <b>Телефон:</b> <code>{html.quote(CAFE_PHONE)}</code>",
+    return message.answer(
+        f"📞 <b>Телефон:</b> <code>{html.quote(cafe().phone)}</code>",
         reply_markup=create_client_menu_keyboard(),
     )
 
 
-@router.message(F.text == BTN_HOURS)
+@buttons.button(BTN_HOURS)
 async def show_hours(message: Message):
     msk_time = get_moscow_time().strftime("%H:%M")
-    await message.answer(
+    return message.answer(
         f"🕐 <b>Сейчас:</b> {msk_time} (МСК)\n{get_work_status()}{_address_line()}",
         reply_markup=create_client_menu_keyboard(),
     )
 
 
-@router.message(F.text == BTN_STAFF_GROUP)
+@buttons.button(BTN_STAFF_GROUP)
 async def owner_staff_group(message: Message):
     await message.answer(owner_staff_group_text(), reply_markup=create_owner_menu_keyboard())
 
 
-@router.message(F.text == BTN_LINKS)
+@buttons.button(BTN_LINKS)
 async def owner_links(message: Message):
     await message.answer(owner_links_text(), reply_markup=create_owner_menu_keyboard())
 
 
-@router.message(F.text == BTN_RENEW_SUB)
+@buttons.button(BTN_RENEW_SUB)
 async def owner_renew_subscription(message: Message):
     await message.answer(owner_renew_subscription_text(), reply_markup=create_owner_menu_keyboard())
 
 
-@router.message(F.text == BTN_SUBSCRIPTION)
+@buttons.button(BTN_SUBSCRIPTION)
 async def owner_subscription(message: Message):
     await message.answer(owner_subscription_text(), reply_markup=create_owner_menu_keyboard())
 
 
-@router.message(F.text == BTN_ADMIN_HELP)
+@buttons.button(BTN_ADMIN_HELP)
 async def owner_admin_help(message: Message):
     await message.answer(owner_admin_help_text(), reply_markup=create_owner_menu_keyboard())
 
 
-@router.message(F.text == BTN_SUPPORT)
+@buttons.button(BTN_SUPPORT)
 async def owner_support(message: Message):
     await message.answer(owner_support_text(), reply_markup=create_owner_menu_keyboard())
 
 
 # ---------------- Menu edit entry (DEMO preview for non-admin) ----------------
-@router.message(F.text == BTN_MENU_EDIT)
+@buttons.button(BTN_MENU_EDIT)
 async def menu_edit_entry(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         if DEMO_MODE:
             await message.answer(demo_menu_edit_preview_text(), reply_markup=create_menu_edit_keyboard())
             await message.answer("🔒 Редактирование доступно только администратору.", reply_markup=create_start_keyboard())
@@ -1097,7 +2459,7 @@ async def menu_edit_entry(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.waiting_for_action))
 async def menu_edit_choose_action(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1126,7 +2488,7 @@ async def menu_edit_choose_action(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.waiting_for_add_name))
 async def menu_edit_add_name(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1147,7 +2509,7 @@ async def menu_edit_add_name(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.waiting_for_add_price))
 async def menu_edit_add_price(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1173,7 +2535,7 @@ async def menu_edit_add_price(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.pick_edit_item))
 async def menu_pick_edit_item(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1183,7 +2545,7 @@ async def menu_pick_edit_item(message: Message, state: FSMContext):
         return
 
     picked = (message.text or "").strip()
-    if picked not in MENU:
+    if cafe().menu.by_name(picked) is None:
         await message.answer("Выберите позицию кнопкой.", reply_markup=create_pick_menu_item_keyboard())
         return
 
@@ -1194,7 +2556,7 @@ async def menu_pick_edit_item(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.waiting_for_edit_price))
 async def menu_edit_price(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1213,7 +2575,7 @@ async def menu_edit_price(message: Message, state: FSMContext):
 
     data = await state.get_data()
     name = str(data.get("edit_name") or "")
-    if name not in MENU:
+    if cafe().menu.by_name(name) is None:
         await state.clear()
         await message.answer("Позиция не найдена. /start", reply_markup=create_start_keyboard())
         return
@@ -1225,7 +2587,7 @@ async def menu_edit_price(message: Message, state: FSMContext):
 
 @router.message(StateFilter(MenuEditStates.pick_remove_item))
 async def menu_pick_remove_item(message: Message, state: FSMContext):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         await state.clear()
         return
 
@@ -1235,7 +2597,7 @@ async def menu_pick_remove_item(message: Message, state: FSMContext):
         return
 
     picked = (message.text or "").strip()
-    if picked not in MENU:
+    if cafe().menu.by_name(picked) is None:
         await message.answer("Выберите позицию кнопкой.", reply_markup=create_pick_menu_item_keyboard())
         return
 
@@ -1245,9 +2607,12 @@ async def menu_pick_remove_item(message: Message, state: FSMContext):
 
 
 # ---------------- Stats button (DEMO preview for non-admin) ----------------
-@router.message(F.text == BTN_STATS)
+WEEKDAY_NAMES = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+
+
+@buttons.button(BTN_STATS)
 async def stats_button(message: Message):
-    if message.from_user.id != ADMIN_ID:
+    if message.from_user.id != cafe().admin_id:
         if DEMO_MODE:
             await message.answer(demo_stats_preview_text(), reply_markup=create_start_keyboard())
         else:
@@ -1256,51 +2621,69 @@ async def stats_button(message: Message):
 
     try:
         r = await get_redis_client()
-        total_orders = int(await r.get(STATS_TOTAL_ORDERS) or 0)
-        total_rev = int(await r.get(STATS_TOTAL_REVENUE) or 0)
+        total_orders = int(await r.get(cafe_key(STATS_TOTAL_ORDERS)) or 0)
+        total_rev = int(await r.get(cafe_key(STATS_TOTAL_REVENUE)) or 0)
 
+        items = cafe().menu.active()
         lines = []
-        for drink in MENU.keys():
-            cnt = int(await r.get(f"{STATS_DRINK_PREFIX}{drink}") or 0)
-            rev = int(await r.get(f"{STATS_DRINK_REV_PREFIX}{drink}") or 0)
-            lines.append(f"• {html.quote(drink)}: <b>{cnt}</b> шт., <b>{rev}₽</b>")
-
+        if items:
+            cnts = await r.mget([cafe_key(f"{STATS_ITEM_PREFIX}{it.id}") for it in items])
+            revs = await r.mget([cafe_key(f"{STATS_ITEM_REV_PREFIX}{it.id}") for it in items])
+            for it, cnt, rev in zip(items, cnts, revs):
+                lines.append(f"• {html.quote(it.name)}: <b>{int(cnt or 0)}</b> шт., <b>{int(rev or 0)}₽</b>")
+
+        by_hour = await r.hgetall(cafe_key(STATS_HOUR_KEY))
+        by_weekday = await r.hgetall(cafe_key(STATS_WEEKDAY_KEY))
+        baskets = await r.hgetall(cafe_key(STATS_BASKET_KEY))
         await r.aclose()
 
+        extra = []
+        if by_hour:
+            hour = max(by_hour, key=lambda k: int(by_hour[k]))
+            extra.append(f"Пиковый час: <b>{int(hour):02d}:00</b> ({by_hour[hour]} заказов)")
+        if by_weekday:
+            day = max(by_weekday, key=lambda k: int(by_weekday[k]))
+            extra.append(f"Самый загруженный день: <b>{WEEKDAY_NAMES[int(day)]}</b>")
+        basket_orders = sum(int(v) for v in baskets.values())
+        if basket_orders:
+            avg = sum(int(k) * int(v) for k, v in baskets.items()) / basket_orders
+            extra.append(f"Средний размер заказа: <b>{avg:.1f}</b> поз.")
+
         text = (
             "📊 <b>Статистика</b>\n\n"
             f"Всего заказов: <b>{total_orders}</b>\n"
             f"Выручка всего: <b>{total_rev}₽</b>\n\n"
             "<b>По позициям:</b>\n" + "\n".join(lines)
         )
+        if extra:
+            text += "\n\n" + "\n".join(extra)
         await message.answer(text, reply_markup=create_start_keyboard())
     except Exception:
         await message.answer("❌ Ошибка статистики", reply_markup=create_start_keyboard())
 
 
 # ---------------- Cart show/clear/cancel ----------------
-@router.message(F.text == BTN_CART)
+@buttons.button(BTN_CART)
 async def cart_button(message: Message, state: FSMContext):
     if not is_cafe_open():
-        await message.answer(get_closed_message(), reply_markup=create_start_keyboard())
-        return
+        return message.answer(get_closed_message(), reply_markup=create_start_keyboard())
     await _show_cart(message, state)
 
 
-@router.message(F.text == BTN_CLEAR_CART)
+@buttons.button(BTN_CLEAR_CART)
 async def clear_cart(message: Message, state: FSMContext):
     await state.update_data(cart={})
     await _show_cart(message, state)
 
 
-@router.message(F.text == BTN_CANCEL_ORDER)
+@buttons.button(BTN_CANCEL_ORDER)
 async def cancel_order(message: Message, state: FSMContext):
     await state.clear()
     await message.answer("❌ Заказ отменён.", reply_markup=create_start_keyboard())
 
 
 # ---------------- Cart edit ----------------
-@router.message(F.text == BTN_EDIT_CART)
+@buttons.button(BTN_EDIT_CART)
 async def edit_cart(message: Message, state: FSMContext):
     cart = _get_cart(await state.get_data())
     if not cart:
@@ -1310,11 +2693,10 @@ async def edit_cart(message: Message, state: FSMContext):
     await message.answer("Выберите позицию:", reply_markup=create_cart_pick_item_keyboard(cart))
 
 
-@router.message(F.from_user.id == ADMIN_ID)
+@router.message(F.from_user.id == SUPERADMIN_ID, F.text.startswith("[Ответ] tgid:"))
 async def admin_write_to_payer(message: Message):
-    if not (text := message.text) or not text.startswith("[Ответ] tgid:"):
-        return  # не ответ плательщику
-    
+    text = message.text
+
     # Парсим tgid из текста
     tgid_match = re.search(r"tgid:(\d+)", text)
     if not tgid_match:
@@ -1347,12 +2729,13 @@ async def pick_item_to_edit(message: Message, state: FSMContext):
         return
 
     cart = _get_cart(await state.get_data())
-    if text not in cart:
+    item_id = next((i for i in cart if cafe().menu.name(i) == text), None)
+    if item_id is None:
         await message.answer("Выберите позицию кнопкой.", reply_markup=create_cart_pick_item_keyboard(cart))
         return
 
     await state.set_state(OrderStates.cart_edit_pick_action)
-    await state.update_data(edit_item=text)
+    await state.update_data(edit_item=item_id)
     await message.answer(f"Что сделать с <b>{html.quote(text)}</b>?", reply_markup=create_cart_edit_actions_keyboard())
 
 
@@ -1365,7 +2748,10 @@ async def cart_edit_action(message: Message, state: FSMContext):
 
     data = await state.get_data()
     cart = _get_cart(data)
-    item = str(data.get("edit_item") or "")
+    try:
+        item = int(data.get("edit_item") or 0)
+    except Exception:
+        item = 0
 
     if action == CART_ACT_DONE:
         await _show_cart(message, state)
@@ -1387,38 +2773,23 @@ async def cart_edit_action(message: Message, state: FSMContext):
         await message.answer("Выберите действие кнопкой.", reply_markup=create_cart_edit_actions_keyboard())
         return
 
-    await state.update_data(cart=cart)
+    await state.update_data(cart=_dump_cart(cart))
     await _show_cart(message, state)
 
 
-# ---- Хендлер: кнопка «🍽 Меню клиента» ----
-@router.message(F.text == BTN_CLIENT_MENU)
-async def open_client_menu(message: Message, state: FSMContext):
-    await state.clear()
-    await sync_menu_from_redis()
-
-    await message.answer(
-        "🍽 <b>Меню клиента</b>\n\n"
-        "Выберите напиток из списка ниже, чтобы добавить его в корзину.\n"
-        "Когда будете готовы — перейдите в корзину, чтобы оформить заказ.",
-        reply_markup=create_client_menu_keyboard(),  # клавиатура с напитками, корзиной и «🏠 Главное меню»
-    )
-
-
 # ---------------- Add item: drink -> quantity ----------------
-async def _start_add_item(message: Message, state: FSMContext, drink: str):
-    price = MENU.get(drink)
-    if price is None:
+async def _start_add_item(message: Message, state: FSMContext, item: Optional[MenuItem]):
+    if item is None or not item.active:
         await message.answer("Этой позиции уже нет.", reply_markup=create_start_keyboard())
         return
 
     cart = _get_cart(await state.get_data())
     await state.set_state(OrderStates.waiting_for_quantity)
-    await state.update_data(current_drink=drink, cart=cart)
+    await state.update_data(current_item=item.id, cart=_dump_cart(cart))
 
     await message.answer(
         f"{random.choice(CHOICE_VARIANTS)}\n\n"
-        f"🥤 <b>{html.quote(drink)}</b>\n💰 <b>{price}₽</b>\n\nСколько добавить?",
+        f"🥤 <b>{html.quote(item.name)}</b>\n💰 <b>{item.price}₽</b>\n\nСколько добавить?",
         reply_markup=create_quantity_keyboard(),
     )
 
@@ -1443,30 +2814,693 @@ async def process_quantity(message: Message, state: FSMContext):
         return
 
     data = await state.get_data()
-    drink = str(data.get("current_drink") or "")
+    try:
+        item = cafe().menu.get(int(data.get("current_item") or 0))
+    except Exception:
+        item = None
     cart = _get_cart(data)
 
-    if not drink or drink not in MENU:
+    if item is None or not item.active:
         await state.clear()
         await message.answer("Ошибка. Нажмите /start.", reply_markup=create_start_keyboard())
         return
 
-    cart[drink] = int(cart.get(drink, 0)) + qty
-    await state.update_data(cart=cart)
+    cart[item.id] = int(cart.get(item.id, 0)) + qty
+    await state.update_data(cart=_dump_cart(cart))
     await state.set_state(OrderStates.cart_view)
 
     await message.answer(
-        f"✅ Добавил в корзину: <b>{html.quote(drink)}</b> × {qty}\n\n{_cart_text(cart)}",
+        f"✅ Добавил в корзину: <b>{html.quote(item.name)}</b> × {qty}\n\n{_cart_text(cart)}",
         reply_markup=create_cart_keyboard(True),
     )
 
 
+# ---------------- Order ledger ----------------
+# Каждый оформленный заказ дописывается в стрим кафе (orders:stream, XADD с
+# приблизительным MAXLEN). Номер заказа — атомарный дневной счётчик кафе.
+# Запись в стрим идёт фоновой задачей и не задерживает ответ клиенту.
+# Тот же скрипт создаёт группу консьюмеров аналитики (если она ещё не создана)
+# до XADD: у нового стрима первый заказ уже попадает в группу.
+# id записи строится из времени заказа (<ts в мс>-*), а не из момента XADD:
+# отложенная при недоступном Redis запись ложится на своё время, и выборки
+# по диапазону id (выгрузка) её находят. Если в стриме уже есть более поздний
+# id (запись доигрывается после новых заказов), остаётся только "*".
+ORDER_APPEND_LUA = """
+if ARGV[2] ~= '' then
+  pcall(redis.call, 'XGROUP', 'CREATE', KEYS[1], ARGV[2], '$', 'MKSTREAM')
+end
+local ok, id = pcall(redis.call, 'XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], ARGV[3] .. '-*', unpack(ARGV, 4))
+if ok then
+  return id
+end
+return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', unpack(ARGV, 4))
+"""
+
+_background_tasks: set = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    # фоновая задача переживает апдейт и не наследует его бюджет
+    context = copy_context()
+    context.run(_update_budget.set, None)
+    task = asyncio.create_task(coro, context=context)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def next_order_number() -> str:
+    day = get_moscow_time()
+    seq_key = cafe_key(f"{ORDER_SEQ_PREFIX}{day:%Y%m%d}")
+    try:
+        r = await get_redis_client()
+        pipe = r.pipeline(transaction=True)
+        pipe.incr(seq_key)
+        pipe.expire(seq_key, 3 * 86400)
+        seq, _ = await pipe.execute()
+        await r.aclose()
+    except Exception as e:
+        logger.error(f"order seq {seq_key}: {e}")
+        # без Redis номер всё равно нужен: время + случайный хвост
+        return f"{day:%d%m}-T{int(time.time()) % 100000:05d}{random.randint(0, 9)}"
+    return f"{day:%d%m}-{int(seq)}"
+
+
+def build_order_entry(
+    order_num: str, user_id: int, firstname: str, username: str, cart: Dict[int, int], total: int, ready_in_min: int
+) -> Dict[str, str]:
+    menu = cafe().menu
+    now_ts = int(time.time())
+    items = [
+        {"id": int(i), "name": menu.name(i), "price": menu.price(i), "qty": int(q)}
+        for i, q in cart.items()
+    ]
+    return {
+        "order": order_num,
+        "cafe_id": cafe().cafe_id,
+        "user_id": str(user_id),
+        "firstname": firstname or "",
+        "username": username or "",
+        "items": json.dumps(items, ensure_ascii=False),
+        "total": str(int(total)),
+        "ready_in_min": str(int(ready_in_min)),
+        "ready_at": str(now_ts + max(0, int(ready_in_min)) * 60),
+        "ts": str(now_ts),
+    }
+
+
+async def append_order(entry: Dict[str, str]):
+    stream_key = cafe_key(ORDERS_STREAM_KEY, entry["cafe_id"])
+    group = ANALYTICS_GROUP if ANALYTICS_ENABLED else ""
+    created_ms = int(entry["ts"]) * 1000
+    fields = [x for pair in entry.items() for x in pair]
+    try:
+        # при недоступном Redis заказ ляжет в стрим после восстановления, с id по времени заказа
+        await write_or_defer(
+            lambda pipe: pipe_lua(pipe, ORDER_APPEND_LUA, 1, stream_key, ORDERS_STREAM_MAXLEN, group, created_ms, *fields)
+        )
+    except Exception as e:
+        logger.error(f"order ledger append {entry.get('order')}: {e}")
+
+
+def parse_order_entry(entry_id: str, fields: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        items = json.loads(fields.get("items") or "[]")
+    except Exception:
+        items = []
+    return {
+        "id": entry_id,
+        "order": fields.get("order", ""),
+        "cafe_id": fields.get("cafe_id", ""),
+        "user_id": int(fields.get("user_id") or 0),
+        "firstname": fields.get("firstname", ""),
+        "username": fields.get("username", ""),
+        "items": items,
+        "total": int(fields.get("total") or 0),
+        "ready_in_min": int(fields.get("ready_in_min") or 0),
+        "ready_at": int(fields.get("ready_at") or 0),
+        "ts": int(fields.get("ts") or 0),
+    }
+
+
+# ---------------- Delayed jobs ----------------
+# Отложенные задачи (напоминания о бронях и подписке, предложения вернуться)
+# лежат в одном zset jobs:due со временем исполнения в score, тело задачи —
+# в hash jobs:data. Поллер раз в JOBS_POLL_SECONDS забирает Lua-скриптом не
+# больше JOBS_BATCH созревших задач, так что цена тика не зависит от общего
+# числа задач, а забрать одну задачу могут только один раз на все воркеры.
+# Взятая задача арендуется в jobs:inflight и возвращается в очередь, если
+# воркер умер, не подтвердив её.
+# Задача уходит от бота своего кафе (bot_registry); кафе без своего бота
+# (в том числе подключённые по ссылке основного бота) обслуживает основной.
+# Упавшая задача (сбой Redis или Telegram) переносится с экспоненциальной
+# задержкой от JOBS_RETRY_SECONDS и подтверждается только после успеха или
+# JOBS_MAX_ATTEMPTS попыток. Обработчики глотают лишь окончательные ответы
+# Telegram: бот заблокирован, чат не найден.
+JOBS_DUE_KEY = "jobs:due"            # zset {job_id: due_ts}
+JOBS_INFLIGHT_KEY = "jobs:inflight"  # zset {job_id: lease_until}
+JOBS_DATA_KEY = "jobs:data"          # hash {job_id: json}
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", "1"))
+JOBS_BATCH = 100
+JOBS_LEASE_SECONDS = 300
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_SECONDS = 60
+
+JOBS_POP_LUA = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(stale) do
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('ZADD', KEYS[1], 'NX', ARGV[1], id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local out = {}
+for _, id in ipairs(ids) do
+  redis.call('ZREM', KEYS[1], id)
+  redis.call('ZADD', KEYS[2], ARGV[3], id)
+  out[#out + 1] = id
+  out[#out + 1] = redis.call('HGET', KEYS[3], id) or ''
+end
+return out
+"""
+
+# задача, которую обработчик переназначил, остаётся в jobs:due вместе с телом
+JOBS_ACK_LUA = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+  redis.call('HDEL', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+JOB_HANDLERS: Dict[str, Any] = {}
+
+
+def job_handler(job_type: str):
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+
+def job_id_for(job_type: str, *parts: Any) -> str:
+    return ":".join([job_type, *(str(p) for p in parts)])
+
+
+def queue_job(pipe, job_id: str, due_ts: int, payload: Dict[str, Any]):
+    # повторная постановка с тем же id переносит задачу, а не дублирует её
+    pipe.hset(JOBS_DATA_KEY, job_id, json.dumps(payload, ensure_ascii=False))
+    pipe.zadd(JOBS_DUE_KEY, {job_id: int(due_ts)})
+
+
+def queue_cancel_job(pipe, job_id: str):
+    pipe.zrem(JOBS_DUE_KEY, job_id)
+    pipe.hdel(JOBS_DATA_KEY, job_id)
+
+
+async def schedule_job(job_id: str, due_ts: int, payload: Dict[str, Any]):
+    r = await get_redis_client()
+    try:
+        pipe = r.pipeline(transaction=True)
+        queue_job(pipe, job_id, due_ts, payload)
+        await pipe.execute()
+    finally:
+        await r.aclose()
+
+
+async def cancel_job(job_id: str):
+    r = await get_redis_client()
+    try:
+        pipe = r.pipeline(transaction=True)
+        queue_cancel_job(pipe, job_id)
+        await pipe.execute()
+    finally:
+        await r.aclose()
+
+
+def _job_bot(main_bot: Bot, cafe_id: str) -> Bot:
+    bot = bot_registry.bot_for(cafe_id) if bot_registry is not None else None
+    return bot or main_bot
+
+
+async def _run_job(main_bot: Bot, job_id: str, raw: str):
+    try:
+        job = json.loads(raw) if raw else {}
+    except Exception:
+        job = {}
+    handler = JOB_HANDLERS.get(job.get("type"))
+    attempt = int(job.pop("attempt", 0) or 0)
+    bot = _job_bot(main_bot, job.get("cafe_id") or DEFAULT_CAFE_CODE)
+    if handler is None:
+        logger.error(f"job {job_id}: unknown type {job.get('type')!r}")
+    else:
+        profile = await tenants.get(job.get("cafe_id"))
+        with cafe_scope(profile):
+            try:
+                await handler(bot, job_id, job)
+                metrics.incr(f"jobs_{job['type']}")
+            except Exception as e:
+                metrics.incr("jobs_failed")
+                if attempt + 1 >= JOBS_MAX_ATTEMPTS:
+                    logger.error(f"job {job_id}: {e}, dropped after {JOBS_MAX_ATTEMPTS} attempts")
+                else:
+                    # не вышло перенести — задача останется в inflight и
+                    # вернётся в очередь по истечении аренды
+                    delay = JOBS_RETRY_SECONDS * 2 ** attempt
+                    logger.warning(f"job {job_id}: {e}, retry in {delay} s")
+                    await schedule_job(job_id, int(time.time()) + delay, {**job, "attempt": attempt + 1})
+
+    r = await get_redis_client()
+    try:
+        await lua_eval(r, JOBS_ACK_LUA, 3, JOBS_INFLIGHT_KEY, JOBS_DUE_KEY, JOBS_DATA_KEY, job_id)
+    finally:
+        await r.aclose()
+
+
+async def run_scheduler(bot: Bot):
+    while True:
+        try:
+            now_ts = int(time.time())
+            r = await get_redis_client()
+            try:
+                res = await lua_eval(
+                    r, JOBS_POP_LUA, 3, JOBS_DUE_KEY, JOBS_INFLIGHT_KEY, JOBS_DATA_KEY,
+                    now_ts, JOBS_BATCH, now_ts + JOBS_LEASE_SECONDS,
+                )
+            finally:
+                await r.aclose()
+            for i in range(0, len(res), 2):
+                await _run_job(bot, res[i], res[i + 1])
+            if len(res) == 2 * JOBS_BATCH:
+                continue  # очередь не разобрана — следующий тик сразу
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"scheduler: {e}")
+        await asyncio.sleep(JOBS_POLL_SECONDS)
+
+
+# ---------------- Orders export ----------------
+# Выгрузка заказов за период в CSV. Стрим читается страницами XRANGE с
+# курсором (id последней записи), так что память не зависит от размера
+# выгрузки. Владелец получает файл командой /export, тот же поток отдаёт
+# GET /export/orders.csv (chunked). HTTP-выгрузка включается EXPORT_SECRET:
+# токен — HMAC от кафе, периода и срока действия, передаётся только в
+# заголовке Authorization. Без EXPORT_SECRET эндпоинт отвечает 404.
+EXPORT_SECRET = os.getenv("EXPORT_SECRET", "")
+EXPORT_TOKEN_TTL = int(os.getenv("EXPORT_TOKEN_TTL", str(24 * 3600)))
+ORDERS_EXPORT_BATCH = int(os.getenv("ORDERS_EXPORT_BATCH", "1000"))
+ORDERS_EXPORT_DEFAULT_DAYS = 30
+ORDERS_CSV_HEADER = ["order", "created_at", "user_id", "username", "items", "total", "ready_at"]
+
+
+def _next_stream_id(entry_id: str) -> str:
+    ms, _, seq = entry_id.partition("-")
+    return f"{ms}-{int(seq or 0) + 1}"
+
+
+async def iter_orders(cafe_id: str, start_ts: int, end_ts: int, batch: int = ORDERS_EXPORT_BATCH):
+    stream_key = cafe_key(ORDERS_STREAM_KEY, cafe_id)
+    cursor = f"{start_ts * 1000}-0"
+    end_id = f"{end_ts * 1000 - 1}-18446744073709551615"
+    r = await get_redis_client()
+    try:
+        while True:
+            entries = await r.xrange(stream_key, min=cursor, max=end_id, count=batch)
+            for entry_id, fields in entries:
+                order = parse_order_entry(entry_id, fields)
+                # id записи, доигранной после более новых заказов, позже её ts
+                if start_ts <= order["ts"] < end_ts:
+                    yield order
+            if len(entries) < batch:
+                return
+            cursor = _next_stream_id(entries[-1][0])
+    finally:
+        await r.aclose()
+
+
+def _order_csv_row(order: Dict[str, Any]) -> list:
+    items = "; ".join(f"{it.get('name')} x{it.get('qty')} @{it.get('price')}" for it in order["items"])
+    created = datetime.fromtimestamp(order["ts"], MSK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    ready = datetime.fromtimestamp(order["ready_at"], MSK_TZ).strftime("%Y-%m-%d %H:%M:%S") if order["ready_at"] else ""
+    return [order["order"], created, order["user_id"], order["username"] or order["firstname"], items, order["total"], ready]
+
+
+async def iter_orders_csv(cafe_id: str, start_ts: int, end_ts: int):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(ORDERS_CSV_HEADER)
+    rows = 0
+    async for order in iter_orders(cafe_id, start_ts, end_ts):
+        writer.writerow(_order_csv_row(order))
+        rows += 1
+        if rows % ORDERS_EXPORT_BATCH == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def _parse_export_range(date_from: Optional[str], date_to: Optional[str]) -> Tuple[int, int]:
+    # даты включительно, по МСК; по умолчанию — последние 30 дней
+    today = get_moscow_time().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = datetime.strptime(date_from, "%Y-%m-%d").replace(tzinfo=MSK_TZ) if date_from else today - timedelta(days=ORDERS_EXPORT_DEFAULT_DAYS - 1)
+    end = datetime.strptime(date_to, "%Y-%m-%d").replace(tzinfo=MSK_TZ) if date_to else today
+    if end < start:
+        raise ValueError("date_to < date_from")
+    return int(start.timestamp()), int((end + timedelta(days=1)).timestamp())
+
+
+def _export_dates(start_ts: int, end_ts: int) -> Tuple[str, str]:
+    return (
+        datetime.fromtimestamp(start_ts, MSK_TZ).strftime("%Y-%m-%d"),
+        datetime.fromtimestamp(end_ts - 1, MSK_TZ).strftime("%Y-%m-%d"),
+    )
+
+
+def _export_signature(cafe_id: str, date_from: str, date_to: str, expires: int) -> str:
+    payload = f"export:{cafe_id}:{date_from}:{date_to}:{expires}"
+    return hmac.new(EXPORT_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def export_token(cafe_id: str, date_from: str, date_to: str, expires: int) -> str:
+    # <срок действия>.<подпись>: токен годится только для этого кафе и периода
+    return f"{expires}.{_export_signature(cafe_id, date_from, date_to, expires)}"
+
+
+def check_export_token(token: str, cafe_id: str, date_from: str, date_to: str) -> bool:
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _export_signature(cafe_id, date_from, date_to, int(expires)))
+
+
+async def send_orders_export(bot: Bot, chat_id: int, cafe_id: str, start_ts: int, end_ts: int):
+    date_from, date_to = _export_dates(start_ts, end_ts)
+    fd, path = tempfile.mkstemp(prefix="orders_", suffix=".csv")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in iter_orders_csv(cafe_id, start_ts, end_ts):
+                await asyncio.to_thread(f.write, chunk)
+        await bot.send_document(
+            chat_id,
+            FSInputFile(path, filename=f"orders_{cafe_id}_{date_from}_{date_to}.csv"),
+            caption=f"Заказы {date_from} — {date_to}",
+        )
+    except Exception as e:
+        logger.error(f"export {cafe_id}: {e}")
+        try:
+            await bot.send_message(chat_id, "⚠️ Не удалось выгрузить заказы.")
+        except Exception:
+            pass
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@router.message(Command("export"))
+async def export_cmd(message: Message):
+    profile = cafe()
+    if message.from_user.id not in (SUPERADMIN_ID, profile.admin_id):
+        return
+
+    parts = (message.text or "").split()
+    try:
+        start_ts, end_ts = _parse_export_range(parts[1] if len(parts) > 1 else None, parts[2] if len(parts) > 2 else None)
+    except Exception:
+        await message.answer("Формат: /export [YYYY-MM-DD] [YYYY-MM-DD]")
+        return
+
+    date_from, date_to = _export_dates(start_ts, end_ts)
+    # большая выгрузка не укладывается в бюджет апдейта: файл собирается и
+    # отправляется фоновой задачей
+    await message.answer(f"⏳ Готовлю выгрузку заказов {date_from} — {date_to}, пришлю файлом.")
+    spawn_background(send_orders_export(message.bot, message.chat.id, profile.cafe_id, start_ts, end_ts))
+
+    if not EXPORT_SECRET:
+        return
+    expires = int(time.time()) + EXPORT_TOKEN_TTL
+    url = f"https://{HOSTNAME}/export/orders.csv?cafe_id={profile.cafe_id}&from={date_from}&to={date_to}"
+    await message.answer(
+        f"Выгрузка по HTTP:\n<code>{html.quote(url)}</code>\n"
+        f"Заголовок: <code>Authorization: Bearer {export_token(profile.cafe_id, date_from, date_to, expires)}</code>\n"
+        f"Токен действует до {datetime.fromtimestamp(expires, MSK_TZ):%d.%m.%Y %H:%M} МСК и только для этого периода."
+    )
+
+
+async def export_orders_handler(request: web.Request):
+    if not EXPORT_SECRET:
+        raise web.HTTPNotFound()
+    cafe_id = request.query.get("cafe_id") or DEFAULT_CAFE_CODE
+    date_from, date_to = request.query.get("from"), request.query.get("to")
+    if not date_from or not date_to:
+        return web.Response(status=400, text="from/to must be YYYY-MM-DD")
+    try:
+        start_ts, end_ts = _parse_export_range(date_from, date_to)
+    except Exception:
+        return web.Response(status=400, text="from/to must be YYYY-MM-DD")
+
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    if not _CAFE_CODE_RE.match(cafe_id) or not check_export_token(token, cafe_id, *_export_dates(start_ts, end_ts)):
+        return web.Response(status=401, text="Unauthorized")
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="orders_{cafe_id}.csv"',
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    async for chunk in iter_orders_csv(cafe_id, start_ts, end_ts):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+# ---------------- Order analytics ----------------
+# Статистика считается не в _finalize_order, а консьюмером группы "analytics"
+# на стримах заказов кафе: агрегаты заказа и XACK пишутся одной транзакцией,
+# так что позиция группы и есть чекпоинт. Если поменялся
+# ANALYTICS_SCHEMA_VERSION, агрегаты кафе удаляются и группа перечитывает
+# стрим с начала (карточки клиентов при этом повторно не считаются).
+# С ANALYTICS_ENABLED=0 консьюмер не запускается, и _finalize_order пишет
+# агрегаты и карточку клиента сам (record_order_stats).
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "1") == "1"
+ANALYTICS_GROUP = "analytics"
+ANALYTICS_SCHEMA_VERSION = 1
+ANALYTICS_SCHEMA_KEY = "analytics:schema"
+ANALYTICS_REPLAY_UNTIL_KEY = "analytics:replay_until"
+ANALYTICS_REBUILD_LOCK_KEY = "analytics:rebuild_lock"
+ANALYTICS_AGGREGATES_PATTERN = "stats:*"
+ANALYTICS_BATCH = 100
+ANALYTICS_BLOCK_MS = 5000
+ANALYTICS_CLAIM_IDLE_MS = 60_000
+ANALYTICS_CAFES_REFRESH_SECONDS = 60
+
+
+def _stream_id_tuple(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def queue_order_aggregates(pipe, order: Dict[str, Any]):
+    created = datetime.fromtimestamp(order["ts"], MSK_TZ)
+    basket = 0
+    pipe.incr(cafe_key(STATS_TOTAL_ORDERS))
+    pipe.incrby(cafe_key(STATS_TOTAL_REVENUE), int(order["total"]))
+    for it in order["items"]:
+        qty = int(it.get("qty") or 0)
+        basket += qty
+        pipe.incrby(cafe_key(f"{STATS_ITEM_PREFIX}{it['id']}"), qty)
+        pipe.incrby(cafe_key(f"{STATS_ITEM_REV_PREFIX}{it['id']}"), qty * int(it.get("price") or 0))
+    pipe.hincrby(cafe_key(STATS_HOUR_KEY), str(created.hour), 1)
+    pipe.hincrby(cafe_key(STATS_WEEKDAY_KEY), str(created.weekday()), 1)
+    pipe.hincrby(cafe_key(STATS_BASKET_KEY), str(basket), 1)
+
+
+def queue_order_customer(pipe, order: Dict[str, Any]):
+    cart = {int(it["id"]): int(it.get("qty") or 0) for it in order["items"]}
+    queue_customer_order(
+        pipe, order["user_id"], order["firstname"], order["username"], cart, order["total"], order["ts"],
+    )
+
+
+async def record_order_stats(entry: Dict[str, str]):
+    order = parse_order_entry("", entry)
+    try:
+        r = await get_redis_client()
+        try:
+            pipe = r.pipeline(transaction=True)
+            queue_order_aggregates(pipe, order)
+            queue_order_customer(pipe, order)
+            await pipe.execute()
+        finally:
+            await r.aclose()
+    except Exception as e:
+        logger.error(f"order stats {order['order']}: {e}")
+
+
+class AnalyticsConsumer:
+    def __init__(self, name: str):
+        self.name = name
+        self._streams: Dict[str, str] = {}  # stream key -> cafe_id
+        self._replay_until: Dict[str, Tuple[int, int]] = {}
+        self._refreshed_at = 0.0
+
+    async def _ensure_group(self, r: redis.Redis, stream: str, start_id: str):
+        try:
+            await r.xgroup_create(stream, ANALYTICS_GROUP, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _rebuild(self, r: redis.Redis, cafe_id: str) -> bool:
+        lock_key = cafe_key(ANALYTICS_REBUILD_LOCK_KEY, cafe_id)
+        if not await r.set(lock_key, self.name, nx=True, ex=120):
+            return False  # пересчёт уже запустил другой воркер
+        stream = cafe_key(ORDERS_STREAM_KEY, cafe_id)
+        try:
+            last = await r.xrevrange(stream, count=1)
+            keys = [k async for k in r.scan_iter(match=cafe_key(ANALYTICS_AGGREGATES_PATTERN, cafe_id), count=500)]
+            # группа пересоздаётся в одной транзакции: иначе append_order мог бы
+            # успеть создать её на "$" между DESTROY и CREATE
+            await self._ensure_group(r, stream, "0")
+            pipe = r.pipeline(transaction=True)
+            if keys:
+                pipe.delete(*keys)
+            pipe.xgroup_destroy(stream, ANALYTICS_GROUP)
+            pipe.xgroup_create(stream, ANALYTICS_GROUP, id="0")
+            pipe.set(cafe_key(ANALYTICS_REPLAY_UNTIL_KEY, cafe_id), last[0][0] if last else "0-0")
+            pipe.set(cafe_key(ANALYTICS_SCHEMA_KEY, cafe_id), ANALYTICS_SCHEMA_VERSION)
+            await pipe.execute()
+            logger.info(f"analytics {cafe_id}: schema v{ANALYTICS_SCHEMA_VERSION}, dropped {len(keys)} keys, replaying")
+        finally:
+            await r.delete(lock_key)
+        return True
+
+    async def _prepare(self, r: redis.Redis, cafe_id: str, schema: Optional[str]) -> bool:
+        stream = cafe_key(ORDERS_STREAM_KEY, cafe_id)
+        if schema is None:
+            # группу новых стримов создаёт append_order до первого XADD; "$" —
+            # только для стримов, записанных до консьюмера: их заказы уже
+            # учтены старыми счётчиками
+            await self._ensure_group(r, stream, "$")
+            await r.set(cafe_key(ANALYTICS_SCHEMA_KEY, cafe_id), ANALYTICS_SCHEMA_VERSION)
+        elif int(schema) != ANALYTICS_SCHEMA_VERSION:
+            if not await self._rebuild(r, cafe_id):
+                return False
+        else:
+            await self._ensure_group(r, stream, "$")
+        self._streams[stream] = cafe_id
+        return True
+
+    async def _refresh(self, r: redis.Redis) -> bool:
+        # новые кафе, смена схемы и записи, зависшие у умерших консьюмеров
+        self._refreshed_at = time.monotonic()
+        cafe_ids = await tenants.known_ids()
+        schemas = await r.mget([cafe_key(ANALYTICS_SCHEMA_KEY, cafe_id) for cafe_id in cafe_ids])
+        known = set(self._streams.values())
+        for cafe_id, schema in zip(cafe_ids, schemas):
+            if cafe_id not in known or schema is None or int(schema) != ANALYTICS_SCHEMA_VERSION:
+                await self._prepare(r, cafe_id, schema)
+
+        claimed = False
+        for stream in self._streams:
+            _, entries, *_ = await r.xautoclaim(
+                stream, ANALYTICS_GROUP, self.name, ANALYTICS_CLAIM_IDLE_MS, start_id="0-0", count=ANALYTICS_BATCH,
+            )
+            claimed = claimed or bool(entries)
+        return claimed
+
+    async def _load_replay_marks(self, r: redis.Redis, streams: list):
+        cafe_ids = [self._streams[stream] for stream in streams]
+        marks = await r.mget([cafe_key(ANALYTICS_REPLAY_UNTIL_KEY, cafe_id) for cafe_id in cafe_ids])
+        for cafe_id, mark in zip(cafe_ids, marks):
+            self._replay_until[cafe_id] = _stream_id_tuple(mark) if mark else (0, 0)
+
+    async def _apply(self, r: redis.Redis, stream: str, entry_id: str, fields: Optional[Dict[str, str]]):
+        cafe_id = self._streams[stream]
+        if not fields:
+            await r.xack(stream, ANALYTICS_GROUP, entry_id)  # запись обрезана MAXLEN
+            return
+
+        order = parse_order_entry(entry_id, fields)
+        profile = await tenants.get(cafe_id)
+        with cafe_scope(profile):
+            pipe = r.pipeline(transaction=True)
+            queue_order_aggregates(pipe, order)
+            if order["user_id"] and _stream_id_tuple(entry_id) > self._replay_until.get(cafe_id, (0, 0)):
+                queue_order_customer(pipe, order)
+            pipe.xack(stream, ANALYTICS_GROUP, entry_id)
+            await pipe.execute()
+
+    async def run(self):
+        # сначала дочитываем свои неподтверждённые записи (id "0"), потом новые (">")
+        pending = True
+        while True:
+            try:
+                r = await get_redis_client()
+                try:
+                    if not self._streams or time.monotonic() - self._refreshed_at > ANALYTICS_CAFES_REFRESH_SECONDS:
+                        pending = await self._refresh(r) or pending
+                    if not self._streams:
+                        await asyncio.sleep(ANALYTICS_BLOCK_MS / 1000)
+                        continue
+
+                    resp = await r.xreadgroup(
+                        ANALYTICS_GROUP,
+                        self.name,
+                        {stream: "0" if pending else ">" for stream in self._streams},
+                        count=ANALYTICS_BATCH,
+                        block=None if pending else ANALYTICS_BLOCK_MS,
+                    )
+                    got = 0
+                    if resp:
+                        await self._load_replay_marks(r, [stream for stream, _ in resp])
+                    for stream, entries in resp or []:
+                        for entry_id, fields in entries:
+                            await self._apply(r, stream, entry_id, fields)
+                            got += 1
+                    if pending and not got:
+                        pending = False
+                finally:
+                    await r.aclose()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if "NOGROUP" in str(e):
+                    # группу пересоздал пересчёт в другом воркере
+                    self._streams.clear()
+                    pending = True
+                logger.error(f"analytics consumer {self.name}: {e}")
+                await asyncio.sleep(1)
+
+
+@router.message(Command("analytics_rebuild"))
+async def analytics_rebuild_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+    try:
+        r = await get_redis_client()
+        await r.set(cafe_key(ANALYTICS_SCHEMA_KEY), 0)
+        await r.aclose()
+    except Exception as e:
+        await message.answer(f"Redis error: {html.quote(str(e))}")
+        return
+    await message.answer(
+        f"✅ Статистика кафе <code>{html.quote(cafe().cafe_id)}</code> будет пересчитана "
+        f"из журнала заказов в течение {ANALYTICS_CAFES_REFRESH_SECONDS} с."
+    )
+
+
 # ---------------- Checkout ----------------
-@router.message(F.text == BTN_CHECKOUT)
+@buttons.button(BTN_CHECKOUT)
 async def checkout(message: Message, state: FSMContext):
     if not is_cafe_open():
-        await message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
-        return
+        return message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
 
     cart = _get_cart(await state.get_data())
     if not cart:
@@ -1508,62 +3542,46 @@ async def _finalize_order(message: Message, state: FSMContext, ready_in_min: int
         await message.answer("Корзина пустая.", reply_markup=create_client_menu_keyboard())
         return
 
-    try:
-        r = await get_redis_client()
-        last_order = await r.get(_rate_limit_key(user_id))
-        if last_order and time.time() - float(last_order) < RATE_LIMIT_SECONDS:
-            await r.aclose()
-            await state.clear()
-            await message.answer(
-                f"⏳ Подождите {RATE_LIMIT_SECONDS} секунд между заказами.",
-                reply_markup=create_client_menu_keyboard(),
-            )
-            return
-        await r.setex(_rate_limit_key(user_id), RATE_LIMIT_SECONDS, str(time.time()))
-        await r.aclose()
-    except Exception:
-        pass
+    if not is_cafe_open():
+        await state.clear()
+        await message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
+        return
+
+    if await rate_limit_hit(message, "order"):
+        return
 
     total = _cart_total(cart)
-    order_num = str(int(time.time()))[-6:]
+    order_num = await next_order_number()
     ready_at_str = (get_moscow_time() + timedelta(minutes=max(0, ready_in_min))).strftime("%H:%M")
     ready_line = "как можно скорее" if ready_in_min <= 0 else f"через {ready_in_min} мин (к {ready_at_str} МСК)"
 
-    await set_last_order_snapshot(user_id, {"cart": cart, "total": total, "ts": int(time.time())})
-
-    try:
-        r = await get_redis_client()
-        await r.incr(STATS_TOTAL_ORDERS)
-        await r.incrby(STATS_TOTAL_REVENUE, int(total))
-        for drink, qty in cart.items():
-            qty_i = int(qty)
-            price = int(MENU.get(drink, 0))
-            await r.incrby(f"{STATS_DRINK_PREFIX}{drink}", qty_i)
-            await r.incrby(f"{STATS_DRINK_REV_PREFIX}{drink}", qty_i * price)
-        await r.aclose()
-    except Exception:
-        pass
+    await set_last_order_snapshot(user_id, {"cart": _dump_cart(cart), "total": total, "ts": int(time.time())})
+    entry = build_order_entry(
+        order_num, user_id, message.from_user.first_name or "", message.from_user.username or "", cart, total, ready_in_min,
+    )
+    spawn_background(append_order(entry))
+    if not ANALYTICS_ENABLED:
+        spawn_background(record_order_stats(entry))
 
     admin_msg = (
-        f"🔔 <b>НОВЫЙ ЗАКАЗ #{order_num}</b> | {html.quote(CAFE_NAME)}\n\n"
+        f"🔔 <b>НОВЫЙ ЗАКАЗ #{order_num}</b> | {html.quote(cafe().name)}\n\n"
         f"<a href=\"tg://user?id={user_id}\">{html.quote(message.from_user.username or message.from_user.first_name or 'Клиент')}</a>\n"
         f"<code>{user_id}</code>\n\n"
         + "\n".join(_cart_lines(cart))
         + f"\n\n💰 Итого: <b>{total}₽</b>\n⏱ Готовность: <b>{html.quote(ready_line)}</b>"
     )
 
-    if DEMO_MODE:
-        await send_admin_demo_to_user(message.bot, user_id, admin_msg)
-    else:
-        await send_admin_only(message.bot, admin_msg)
-
     finish = random.choice(FINISH_VARIANTS).format(name=html.quote(get_user_name(message)))
 
     await state.clear()
-    await message.answer(
-        f"🎉 <b>Заказ принят!</b>\n\n{_cart_text(cart)}\n\n⏱ Готовность: {html.quote(ready_line)}\n\n{finish}",
-        reply_markup=create_client_menu_keyboard(),
-    )
+    await fan_out("order notify", [
+        (user_id, send_admin_demo_to_user(message.bot, user_id, admin_msg)) if DEMO_MODE
+        else (cafe().admin_id, send_admin_only(message.bot, admin_msg, user_id, "order")),
+        (user_id, message.answer(
+            f"🎉 <b>Заказ принят!</b>\n\n{_cart_text(cart)}\n\n⏱ Готовность: {html.quote(ready_line)}\n\n{finish}",
+            reply_markup=create_client_menu_keyboard(),
+        )),
+    ])
 
 
 @router.message(StateFilter(OrderStates.waiting_for_ready_time))
@@ -1583,21 +3601,367 @@ async def ready_time(message: Message, state: FSMContext):
     await message.answer("Выберите кнопкой.", reply_markup=create_ready_time_keyboard())
 
 
-# ---------------- Booking ----------------
-@router.message(F.text == BTN_BOOKING)
-async def booking_start(message: Message, state: FSMContext):
-    await state.clear()
-    if not is_cafe_open():
-        await message.answer(get_closed_message(), reply_markup=create_start_keyboard())
-        return
-
-    await state.set_state(BookingStates.waiting_for_datetime)
+# ---------------- Booking store ----------------
+# Брони лежат в Redis: hash booking:<id>, индекс bookings:by_time (zset по
+# времени начала) и счётчики занятости bookings:slot:<ts> на каждый
+# 30-минутный слот. Бронь занимает BOOKING_DURATION_MINUTES подряд идущих
+# слотов; проверка вместимости и запись делаются одним Lua-скриптом, он же
+# сбрасывает кэш сетки слотов дня (bookings:grid:<YYYYMMDD>).
+BOOKING_RESERVE_LUA = """
+local cap = tonumber(ARGV[1])
+for i = 4, #KEYS do
+  if tonumber(redis.call('GET', KEYS[i]) or '0') >= cap then
+    return 0
+  end
+end
+redis.call('DEL', KEYS[3])
+for i = 4, #KEYS do
+  redis.call('INCR', KEYS[i])
+  redis.call('EXPIREAT', KEYS[i], ARGV[4])
+end
+redis.call('HSET', KEYS[2], unpack(ARGV, 6))
+redis.call('EXPIREAT', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[5])
+return 1
+"""
+
+BOOKING_CANCEL_LUA = """
+if redis.call('HGET', KEYS[2], 'status') ~= 'active' then
+  return 0
+end
+redis.call('DEL', KEYS[3])
+for i = 4, #KEYS do
+  if tonumber(redis.call('GET', KEYS[i]) or '0') > 0 then
+    redis.call('DECR', KEYS[i])
+  end
+end
+redis.call('HSET', KEYS[2], 'status', 'cancelled')
+redis.call('ZREM', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def _booking_key(booking_id: str) -> str:
+    return cafe_key(f"{BOOKING_KEY_PREFIX}{booking_id}")
+
+
+def booking_slots(start_ts: int) -> list:
+    step = BOOKING_SLOT_MINUTES * 60
+    first = start_ts - start_ts % step
+    return list(range(first, start_ts + BOOKING_DURATION_MINUTES * 60, step))
+
+
+def _slot_keys(slots: list) -> list:
+    return [cafe_key(f"{BOOKING_SLOT_PREFIX}{ts}") for ts in slots]
+
+
+def _grid_key(ts: int) -> str:
+    return cafe_key(f"{BOOKING_GRID_PREFIX}{datetime.fromtimestamp(ts, MSK_TZ):%Y%m%d}")
+
+
+async def slots_occupancy(slots: list) -> Dict[int, int]:
+    if not slots:
+        return {}
+    try:
+        r = await get_redis_client()
+        values = await r.mget(_slot_keys(slots))
+        await r.aclose()
+    except Exception:
+        values = [None] * len(slots)
+    return {ts: int(v or 0) for ts, v in zip(slots, values)}
+
+
+async def is_booking_available(start_ts: int) -> bool:
+    occupancy = await slots_occupancy(booking_slots(start_ts))
+    return all(v < cafe().booking_tables for v in occupancy.values())
+
+
+async def create_booking(user_id: int, name: str, start_ts: int, people: int, comment: str) -> Optional[str]:
+    # None — в один из слотов брони уже нет мест
+    slots = booking_slots(start_ts)
+    now_ts = int(time.time())
+    r = await get_redis_client()
+    try:
+        booking_id = str(await r.incr(cafe_key(BOOKING_SEQ_KEY)))
+        fields = {
+            "id": booking_id,
+            "user_id": str(user_id),
+            "name": name or "",
+            "start_ts": str(start_ts),
+            "people": str(people),
+            "comment": comment or "",
+            "slots": ",".join(str(ts) for ts in slots),
+            "status": "active",
+            "created_ts": str(now_ts),
+        }
+        args = [
+            cafe().booking_tables,
+            booking_id,
+            start_ts,
+            start_ts + BOOKING_HISTORY_DAYS * 86400,
+            now_ts - BOOKING_HISTORY_DAYS * 86400,
+        ]
+        for k, v in fields.items():
+            args.extend((k, v))
+        ok = await lua_eval(
+            r,
+            BOOKING_RESERVE_LUA,
+            3 + len(slots),
+            cafe_key(BOOKINGS_BY_TIME_KEY),
+            _booking_key(booking_id),
+            _grid_key(start_ts),
+            *_slot_keys(slots),
+            *args,
+        )
+        remind_ts = start_ts - BOOKING_REMIND_MINUTES * 60
+        if ok and remind_ts > now_ts:
+            pipe = r.pipeline(transaction=True)
+            queue_job(
+                pipe,
+                job_id_for("booking_reminder", cafe().cafe_id, booking_id),
+                remind_ts,
+                {"type": "booking_reminder", "cafe_id": cafe().cafe_id, "booking_id": booking_id},
+            )
+            await pipe.execute()
+    finally:
+        await r.aclose()
+    return booking_id if ok else None
+
+
+async def get_booking(booking_id: str) -> Dict[str, str]:
+    try:
+        r = await get_redis_client()
+        data = await r.hgetall(_booking_key(booking_id))
+        await r.aclose()
+        return data
+    except Exception:
+        return {}
+
+
+async def cancel_booking(booking_id: str) -> bool:
+    booking = await get_booking(booking_id)
+    if not booking:
+        return False
+    slots = [int(ts) for ts in (booking.get("slots") or "").split(",") if ts]
+    r = await get_redis_client()
+    try:
+        ok = await lua_eval(
+            r,
+            BOOKING_CANCEL_LUA,
+            3 + len(slots),
+            cafe_key(BOOKINGS_BY_TIME_KEY),
+            _booking_key(booking_id),
+            _grid_key(int(booking.get("start_ts") or 0)),
+            *_slot_keys(slots),
+            booking_id,
+        )
+        if ok:
+            pipe = r.pipeline(transaction=True)
+            queue_cancel_job(pipe, job_id_for("booking_reminder", cafe().cafe_id, booking_id))
+            await pipe.execute()
+    finally:
+        await r.aclose()
+    return bool(ok)
+
+
+@job_handler("booking_reminder")
+async def booking_reminder_job(bot: Bot, job_id: str, job: Dict[str, Any]):
+    booking = await get_booking(str(job.get("booking_id", "")))
+    if booking.get("status") != "active":
+        return
+    start = datetime.fromtimestamp(int(booking.get("start_ts") or 0), MSK_TZ)
+    try:
+        await bot.send_message(
+            int(booking["user_id"]),
+            "⏰ <b>Напоминаем о брони</b>\n\n"
+            f"{html.quote(cafe().name)}, <b>{start:%d.%m в %H:%M}</b>, "
+            f"{html.quote(booking.get('people', ''))} чел.{_address_line()}\n\n"
+            f"Если планы изменились, позвоните нам: <code>{html.quote(cafe().phone)}</code>",
+        )
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.error(f"booking reminder {booking.get('id')}: {e}")
+
+
+async def upcoming_bookings(limit: int = 20) -> list:
+    now_ts = int(time.time())
+    r = await get_redis_client()
+    try:
+        ids = await r.zrangebyscore(
+            cafe_key(BOOKINGS_BY_TIME_KEY), now_ts - BOOKING_DURATION_MINUTES * 60, "+inf", start=0, num=limit,
+        )
+        pipe = r.pipeline(transaction=False)
+        for booking_id in ids:
+            pipe.hgetall(_booking_key(booking_id))
+        bookings = await pipe.execute() if ids else []
+    finally:
+        await r.aclose()
+    return [b for b in bookings if b and b.get("status") == "active"]
+
+
+def _booking_line(booking: Dict[str, str]) -> str:
+    start = datetime.fromtimestamp(int(booking.get("start_ts") or 0), MSK_TZ)
+    comment = booking.get("comment") or "-"
+    return (
+        f"#{html.quote(booking.get('id', ''))} — <b>{start:%d.%m %H:%M}</b>, "
+        f"{html.quote(booking.get('people', ''))} чел., "
+        f"<a href=\"tg://user?id={html.quote(booking.get('user_id', ''))}\">{html.quote(booking.get('name') or 'гость')}</a>"
+        + (f" — {html.quote(comment)}" if comment != "-" else "")
+    )
+
+
+@router.message(Command("bookings"))
+async def bookings_cmd(message: Message):
+    if message.from_user.id not in (SUPERADMIN_ID, cafe().admin_id):
+        return
+    try:
+        bookings = await upcoming_bookings()
+    except Exception as e:
+        await message.answer(f"Redis error: {html.quote(str(e))}")
+        return
+    if not bookings:
+        await message.answer("📅 Ближайших броней нет.")
+        return
     await message.answer(
-        "📅 Введите дату и время в формате <code>15.02 19:00</code>.",
-        reply_markup=create_booking_cancel_keyboard(),
+        "📅 <b>Ближайшие брони</b>\n\n" + "\n".join(_booking_line(b) for b in bookings)
+        + "\n\nОтменить: <code>/cancel_booking &lt;id&gt;</code>"
     )
 
 
+@router.message(Command("cancel_booking"))
+async def cancel_booking_cmd(message: Message):
+    if message.from_user.id not in (SUPERADMIN_ID, cafe().admin_id):
+        return
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Формат: /cancel_booking <id>")
+        return
+    try:
+        ok = await cancel_booking(parts[1])
+    except Exception as e:
+        await message.answer(f"Redis error: {html.quote(str(e))}")
+        return
+    await message.answer(f"✅ Бронь #{parts[1]} отменена." if ok else "Бронь не найдена или уже отменена.")
+
+
+# ---------------- Booking slot picker ----------------
+# Вместо ввода «15.02 19:00» гость выбирает день и свободное время кнопками.
+# Сетка дня (время начала -> сколько столов свободно) строится по часам работы
+# и счётчикам слотов и кэшируется в Redis; брони и отмены её сбрасывают.
+WEEKDAY_SHORT = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+def _day_start(day: str) -> Optional[datetime]:
+    try:
+        return datetime.strptime(day, "%Y%m%d").replace(tzinfo=MSK_TZ)
+    except Exception:
+        return None
+
+
+def _picked_day(action: str, value: str) -> Optional[datetime]:
+    # bk:d:<YYYYMMDD> — день, bk:s:<ts> — начало слота
+    if action == "d":
+        return _day_start(value)
+    try:
+        return datetime.fromtimestamp(int(value), MSK_TZ)
+    except Exception:
+        return None
+
+
+def is_bookable_day(day: datetime) -> bool:
+    # те же дни, что на клавиатуре: сегодня .. сегодня + BOOKING_DAYS_AHEAD - 1
+    return 0 <= (day.date() - get_moscow_time().date()).days < BOOKING_DAYS_AHEAD
+
+
+def day_start_times(day: datetime) -> list:
+    c = cafe()
+    work_end = c.work_end if c.work_end > c.work_start else c.work_end + 24
+    first = int((day + timedelta(hours=c.work_start)).timestamp())
+    last = int((day + timedelta(hours=work_end)).timestamp()) - BOOKING_DURATION_MINUTES * 60
+    return list(range(first, last + 1, BOOKING_SLOT_MINUTES * 60))
+
+
+async def day_slot_grid(day: datetime) -> list:
+    c = cafe()
+    key = _grid_key(int(day.timestamp()))
+    try:
+        r = await get_redis_client()
+        cached = await r.get(key)
+        await r.aclose()
+        grid = json.loads(cached) if cached else None
+        if grid and grid.get("hours") == [c.work_start, c.work_end] and grid.get("tables") == c.booking_tables:
+            return grid["slots"]
+    except Exception:
+        pass
+
+    starts = day_start_times(day)
+    occupancy = await slots_occupancy(sorted({ts for start in starts for ts in booking_slots(start)}))
+    slots = [
+        [start, c.booking_tables - max(occupancy.get(ts, 0) for ts in booking_slots(start))]
+        for start in starts
+    ]
+    try:
+        r = await get_redis_client()
+        await r.set(
+            key,
+            json.dumps({"hours": [c.work_start, c.work_end], "tables": c.booking_tables, "slots": slots}),
+            ex=BOOKING_GRID_TTL,
+        )
+        await r.aclose()
+    except Exception:
+        pass
+    return slots
+
+
+def create_booking_days_keyboard() -> InlineKeyboardMarkup:
+    today = get_moscow_time().replace(hour=0, minute=0, second=0, microsecond=0)
+    rows: list[list[InlineKeyboardButton]] = []
+    row: list[InlineKeyboardButton] = []
+    for i in range(BOOKING_DAYS_AHEAD):
+        day = today + timedelta(days=i)
+        label = "Сегодня" if i == 0 else "Завтра" if i == 1 else f"{WEEKDAY_SHORT[day.weekday()]} {day:%d.%m}"
+        row.append(InlineKeyboardButton(text=label, callback_data=f"bk:d:{day:%Y%m%d}"))
+        if len(row) == 3:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+    rows.append([InlineKeyboardButton(text=BTN_CANCEL, callback_data="bk:cancel")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def create_booking_slots_keyboard(day: datetime) -> Optional[InlineKeyboardMarkup]:
+    earliest = int(time.time()) + BOOKING_LEAD_MINUTES * 60
+    free = [start for start, left in await day_slot_grid(day) if left > 0 and start >= earliest]
+    if not free:
+        return None
+    rows: list[list[InlineKeyboardButton]] = []
+    for i in range(0, len(free), 4):
+        rows.append([
+            InlineKeyboardButton(text=f"{datetime.fromtimestamp(ts, MSK_TZ):%H:%M}", callback_data=f"bk:s:{ts}")
+            for ts in free[i:i + 4]
+        ])
+    rows.append([
+        InlineKeyboardButton(text="« Другой день", callback_data="bk:days"),
+        InlineKeyboardButton(text=BTN_CANCEL, callback_data="bk:cancel"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def _ask_booking_day(message: Message, state: FSMContext, text: str = "📅 Выберите день:"):
+    await state.set_state(BookingStates.waiting_for_datetime)
+    await message.answer(text, reply_markup=create_booking_days_keyboard())
+
+
+# ---------------- Booking ----------------
+@buttons.button(BTN_BOOKING)
+async def booking_start(message: Message, state: FSMContext):
+    if await rate_limit_hit(message, "booking"):
+        return
+    await state.clear()
+    await _ask_booking_day(message, state)
+
+
 @router.message(StateFilter(BookingStates.waiting_for_datetime))
 async def booking_datetime(message: Message, state: FSMContext):
     if message.text == BTN_CANCEL:
@@ -1605,22 +3969,73 @@ async def booking_datetime(message: Message, state: FSMContext):
         await message.answer("Ок, бронирование отменено.", reply_markup=create_start_keyboard())
         return
 
-    m = re.match(r"(\d{1,2})\.(\d{1,2})\s+(\d{1,2}):(\d{2})", message.text or "")
-    if not m:
-        await message.answer("Формат: <code>15.02 19:00</code>.", reply_markup=create_booking_cancel_keyboard())
+    await message.answer("Выберите день и время кнопками:", reply_markup=create_booking_days_keyboard())
+
+
+@router.callback_query(F.data.startswith("bk:"))
+async def booking_picker(callback: CallbackQuery, state: FSMContext):
+    if await state.get_state() != BookingStates.waiting_for_datetime.state:
+        await callback.answer("Начните бронирование заново.", show_alert=True)
+        return
+
+    _, action, *rest = (callback.data or "").split(":")
+    value = rest[0] if rest else ""
+
+    if action == "cancel":
+        await state.clear()
+        await callback.answer()
+        await callback.message.edit_text("Ок, бронирование отменено.")
+        await callback.message.answer("Главное меню:", reply_markup=create_start_keyboard())
         return
 
-    day, month, hour, minute = map(int, m.groups())
-    year = get_moscow_time().year
-    try:
-        dt = datetime(year, month, day, hour, minute, tzinfo=MSK_TZ)
-    except Exception:
-        await message.answer("Не удалось разобрать дату/время.", reply_markup=create_booking_cancel_keyboard())
+    if action == "days":
+        await callback.answer()
+        await callback.message.edit_text("📅 Выберите день:", reply_markup=create_booking_days_keyboard())
+        return
+
+    if action in ("d", "s") and await rate_limit_hit(callback, "booking"):
+        return
+
+    if action in ("d", "s"):
+        # callback_data приходит от клиента: день может быть подделан или
+        # устареть, если клавиатуру открыли вчера
+        day = _picked_day(action, value)
+        if day is None or not is_bookable_day(day):
+            await callback.answer("Этот день недоступен, выберите другой.", show_alert=True)
+            await callback.message.edit_text("📅 Выберите день:", reply_markup=create_booking_days_keyboard())
+            return
+
+    if action == "d":
+        keyboard = await create_booking_slots_keyboard(day)
+        if keyboard is None:
+            await callback.answer("На этот день свободного времени нет.", show_alert=True)
+            return
+        await callback.answer()
+        await callback.message.edit_text(f"🕐 Свободное время на <b>{day:%d.%m}</b>:", reply_markup=keyboard)
         return
 
-    await state.update_data(booking_dt=dt.strftime("%d.%m %H:%M"))
-    await state.set_state(BookingStates.waiting_for_people)
-    await message.answer("На сколько человек? (1–10)", reply_markup=create_booking_people_keyboard())
+    if action == "s":
+        start_ts = int(value)
+        dt = datetime.fromtimestamp(start_ts, MSK_TZ)
+        valid = (
+            start_ts >= int(time.time()) + BOOKING_LEAD_MINUTES * 60
+            and start_ts in day_start_times(dt.replace(hour=0, minute=0, second=0, microsecond=0))
+        )
+        if not valid or not await is_booking_available(start_ts):
+            keyboard = await create_booking_slots_keyboard(dt.replace(hour=0, minute=0, second=0, microsecond=0))
+            await callback.answer("Это время уже занято, выберите другое.", show_alert=True)
+            if keyboard is not None:
+                await callback.message.edit_reply_markup(reply_markup=keyboard)
+            return
+
+        await state.update_data(booking_dt=dt.strftime("%d.%m %H:%M"), booking_ts=start_ts)
+        await state.set_state(BookingStates.waiting_for_people)
+        await callback.answer()
+        await callback.message.edit_text(f"📅 Бронь на <b>{dt:%d.%m %H:%M}</b>")
+        await callback.message.answer("На сколько человек? (1–10)", reply_markup=create_booking_people_keyboard())
+        return
+
+    await callback.answer()
 
 
 @router.message(StateFilter(BookingStates.waiting_for_people))
@@ -1652,16 +4067,31 @@ async def booking_finish(message: Message, state: FSMContext):
 
     data = await state.get_data()
     dt_str = str(data.get("booking_dt") or "")
+    booking_ts = int(data.get("booking_ts") or 0)
     people = int(data.get("booking_people") or 0)
     comment = (message.text or "").strip() or "-"
-
-    booking_id = str(int(time.time()))[-6:]
     user_id = message.from_user.id
 
-    await message.answer("✅ Бронь отправлена админу.", reply_markup=create_start_keyboard())
+    if not booking_ts:
+        await _ask_booking_day(message, state, "Выберите день и время ещё раз:")
+        return
+
+    try:
+        booking_id = await create_booking(
+            user_id, message.from_user.username or message.from_user.first_name or "", booking_ts, people, comment,
+        )
+    except Exception as e:
+        logger.error(f"create_booking: {e}")
+        await state.clear()
+        await message.answer("⚠️ Не удалось сохранить бронь, попробуйте позже.", reply_markup=create_start_keyboard())
+        return
+
+    if booking_id is None:
+        await _ask_booking_day(message, state, "😔 Пока вы заполняли бронь, это время заняли. Выберите другое:")
+        return
 
     admin_msg = (
-        f"📅 <b>НОВАЯ БРОНЬ #{booking_id}</b> | {html.quote(CAFE_NAME)}\n\n"
+        f"📅 <b>НОВАЯ БРОНЬ #{booking_id}</b> | {html.quote(cafe().name)}\n\n"
         f"<a href=\"tg://user?id={user_id}\">{html.quote(message.from_user.username or message.from_user.first_name or 'Клиент')}</a>\n"
         f"<code>{user_id}</code>\n\n"
         f"🕐 Время: <b>{html.quote(dt_str)}</b>\n"
@@ -1669,70 +4099,12 @@ async def booking_finish(message: Message, state: FSMContext):
         f"💬 Комментарий: {html.quote(comment)}"
     )
 
-    if DEMO_MODE:
-        await send_admin_demo_to_user(message.bot, user_id, admin_msg)
-    else:
-        await send_admin_only(message.bot, admin_msg)
-
     await state.clear()
-
-
-@router.message(F.from_user.id == ADMIN_ID)
-async def admin_reply_debug(message: Message):
-    logger.info(f"🔍 ADMIN DEBUG: text='{message.text[:50]}' has_reply={message.reply_to_message is not None}")
-    
-    if message.reply_to_message:
-        logger.info(f"🔍 REPLIED: bot={message.reply_to_message.from_user.is_bot} text='{message.reply_to_message.text[:100]}'")
-        if "Новая оплата" in (message.reply_to_message.text or ""):
-            logger.info("🔍 PAYMENT NOTIFICATION FOUND!")
-    
-    await message.answer("DEBUG: получил reply")  # ← ТОСТ для теста
-
-
-@router.message(F.from_user.id == ADMIN_ID)
-async def admin_reply_to_client(message: Message):
-    logger.info(f"ADMIN REPLY DEBUG: has_reply={message.reply_to_message is not None}")
-    
-    # 1. Проверяем reply на сообщение БОТА
-    if not message.reply_to_message:
-        logger.info("No reply_to_message")
-        return
-    
-    if not message.reply_to_message.from_user.is_bot:
-        logger.info("Reply not to bot")
-        return
-    
-    # 2. Проверяем уведомление об оплате
-    replied_text = message.reply_to_message.text or ""
-    logger.info(f"Replied text preview: {replied_text[:100]}")
-    
-    if "Новая оплата" not in replied_text and "CafebotifySTART" not in replied_text:
-        logger.info("Not payment notification")
-        return
-    
-    # 3. Извлекаем tgid КЛИЕНТА из текста уведомления
-    import re
-    tgid_match = re.search(r"<code>(\d+)</code>", replied_text)
-    if not tgid_match:
-        logger.error("No tgid in notification")
-        await message.answer("❌ Не найден ID клиента")
-        return
-    
-    client_id = int(tgid_match.group(1))
-    logger.info(f"Found client_id: {client_id}")
-    
-    # 4. ОТПРАВЛЯЕМ КЛИЕНТУ ОТ БОТА
-    try:
-        await message.bot.send_message(
-            client_id,
-            f"💬 <b>Ответ от поддержки Cafebotify:</b>\n\n{html.quote(message.text or '')}",
-            parse_mode="HTML"
-        )
-        await message.answer(f"✅ Отправлено клиенту <code>{client_id}</code>")
-        logger.info(f"Message sent to client {client_id}")
-    except Exception as e:
-        logger.error(f"Send error: {e}")
-        await message.answer("❌ Ошибка отправки")
+    await fan_out("booking notify", [
+        (user_id, message.answer(f"✅ Бронь #{booking_id} принята и отправлена админу.", reply_markup=create_start_keyboard())),
+        (user_id, send_admin_demo_to_user(message.bot, user_id, admin_msg)) if DEMO_MODE
+        else (cafe().admin_id, send_admin_only(message.bot, admin_msg, user_id, "booking")),
+    ])
 
 
 # ---------------- Cafebotify subscriptions helpers ----------------
@@ -1745,215 +4117,377 @@ def _in_send_window_msk() -> bool:
     return RETURN_SEND_FROM_HOUR <= h < RETURN_SEND_TO_HOUR
 
 
-async def _get_favorite_drink(user_id: int) -> str:
-    key = f"{CUSTOMER_DRINKS_PREFIX}{user_id}"
+async def _get_favorite_drinks(user_id: int, k: int = 3) -> list:
     try:
         r = await get_redis_client()
-        data = await r.hgetall(key)
+        ids = await r.zrevrange(cafe_key(f"{CUSTOMER_TOP_PREFIX}{user_id}"), 0, k - 1)
         await r.aclose()
-        best_name, best_cnt = "", -1
-        for k, v in data.items():
-            try:
-                cnt = int(v)
-                if cnt > best_cnt:
-                    best_cnt = cnt
-                    best_name = str(k)
-            except Exception:
-                continue
-        return best_name
     except Exception:
-        return ""
+        return []
+    return [cafe().menu.name(int(i)) for i in ids if str(i).isdigit()]
 
 
-async def customer_mark_order(user_id: int, firstname: str, username: str, cart: Dict[str, int], total_sum: int):
-    now_ts = int(time.time())
-    customer_key = f"{CUSTOMER_KEY_PREFIX}{user_id}"
-    drinks_key = f"{CUSTOMER_DRINKS_PREFIX}{user_id}"
-    last_drink = next(iter(cart.keys()), "")
+async def _get_favorite_drink(user_id: int) -> str:
+    top = await _get_favorite_drinks(user_id, 1)
+    return top[0] if top else ""
+
+
+def queue_customer_order(pipe, user_id: int, firstname: str, username: str, cart: Dict[int, int], total_sum: int, now_ts: int):
+    customer_key = cafe_key(f"{CUSTOMER_KEY_PREFIX}{user_id}")
+    top_key = cafe_key(f"{CUSTOMER_TOP_PREFIX}{user_id}")
+    last_drink = str(next(iter(cart.keys()), ""))
+
+    pipe.sadd(cafe_key(CUSTOMERS_SET_KEY), user_id)
+    pipe.hsetnx(customer_key, "first_order_ts", now_ts)
+    pipe.hsetnx(customer_key, "offers_opt_out", 0)
+    pipe.hsetnx(customer_key, "last_trigger_ts", 0)
+    pipe.hset(
+        customer_key,
+        mapping={
+            "firstname": firstname or "",
+            "username": username or "",
+            "last_order_ts": now_ts,
+            "last_order_sum": int(total_sum),
+            "last_drink": last_drink,
+        },
+    )
+    pipe.hincrby(customer_key, "total_orders", 1)
+    pipe.hincrby(customer_key, "total_spent", int(total_sum))
+    for item_id, qty in cart.items():
+        pipe.zincrby(top_key, int(qty), str(item_id))
+    queue_rfm_update(pipe, user_id)
+
+
+# ---------------- Customer RFM ----------------
+# Recency/frequency/monetary каждого клиента лежат в отсортированных множествах
+# и обновляются скриптом сразу после записи заказа в карточку клиента (в той же
+# транзакции). Баллы 1..5 считаются по рангу в индексе, сегменты — выборками
+# по диапазону score, без перебора всех клиентов. Тот же скрипт переносит
+# задачу return_offer клиента на новый срок: lapse_due для клиентов с ритмом,
+# last_order_ts + цикл кафе для остальных.
+RFM_UPDATE_LUA = """
+local first = tonumber(redis.call('HGET', KEYS[1], 'first_order_ts') or '0') or 0
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_order_ts') or '0') or 0
+local orders = tonumber(redis.call('HGET', KEYS[1], 'total_orders') or '0') or 0
+local spent = tonumber(redis.call('HGET', KEYS[1], 'total_spent') or '0') or 0
+if orders == 0 then
+  return 0
+end
+local due = last + tonumber(ARGV[3])
+redis.call('ZADD', KEYS[2], last, ARGV[1])
+redis.call('ZADD', KEYS[3], orders, ARGV[1])
+redis.call('ZADD', KEYS[4], spent, ARGV[1])
+if orders >= 2 and last > first then
+  local avg = math.floor((last - first) / (orders - 1))
+  redis.call('HSET', KEYS[1], 'avg_interval', avg)
+  due = last + math.floor(avg * tonumber(ARGV[2]))
+  redis.call('ZADD', KEYS[5], due, ARGV[1])
+else
+  redis.call('ZREM', KEYS[5], ARGV[1])
+end
+redis.call('HSET', KEYS[7], ARGV[4], ARGV[5])
+redis.call('ZADD', KEYS[6], due, ARGV[4])
+return orders
+"""
+
+
+def queue_rfm_update(pipe, user_id: int, cafe_id: Optional[str] = None):
+    # при миграции профиль кафе ещё грузится: точный срок уточнит сама задача
+    profile = tenants.peek(cafe_id) if cafe_id else cafe()
+    cafe_id = cafe_id or cafe().cafe_id
+    cycle_days = profile.return_cycle_days if profile else DEFAULT_RETURN_CYCLE_DAYS
+    pipe_lua(
+        pipe,
+        RFM_UPDATE_LUA,
+        7,
+        cafe_key(f"{CUSTOMER_KEY_PREFIX}{user_id}", cafe_id),
+        cafe_key(RFM_RECENCY_KEY, cafe_id),
+        cafe_key(RFM_FREQUENCY_KEY, cafe_id),
+        cafe_key(RFM_MONETARY_KEY, cafe_id),
+        cafe_key(RFM_LAPSE_DUE_KEY, cafe_id),
+        JOBS_DUE_KEY,
+        JOBS_DATA_KEY,
+        str(user_id),
+        str(RFM_LAPSE_FACTOR),
+        str(cycle_days * 86400),
+        job_id_for("return_offer", cafe_id, user_id),
+        json.dumps({"type": "return_offer", "cafe_id": cafe_id, "user_id": int(user_id)}),
+    )
+
+
+def queue_rfm_forget(pipe, user_id: int):
+    for key in (RFM_RECENCY_KEY, RFM_FREQUENCY_KEY, RFM_MONETARY_KEY, RFM_LAPSE_DUE_KEY):
+        pipe.zrem(cafe_key(key), str(user_id))
+    queue_cancel_job(pipe, job_id_for("return_offer", cafe().cafe_id, user_id))
 
+
+async def migrate_rfm(r: redis.Redis, cafe_id: str):
+    # одноразовое построение индексов по уже существующим карточкам клиентов
+    if not await r.set(cafe_key(MIGRATION_RFM_KEY, cafe_id), "running", nx=True, ex=600):
+        return
+
+    user_ids = list(await r.smembers(cafe_key(CUSTOMERS_SET_KEY, cafe_id)))
+    for i in range(0, len(user_ids), 500):
+        pipe = r.pipeline(transaction=False)
+        for user_id in user_ids[i:i + 500]:
+            queue_rfm_update(pipe, int(user_id), cafe_id)
+        await pipe.execute()
+    await r.set(cafe_key(MIGRATION_RFM_KEY, cafe_id), "done")
+    logger.info(f"migrate_rfm {cafe_id}: {len(user_ids)} customers")
+
+
+def _rfm_score(rank: Optional[int], total: int) -> int:
+    # rank по возрастанию score: верхние 20% получают 5
+    if rank is None or total <= 0:
+        return 0
+    return min(5, 1 + rank * 5 // total)
+
+
+async def rfm_scores(user_id: int) -> Dict[str, int]:
+    keys = {"r": RFM_RECENCY_KEY, "f": RFM_FREQUENCY_KEY, "m": RFM_MONETARY_KEY}
     try:
         r = await get_redis_client()
-        pipe = r.pipeline()
-        pipe.sadd(CUSTOMERS_SET_KEY, user_id)
-        pipe.hsetnx(customer_key, "first_order_ts", now_ts)
-        pipe.hsetnx(customer_key, "offers_opt_out", 0)
-        pipe.hsetnx(customer_key, "last_trigger_ts", 0)
-        pipe.hset(
-            customer_key,
-            mapping={
-                "firstname": firstname or "",
-                "username": username or "",
-                "last_order_ts": now_ts,
-                "last_order_sum": int(total_sum),
-                "last_drink": last_drink,
-            },
-        )
-        pipe.hincrby(customer_key, "total_orders", 1)
-        pipe.hincrby(customer_key, "total_spent", int(total_sum))
-        for drink, qty in cart.items():
-            pipe.hincrby(drinks_key, drink, int(qty))
-        await pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for key in keys.values():
+            pipe.zrank(cafe_key(key), str(user_id))
+            pipe.zcard(cafe_key(key))
+        res = await pipe.execute()
         await r.aclose()
     except Exception:
-        pass
+        return {}
+    return {name: _rfm_score(res[2 * i], res[2 * i + 1]) for i, name in enumerate(keys)}
 
 
-async def smart_return_check_and_send(bot: Bot):
-    if not _in_send_window_msk():
+async def rfm_lapsed_customers(now_ts: int, min_orders: int = 2) -> list:
+    # «постоянные клиенты, пропавшие на RFM_LAPSE_FACTOR своих обычных интервалов»
+    r = await get_redis_client()
+    try:
+        lapsed = await r.zrangebyscore(cafe_key(RFM_LAPSE_DUE_KEY), "-inf", now_ts)
+        if not lapsed or min_orders <= 2:
+            return [int(u) for u in lapsed]
+        freq = await r.zmscore(cafe_key(RFM_FREQUENCY_KEY), lapsed)
+        return [int(u) for u, f in zip(lapsed, freq) if f is not None and f >= min_orders]
+    finally:
+        await r.aclose()
+
+
+@router.message(Command("rfm"))
+async def rfm_cmd(message: Message):
+    if message.from_user.id not in (SUPERADMIN_ID, cafe().admin_id):
         return
 
     now_ts = int(time.time())
     try:
         r = await get_redis_client()
-        ids = await r.smembers(CUSTOMERS_SET_KEY)
+        pipe = r.pipeline(transaction=False)
+        pipe.zcard(cafe_key(RFM_RECENCY_KEY))
+        pipe.zcount(cafe_key(RFM_RECENCY_KEY), now_ts - 30 * 86400, "+inf")
+        pipe.zcount(cafe_key(RFM_FREQUENCY_KEY), RFM_FREQUENT_MIN_ORDERS, "+inf")
+        pipe.zcount(cafe_key(RFM_LAPSE_DUE_KEY), "-inf", now_ts)
+        total, active, frequent, lapsed = await pipe.execute()
         await r.aclose()
-        ids = [int(x) for x in ids]
-    except Exception:
-        ids = []
+        frequent_lapsed = len(await rfm_lapsed_customers(now_ts, RFM_FREQUENT_MIN_ORDERS))
+    except Exception as e:
+        await message.answer(f"Redis error: {html.quote(str(e))}")
+        return
 
-    for user_id in ids:
-        customer_key = f"{CUSTOMER_KEY_PREFIX}{user_id}"
-        try:
-            r = await get_redis_client()
-            profile = await r.hgetall(customer_key)
-            await r.aclose()
-        except Exception:
-            profile = {}
+    await message.answer(
+        "👥 <b>Клиенты</b>\n\n"
+        f"Всего: <b>{total}</b>\n"
+        f"Заказывали за 30 дней: <b>{active}</b>\n"
+        f"Постоянные ({RFM_FREQUENT_MIN_ORDERS}+ заказов): <b>{frequent}</b>\n"
+        f"Пропали (×{RFM_LAPSE_FACTOR:g} обычного интервала): <b>{lapsed}</b>\n"
+        f"Из них постоянные: <b>{frequent_lapsed}</b>"
+    )
 
-        if not profile or str(profile.get("offers_opt_out", 0)) == "1":
-            continue
 
-        try:
-            last_order_ts = int(float(profile.get("last_order_ts", 0) or 0))
-        except Exception:
-            continue
+def _next_send_window_ts(now_ts: int, user_id: int) -> int:
+    now = datetime.fromtimestamp(now_ts, MSK_TZ)
+    start = now.replace(hour=RETURN_SEND_FROM_HOUR, minute=0, second=0, microsecond=0)
+    if now.hour >= RETURN_SEND_FROM_HOUR:
+        start += timedelta(days=1)
+    # разносим отложенные предложения по первому часу окна, а не все в 10:00:00
+    return int(start.timestamp()) + user_id % 3600
 
-        days_since = (now_ts - last_order_ts) / 86400
-        if days_since < RETURN_CYCLE_DAYS:
-            continue
 
-        try:
-            last_trigger_ts = int(float(profile.get("last_trigger_ts", 0) or 0))
-        except Exception:
-            last_trigger_ts = 0
+@job_handler("return_offer")
+async def return_offer_job(bot: Bot, job_id: str, job: Dict[str, Any]):
+    user_id = int(job["user_id"])
+    now_ts = int(time.time())
+    if not _in_send_window_msk():
+        await schedule_job(job_id, _next_send_window_ts(now_ts, user_id), job)
+        return
 
-        if last_trigger_ts and (now_ts - last_trigger_ts) < RETURN_COOLDOWN_DAYS * 86400:
-            continue
+    customer_key = cafe_key(f"{CUSTOMER_KEY_PREFIX}{user_id}")
+    r = await get_redis_client()
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(customer_key)
+        pipe.zscore(cafe_key(RFM_LAPSE_DUE_KEY), str(user_id))
+        profile, lapse_due = await pipe.execute()
+    finally:
+        await r.aclose()
 
-        firstname = profile.get("firstname") or ""
-        favorite = await _get_favorite_drink(user_id) or profile.get("last_drink") or ""
-        promo = _promo_code_for_user(user_id)
-        text = (
-            f"{html.escape(str(firstname) or 'Друзья')},\n\n"
-            f"Скучаете по <b>{html.quote(str(favorite))}</b>? "
-            f"Дарим <b>{RETURN_DISCOUNT_PERCENT}% скидку</b> на него по промокоду:\n\n"
-            f"<code>{promo}</code>\n\n"
-            "Покажите этот код при заказе. Ждём вас!"
-        )
+    if not profile or str(profile.get("offers_opt_out", 0)) == "1":
+        return
+
+    try:
+        last_order_ts = int(float(profile.get("last_order_ts", 0) or 0))
+        last_trigger_ts = int(float(profile.get("last_trigger_ts", 0) or 0))
+    except Exception:
+        last_order_ts, last_trigger_ts = 0, 0
+
+    # у клиентов с ритмом (2+ заказа) — свой срок из lapse_due,
+    # у остальных — общий цикл кафе по давности последнего заказа
+    due_ts = int(lapse_due) if lapse_due is not None else last_order_ts + cafe().return_cycle_days * 86400
+    if last_trigger_ts:
+        due_ts = max(due_ts, last_trigger_ts + RETURN_COOLDOWN_DAYS * 86400)
+    if due_ts > now_ts:
+        await schedule_job(job_id, due_ts, job)
+        return
+
+    firstname = profile.get("firstname") or ""
+    last_drink = str(profile.get("last_drink") or "")
+    top = await _get_favorite_drinks(user_id, 3)
+    favorite = top[0] if top else (cafe().menu.name(int(last_drink)) if last_drink.isdigit() else "")
+    promo = _promo_code_for_user(user_id)
+    also = f"А ещё ждут {', '.join(html.quote(x) for x in top[1:])}.\n\n" if len(top) > 1 else ""
+    text = (
+        f"{html.quote(str(firstname) or 'Друзья')},\n\n"
+        f"Скучаете по <b>{html.quote(str(favorite))}</b>? "
+        f"Дарим <b>{RETURN_DISCOUNT_PERCENT}% скидку</b> на него по промокоду:\n\n"
+        f"<code>{promo}</code>\n\n"
+        f"{also}"
+        "Покажите этот код при заказе. Ждём вас!"
+    )
 
+    try:
+        await bot.send_message(user_id, text)
+    except (TelegramForbiddenError, TelegramBadRequest):
         try:
-            await bot.send_message(user_id, text)
-            try:
-                r = await get_redis_client()
-                await r.hset(customer_key, "last_trigger_ts", str(now_ts))
-                await r.aclose()
-            except Exception:
-                pass
+            r = await get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            pipe.srem(cafe_key(CUSTOMERS_SET_KEY), user_id)
+            queue_rfm_forget(pipe, user_id)
+            await pipe.execute()
+            await r.aclose()
         except Exception:
-            try:
-                r = await get_redis_client()
-                await r.srem(CUSTOMERS_SET_KEY, user_id)
-                await r.aclose()
-            except Exception:
-                pass
+            pass
+        return
+
+    # не вернулся — повторим не раньше, чем через RETURN_COOLDOWN_DAYS
+    r = await get_redis_client()
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(customer_key, "last_trigger_ts", str(now_ts))
+        queue_job(pipe, job_id, now_ts + RETURN_COOLDOWN_DAYS * 86400, job)
+        await pipe.execute()
+    finally:
+        await r.aclose()
 
 
-async def smart_return_loop(bot: Bot):
-    while True:
-        try:
-            await smart_return_check_and_send(bot)
-        except Exception as e:
-            logger.error(f"smart_return_loop: {e}")
-        await asyncio.sleep(RETURN_CHECK_EVERY_SECONDS)
+# ---------------- Subscriptions: remind & block ----------------
+# На каждый hash подписки (user:<id> или cafe:<id>:admin_subscription) при
+# записи срока ставятся две задачи: напоминание за SUBS_REMIND_DAYS_BEFORE дней
+# и блокировка в момент окончания. Задача сверяет срок с hash: если подписку
+# успели продлить, она ничего не делает.
+# Блокировка (cafebotify_paid=0) включается только явно, SUBS_BLOCK_ENABLED=1:
+# старый subs_loop с ней был отключён из-за конфликта с моделью подписок
+# cafe:*/admin_subscription, и пока проверки доступа не переведены на неё,
+# сброс флага может закрыть доступ оплатившим.
+SUBS_BLOCK_ENABLED = os.getenv("SUBS_BLOCK_ENABLED", "0") == "1"
+
+
+def queue_subscription_jobs(pipe, sub_key: str, user_id: int, valid_until: int, cafe_id: Optional[str] = None):
+    payload = {"cafe_id": cafe_id, "sub_key": sub_key, "user_id": int(user_id), "valid_until": int(valid_until)}
+    queue_job(
+        pipe,
+        job_id_for("subs_reminder", sub_key),
+        valid_until - SUBS_REMIND_DAYS_BEFORE * 86400,
+        {"type": "subs_reminder", **payload},
+    )
+    if SUBS_BLOCK_ENABLED:
+        queue_job(pipe, job_id_for("subs_expire", sub_key), valid_until, {"type": "subs_expire", **payload})
 
 
-# ---------------- Subscriptions loop: remind & block ----------------
-async def subs_check_and_notify(bot: Bot):
-    now_ts = int(time.time())
+async def _subscription_current(job: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    r = await get_redis_client()
     try:
-        r = await get_redis_client()
-        keys = await r.keys("user:*")
+        data = await r.hgetall(job["sub_key"])
+    finally:
         await r.aclose()
-    except Exception:
-        keys = []
+    if str(data.get("cafebotify_valid_until")) != str(job["valid_until"]):
+        return None
+    return data
 
-    for key in keys:
-        try:
-            r = await get_redis_client()
-            data = await r.hgetall(key)
-            await r.aclose()
-        except Exception:
-            continue
 
-        try:
-            paid_flag = int(data.get("cafebotify_paid", 0))
-            valid_until = int(data.get("cafebotify_valid_until", 0))
-        except Exception:
-            continue
+@job_handler("subs_reminder")
+async def subs_reminder_job(bot: Bot, job_id: str, job: Dict[str, Any]):
+    if await _subscription_current(job) is None:
+        return
+    user_id = int(job["user_id"])
+    days_left = max(0, int((int(job["valid_until"]) - time.time()) // 86400))
+    if days_left <= 0:
+        return
+    pay_url = f"{PAY_LANDING_MONTH}?tg_id={user_id}"
+    if job.get("cafe_id"):
+        pay_url += f"&cafe_id={job['cafe_id']}"
+    try:
+        await bot.send_message(
+            user_id,
+            "⏰ <b>Скоро заканчивается доступ к CafebotifySTART</b>\n\n"
+            f"Осталось примерно {days_left} дней.\n"
+            f"Продлите по ссылке:\n<a href=\"{html.quote(pay_url)}\">Оплатить ещё месяц</a>",
+            disable_web_page_preview=True,
+        )
+    except (TelegramForbiddenError, TelegramBadRequest):
+        pass
 
-        if not valid_until:
-            continue
 
-        user_id_str = key.split("user:")[-1]
-        try:
-            user_id = int(user_id_str)
-        except Exception:
-            continue
+@job_handler("subs_expire")
+async def subs_expire_job(bot: Bot, job_id: str, job: Dict[str, Any]):
+    if not SUBS_BLOCK_ENABLED:
+        return
+    data = await _subscription_current(job)
+    if data is None or str(data.get("cafebotify_paid")) != "1":
+        return
+    r = await get_redis_client()
+    try:
+        await r.hset(job["sub_key"], mapping={"cafebotify_paid": "0"})
+    finally:
+        await r.aclose()
+    try:
+        await bot.send_message(
+            int(job["user_id"]),
+            "🔒 Срок действия CafebotifySTART закончился.\n\n"
+            "Оплатите продление, чтобы снова пользоваться ботом.",
+        )
+    except (TelegramForbiddenError, TelegramBadRequest):
+        pass
 
-        days_left = (valid_until - now_ts) / 86400
 
-        # напоминание
-        if SUBS_REMIND_DAYS_BEFORE - 0.5 <= days_left <= SUBS_REMIND_DAYS_BEFORE + 0.5:
-            pay_url = f"{PAY_LANDING_URL}?tg_id={user_id}&plan=month"
-            try:
-                await bot.send_message(
-                    user_id,
-                    "⏰ <b>Скоро заканчивается доступ к CafebotifySTART</b>\n\n"
-                    f"Осталось примерно {int(days_left)} дней.\n"
-                    f"Продлите по ссылке:\n<a href=\"{html.quote(pay_url)}\">Оплатить ещё месяц</a>",
-                    disable_web_page_preview=True,
-                )
-            except Exception:
-                pass
+# ---------------- ЮKassa HTTP ----------------
+# httpx нужен только для платежей: модуль импортируется и клиент (с пулом
+# соединений к API ЮKassa) создаётся при первом платеже, а не при старте.
+_yookassa_http = None
 
-        # блокировка (можно добавить флаг в Redis и проверять его в боте)
-        if days_left < 0 and paid_flag == 1:
-            try:
-                r = await get_redis_client()
-                await r.hset(key, mapping={"cafebotify_paid": "0"})
-                await r.aclose()
-            except Exception:
-                pass
-            try:
-                await bot.send_message(
-                    user_id,
-                    "🔒 Срок действия CafebotifySTART закончился.\n\n"
-                    "Оплатите продление, чтобы снова пользоваться ботом.",
-                )
-            except Exception:
-                pass
 
+def yookassa_http():
+    global _yookassa_http
+    if _yookassa_http is None:
+        import httpx  # requirements.txt: httpx>=0.27.0,<1.0
 
-async def subs_loop(bot: Bot):
-    while True:
-        try:
-            await subs_check_and_notify(bot)
-        except Exception as e:
-            logger.error(f"subs_loop: {e}")
-        await asyncio.sleep(SUBS_CHECK_EVERY_SECONDS)
+        _yookassa_http = httpx.AsyncClient(timeout=YOOKASSA_TIMEOUT)
+    return _yookassa_http
+
+
+async def close_yookassa_http():
+    global _yookassa_http
+    if _yookassa_http is not None:
+        await _yookassa_http.aclose()
+        _yookassa_http = None
 
 
-# ---------------- ЮKassa HTTP ----------------
 async def create_payment(amount: str, description: str, metadata: dict) -> str:
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
         raise web.HTTPInternalServerError(text="Yookassa credentials not set")
@@ -1969,24 +4503,24 @@ async def create_payment(amount: str, description: str, metadata: dict) -> str:
         "metadata": metadata,
     }
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            url,
-            json=payload,
-            auth=(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY),
-            headers={"Idempotence-Key": idem_key},
-            timeout=10,
-        )
-        if resp.status_code not in (200, 201):
-            logger.error(f"Yookassa error {resp.status_code} {resp.text}")
-            raise web.HTTPInternalServerError(text="Yookassa error")
+    resp = await yookassa_http().post(
+        url,
+        json=payload,
+        auth=(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY),
+        headers={"Idempotence-Key": idem_key},
+        timeout=budget_timeout(YOOKASSA_TIMEOUT),
+    )
+    if resp.status_code not in (200, 201):
+        logger.error(f"Yookassa error {resp.status_code} {resp.text}")
+        raise web.HTTPInternalServerError(text="Yookassa error")
 
-        data = resp.json()
-        confirmation = data["confirmation"]["confirmation_url"]
-        return confirmation
+    data = resp.json()
+    confirmation = data["confirmation"]["confirmation_url"]
+    return confirmation
 
 
 async def pay_month_handler(request: web.Request):
+    await check_pay_link_rate(request)
     tgid = (
         request.query.get("tg_id")
         or request.query.get("tgid")
@@ -2016,6 +4550,7 @@ async def pay_month_handler(request: web.Request):
 
 
 async def pay_year_handler(request: web.Request):
+    await check_pay_link_rate(request)
     tgid = (
         request.query.get("tg_id")
         or request.query.get("tgid")
@@ -2106,7 +4641,8 @@ async def yookassa_webhook(request: web.Request):
         try:
             r = await get_redis_client()
             eff_admin = await get_effective_admin_id(r, cafe_id)
-            await r.hset(
+            pipe = r.pipeline(transaction=True)
+            pipe.hset(
                 k_admin_subscription(cafe_id),
                 mapping={
                     "cafebotify_valid_until": str(valid_until),
@@ -2119,6 +4655,8 @@ async def yookassa_webhook(request: web.Request):
                     "last_paid_at": str(now_ts),
                 },
             )
+            queue_subscription_jobs(pipe, k_admin_subscription(cafe_id), tgid_int, valid_until, cafe_id)
+            await pipe.execute()
             await r.aclose()
         except Exception:
             logger.exception(
@@ -2179,81 +4717,158 @@ async def yookassa_webhook(request: web.Request):
     )
 
     demo_bot = request.app["bot"]
+    notify_kwargs = {"disable_web_page_preview": True, "parse_mode": "HTML"}
 
-    try:
-        await demo_bot.send_message(
-            ADMIN_ID,
-            preview,
-            disable_web_page_preview=True,
-            parse_mode="HTML",
-        )
-        await demo_bot.send_message(
-            ADMIN_ID,
-            admin_text,
-            disable_web_page_preview=True,
-            parse_mode="HTML",
-        )
-    except Exception:
-        logger.exception(f"yookassa_webhook admin notify error payment_id={payment_id} tgid={tgid}")
-
+    eff_admin = None
+    group_id = None
     if cafe_id:
         try:
             r = await get_redis_client()
             eff_admin = await get_effective_admin_id(r, cafe_id)
             group_id = await r.get(k_staff_group(cafe_id))
             await r.aclose()
-
-            if eff_admin and eff_admin != ADMIN_ID:
-                await demo_bot.send_message(
-                    eff_admin,
-                    admin_text,
-                    disable_web_page_preview=True,
-                    parse_mode="HTML",
-                )
-
-            if group_id:
-                await demo_bot.send_message(
-                    int(group_id),
-                    admin_text,
-                    disable_web_page_preview=True,
-                    parse_mode="HTML",
-                )
         except Exception:
             logger.exception(
-                f"yookassa_webhook secondary notify failed cafe_id={cafe_id} payment_id={payment_id}"
+                f"yookassa_webhook secondary notify lookup failed cafe_id={cafe_id} payment_id={payment_id}"
             )
-    
+
+    sends = [
+        (SUPERADMIN_ID, demo_bot.send_message(SUPERADMIN_ID, preview, **notify_kwargs)),
+        (SUPERADMIN_ID, demo_bot.send_message(SUPERADMIN_ID, admin_text, **notify_kwargs)),
+    ]
+    if eff_admin and eff_admin != SUPERADMIN_ID:
+        sends.append((eff_admin, demo_bot.send_message(eff_admin, admin_text, **notify_kwargs)))
+    if group_id:
+        sends.append((int(group_id), demo_bot.send_message(int(group_id), admin_text, **notify_kwargs)))
+
+    admin_sends = len(sends)
+
     client_token = (os.getenv("CLIENT_BOT_TOKEN") or "").strip()
+    client_bot = None
     if client_token:
+        if cafe_id:
+            user_text = (
+                "✅ <b>Оплата прошла успешно</b>\n\n"
+                f"Кафе: <code>{html.quote(str(cafe_id))}</code>\n"
+                f"Тариф CafebotifySTART активирован на <b>{tariff_title}</b>.\n"
+                f"Срок действия: до <b>{valid_until_dt}</b>.\n\n"
+                "Подписка кафе обновлена."
+            )
+        else:
+            user_text = (
+                "✅ <b>Оплата прошла успешно</b>\n\n"
+                f"Тариф CafebotifySTART активирован на <b>{tariff_title}</b>.\n"
+                f"Срок действия: до <b>{valid_until_dt}</b>.\n\n"
+                "Следующий шаг — привязка свободного кафе администратором."
+            )
         client_bot = Bot(token=client_token)
-        try:
-            if cafe_id:
-                user_text = (
-                    "✅ <b>Оплата прошла успешно</b>\n\n"
-                    f"Кафе: <code>{html.quote(str(cafe_id))}</code>\n"
-                    f"Тариф CafebotifySTART активирован на <b>{tariff_title}</b>.\n"
-                    f"Срок действия: до <b>{valid_until_dt}</b>.\n\n"
-                    "Подписка кафе обновлена."
-                )
-            else:
-                user_text = (
-                    "✅ <b>Оплата прошла успешно</b>\n\n"
-                    f"Тариф CafebotifySTART активирован на <b>{tariff_title}</b>.\n"
-                    f"Срок действия: до <b>{valid_until_dt}</b>.\n\n"
-                    "Следующий шаг — привязка свободного кафе администратором."
-                )
-
-            await client_bot.send_message(tgid_int, user_text, parse_mode="HTML")
-        except Exception:
-            logger.exception(f"yookassa_webhook user notify error payment_id={payment_id} tgid={tgid}")
-        finally:
-            await client_bot.session.close()
+        # другой бот — другой диалог, с уведомлениями админам не упорядочиваем
+        sends.append((("client", tgid_int), client_bot.send_message(tgid_int, user_text, parse_mode="HTML")))
     else:
         logger.error(f"CLIENT_BOT_TOKEN not set; cannot notify user tgid={tgid_int}, payment_id={payment_id}")
 
+    try:
+        results = await fan_out(f"yookassa_webhook payment_id={payment_id}", sends)
+    finally:
+        if client_bot is not None:
+            await client_bot.session.close()
+    # плательщик общается с клиентским ботом — ответы админов уходят через него
+    await remember_reply_route(demo_bot, results[:admin_sends], tgid_int, "payment", via="client")
+
     return web.json_response({"status": "ok"})
 
 
+# ---------------- Config persistence ----------------
+# Запись config.json уходит в поток (диск — сетевой том, open/fsync могут
+# висеть) и делается атомарно: временный файл рядом, fsync, rename. Правки,
+# пришедшие пока идёт запись или в течение CONFIG_WRITE_DELAY, сливаются в
+# одну запись; каждый вызвавший дожидается записи, в которую попали его поля.
+CONFIG_WRITE_DELAY = float(os.getenv("CONFIG_WRITE_DELAY", "0.2"))
+
+
+def _write_config_file(path: str, cafe_updates: Dict[str, Any]):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        data = {}
+    cafe_section = data.get("cafe", {})
+    cafe_section.update(cafe_updates)
+    data["cafe"] = cafe_section
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # сам rename тоже должен пережить падение
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+class ConfigWriter:
+    def __init__(self, path: str, delay: float):
+        self.path = path
+        self.delay = delay
+        self._pending: Dict[str, Any] = {}
+        self._waiters: list = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def update(self, cafe_updates: Dict[str, Any]):
+        self._pending.update(cafe_updates)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+        await waiter
+
+    async def _flush(self):
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            updates, waiters = self._pending, self._waiters
+            self._pending, self._waiters = {}, []
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(_write_config_file, self.path, updates)
+            except Exception as e:
+                logger.error(f"config.json write failed: {e}")
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            logger.info(
+                f"config.json saved: {len(waiters)} update(s) in one write, "
+                f"{(time.perf_counter() - started) * 1000:.1f} ms"
+            )
+
+    async def drain(self):
+        if self._task is not None and not self._task.done():
+            await self._task
+
+
+config_writer = ConfigWriter(CONFIG_PATH, CONFIG_WRITE_DELAY)
+
+
 # ---------------- Команды суперадмина: профиль и оплата ----------------
 def _parse_kv_payload(text: str) -> Dict[str, str]:
     """
@@ -2282,66 +4897,65 @@ def _parse_kv_payload(text: str) -> Dict[str, str]:
 
 @router.message(Command("set_profile"))
 async def set_profile_cmd(message: Message):
-    if message.from_user.id != SUPERADMIN_ID:
+    if message.from_user.id not in (SUPERADMIN_ID, cafe().admin_id):
         return
 
     params = _parse_kv_payload(message.text or "")
     if not params:
         await message.answer(
             "Формат:\n"
-            "/set_profile name=Кофейня; phone=+7...; address=город, улица; work_start=9; work_end=21"
+            "/set_profile name=Кофейня; phone=+7...; address=город, улица; work_start=9; work_end=21; booking_tables=5"
         )
         return
 
-    global CAFE_NAME, CAFE_PHONE, CAFE_ADDRESS, WORK_START, WORK_END
-
+    profile = cafe()
+    updates: Dict[str, Any] = {}
     changes = []
 
-    if "name" in params:
-        CAFE_NAME = params["name"]
-        changes.append(f"name → <code>{html.quote(CAFE_NAME)}</code>")
-
-    if "phone" in params:
-        CAFE_PHONE = params["phone"]
-        changes.append(f"phone → <code>{html.quote(CAFE_PHONE)}</code>")
-
-    if "address" in params:
-        CAFE_ADDRESS = params["address"]
-        changes.append(f"address → <code>{html.quote(CAFE_ADDRESS)}</code>")
-
-    if "work_start" in params:
-        try:
-            WORK_START = int(params["work_start"])
-            changes.append(f"work_start → <code>{WORK_START}</code>")
-        except Exception:
-            pass
-
-    if "work_end" in params:
-        try:
-            WORK_END = int(params["work_end"])
-            changes.append(f"work_end → <code>{WORK_END}</code>")
-        except Exception:
-            pass
+    for field in ("name", "phone", "address"):
+        if field in params:
+            updates[field] = params[field]
+            changes.append(f"{field} → <code>{html.quote(params[field])}</code>")
+
+    for field in ("work_start", "work_end", "booking_tables"):
+        if field in params:
+            try:
+                updates[field] = int(params[field])
+                changes.append(f"{field} → <code>{updates[field]}</code>")
+            except Exception:
+                pass
+
+    profile = replace(profile, **updates)
+    set_current_cafe(profile)
 
-    # сохранить профиль в CONFIG_PATH (/data/config.json), чтобы переживало рестарт
+    # профиль кафе живёт в Redis (cafe:<id>:profile), его читают все процессы
     try:
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception:
-        data = {}
+        r = await get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        if updates:
+            pipe.hset(k_cafe_profile(profile.cafe_id), mapping={k: str(v) for k, v in updates.items()})
+        pipe.sadd(CAFES_SET_KEY, profile.cafe_id)
+        await pipe.execute()
+        await r.aclose()
+    except Exception as e:
+        logger.error(f"set_profile redis {profile.cafe_id}: {e}")
 
-    cafe = data.get("cafe", {})
-    cafe["name"] = CAFE_NAME
-    cafe["phone"] = CAFE_PHONE
-    cafe["address"] = CAFE_ADDRESS
-    cafe["work_start"] = WORK_START
-    cafe["work_end"] = WORK_END
-    data["cafe"] = cafe
+    if profile.cafe_id != DEFAULT_CAFE_CODE:
+        await message.answer(
+            "✅ Профиль обновлён:\n" + ("\n".join(changes) if changes else "Изменений нет.")
+        )
+        return
 
+    # кафе по умолчанию дополнительно сохраняем в CONFIG_PATH (/data/config.json), чтобы переживало рестарт
     try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        await config_writer.update({
+            "name": profile.name,
+            "phone": profile.phone,
+            "address": profile.address,
+            "work_start": profile.work_start,
+            "work_end": profile.work_end,
+            "booking_tables": profile.booking_tables,
+        })
     except Exception as e:
         await message.answer(
             f"⚠️ Профиль обновлён в памяти, но не удалось сохранить config.json: {e}"
@@ -2419,7 +5033,8 @@ async def set_paid_cmd(message: Message):
 
     try:
         r = await get_redis_client()
-        await r.hset(
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(
             f"user:{tg_id_int}",
             mapping={
                 "cafebotify_paid": "1",
@@ -2428,6 +5043,8 @@ async def set_paid_cmd(message: Message):
                 "cafebotify_product": product,
             },
         )
+        queue_subscription_jobs(pipe, f"user:{tg_id_int}", tg_id_int, valid_until)
+        await pipe.execute()
         await r.aclose()
     except Exception as e:
         await message.answer(f"Redis error: {e}")
@@ -2438,89 +5055,896 @@ async def set_paid_cmd(message: Message):
     )
 
 
-# ---------------- Fallback drink pick ----------------
-@router.message(F.text)
-async def any_text_message(message: Message, state: FSMContext):
-    text = (message.text or "").strip()
+@router.message(Command("add_bot"))
+async def add_bot_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+    if bot_registry is None:
+        await message.answer("Мульти-бот режим выключен (MULTI_BOT=1).")
+        return
 
-    known_buttons = {
-        BTN_CLIENT_MENU,
-        BTN_OWNER_MENU,
-        BTN_TO_START,
-        BTN_ABOUT_ASSISTANT,
-        BTN_PAY_MONTH,
-        BTN_PAY_YEAR,
-        BTN_CART,
-        BTN_CHECKOUT,
-        BTN_BOOKING,
-        BTN_CALL,
-        BTN_HOURS,
-        BTN_STATS,
-        BTN_MENU_EDIT,
-        BTN_STAFF_GROUP,
-        BTN_LINKS,
-        BTN_RENEW_SUB,
-        BTN_SUBSCRIPTION,
-        BTN_ADMIN_HELP,
-        BTN_SUPPORT,
-        BTN_CONFIRM,
-        BTN_CANCEL,
-        BTN_CANCEL_ORDER,
-        BTN_READY_NOW,
-        BTN_READY_20,
-        BTN_EDIT_CART,
-        BTN_CLEAR_CART,
-        BTN_BACK,
-        CART_ACT_PLUS,
-        CART_ACT_MINUS,
-        CART_ACT_DEL,
-        CART_ACT_DONE,
-        MENU_EDIT_ADD,
-        MENU_EDIT_EDIT,
-        MENU_EDIT_DEL,
-    }
+    parts = (message.text or "").split()
+    if len(parts) < 3 or not _CAFE_CODE_RE.match(parts[2]):
+        await message.answer("Формат: /add_bot <token> <cafe_id>")
+        return
 
-    if text in known_buttons:
+    token, cafe_id = parts[1], parts[2]
+    try:
+        bot_hash = await bot_registry.add(token, cafe_id)
+    except Exception as e:
+        await message.answer(f"Не удалось подключить бота: {html.quote(str(e))}")
         return
 
-    if text in MENU:
-        if not is_cafe_open():
-            await message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
-            return
-        await _start_add_item(message, state, text)
+    try:
+        await message.delete()  # токен не должен оставаться в истории чата
+    except Exception:
+        pass
+    await message.answer(f"✅ Бот подключён к кафе <code>{html.quote(cafe_id)}</code>: <code>{bot_hash}</code>")
+
+
+@router.message(Command("remove_bot"))
+async def remove_bot_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+    if bot_registry is None:
+        await message.answer("Мульти-бот режим выключен (MULTI_BOT=1).")
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) < 2:
+        await message.answer("Формат: /remove_bot <hash>")
+        return
+
+    if await bot_registry.remove(parts[1]):
+        await message.answer(f"✅ Бот <code>{html.quote(parts[1])}</code> отключён.")
+    else:
+        await message.answer("Бот не найден.")
+
+
+@router.message(Command("bots"))
+async def bots_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+    if bot_registry is None:
+        await message.answer("Мульти-бот режим выключен (MULTI_BOT=1).")
+        return
+
+    lines = [
+        f"• <code>{bot_hash}</code> → <code>{html.quote(cafe_id)}</code>"
+        for bot_hash, cafe_id in sorted(bot_registry.describe().items())
+    ]
+    await message.answer("<b>Подключённые боты</b>\n" + ("\n".join(lines) if lines else "нет"))
+
+
+# ---------------- Config reload ----------------
+# config.json перечитывается без рестарта. Каждый воркер раз в
+# CONFIG_RELOAD_SECONDS сверяет mtime файла и версию config:version в Redis;
+# при изменении файл читается и проверяется в отдельном потоке, и только
+# целиком валидный конфиг одной операцией подменяет config_snapshot и базовый
+# профиль кафе по умолчанию. Апдейты, которые уже обрабатываются, дорабатывают
+# со старым профилем (он лежит в их контексте). Правки из файла лидер переносит
+# в Redis (профиль и меню) и поднимает версию — остальные воркеры подхватывают.
+CONFIG_VERSION_KEY = "config:version"
+CONFIG_RELOAD_SECONDS = float(os.getenv("CONFIG_RELOAD_SECONDS", "5"))
+_CONFIG_PROFILE_FIELDS = {
+    "name": "name",
+    "phone": "phone",
+    "address": "address",
+    "work_start": "work_start",
+    "work_end": "work_end",
+    "return_cycle_days": "return_cycle_days",
+    "booking_tables": "booking_tables",
+    "admin_chat_id": "admin_id",
+}
+
+
+async def _push_config_changes(old: Mapping[str, Any], new: Mapping[str, Any]) -> bool:
+    updates = {
+        field: str(new[key]) for key, field in _CONFIG_PROFILE_FIELDS.items() if new.get(key) != old.get(key)
+    }
+    menu_changed = False
+    with cafe_scope(tenants.default):
+        for name, price in new["menu"].items():
+            if old["menu"].get(name) != price:
+                await menu_set_item(name, int(price))
+                menu_changed = True
+        for name in old["menu"]:
+            if name not in new["menu"]:
+                await menu_delete_item(name)
+                menu_changed = True
+    if updates:
+        r = await get_redis_client()
+        try:
+            await r.hset(k_cafe_profile(DEFAULT_CAFE_CODE), mapping=updates)
+        finally:
+            await r.aclose()
+    return bool(updates) or menu_changed
+
+
+async def reload_config(force: bool = False) -> bool:
+    global config_snapshot
+    started = time.perf_counter()
+    old = config_snapshot
+    try:
+        r = await get_redis_client()
+        version = int(await r.get(CONFIG_VERSION_KEY) or 0)
+        await r.aclose()
+    except Exception:
+        version = old.version
+    try:
+        mtime = (await asyncio.to_thread(os.stat, CONFIG_PATH)).st_mtime
+    except OSError:
+        mtime = old.mtime  # файла нет — работаем на том, что есть
+
+    file_changed = mtime != old.mtime
+    if not (force or file_changed or version != old.version):
+        return False
+
+    cfg: Mapping[str, Any] = old.data
+    if force or file_changed:
+        try:
+            mtime, parsed = await asyncio.to_thread(read_config_file)
+        except Exception as e:
+            # битый файл не перечитываем на каждом тике — ждём следующей правки
+            config_snapshot = replace(old, mtime=mtime)
+            logger.error(f"config reload: {e}; keeping previous config")
+            return False
+        cfg = _freeze_config(parsed)
+    read_ms = (time.perf_counter() - started) * 1000
+
+    snapshot = ConfigSnapshot(data=cfg, mtime=mtime, version=version)
+    if file_changed and is_leader() and await _push_config_changes(old.data, cfg):
+        r = await get_redis_client()
+        try:
+            snapshot = replace(snapshot, version=int(await r.incr(CONFIG_VERSION_KEY)))
+        finally:
+            await r.aclose()
+
+    config_snapshot = snapshot
+    await tenants.reload_default(_default_profile_from_config(cfg))
+    metrics.incr("config_reloads")
+    logger.info(
+        f"config reloaded v{snapshot.version} (file {'changed' if file_changed else 'same'}): "
+        f"read {read_ms:.1f} ms, total {(time.perf_counter() - started) * 1000:.1f} ms"
+    )
+    return True
+
+
+async def config_reload_loop():
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_SECONDS)
+        try:
+            await reload_config()
+        except Exception as e:
+            logger.error(f"config reload loop: {e}")
+
+
+@router.message(Command("reload_config"))
+async def reload_config_cmd(message: Message):
+    if message.from_user.id != SUPERADMIN_ID:
+        return
+    try:
+        # поднятая версия заставит перечитать конфиг и остальные воркеры
+        r = await get_redis_client()
+        await r.incr(CONFIG_VERSION_KEY)
+        await r.aclose()
+        await reload_config(force=True)
+    except Exception as e:
+        await message.answer(f"Не удалось перечитать конфиг: {html.quote(str(e))}")
         return
+    await message.answer(f"✅ Конфиг перечитан, версия <code>{config_snapshot.version}</code>.")
+
+
+# ---------------- Fallback drink pick ----------------
+# кнопки, которые имеют смысл только внутри состояний: вне состояния молча игнорируем
+fallback_buttons.ignore(
+    *buttons.texts(),
+    BTN_CONFIRM,
+    BTN_CANCEL,
+    BTN_READY_NOW,
+    BTN_READY_20,
+    BTN_BACK,
+    CART_ACT_PLUS,
+    CART_ACT_MINUS,
+    CART_ACT_DEL,
+    CART_ACT_DONE,
+    MENU_EDIT_ADD,
+    MENU_EDIT_EDIT,
+    MENU_EDIT_DEL,
+)
+
+
+@fallback_buttons.menu_items
+async def menu_item_pressed(message: Message, state: FSMContext, menu_item: MenuItem):
+    if not is_cafe_open():
+        return message.answer(get_closed_message(), reply_markup=create_client_menu_keyboard())
+    await _start_add_item(message, state, menu_item)
 
+
+@router.message(ButtonFilter(fallback_buttons, strip=True))
+async def dispatch_fallback_button(message: Message, button_handler: CallableObject, **kwargs):
+    return await button_handler.call(message, **kwargs)
+
+
+@router.message(F.text)
+async def any_text_message(message: Message):
     await message.answer(
         "Не понял. Используйте кнопки меню.",
         reply_markup=create_client_menu_keyboard(),
     )
 
 
-# ---------------- Startup / webhook ----------------
-smart_task: Optional[asyncio.Task] = None
-subs_task: Optional[asyncio.Task] = None
+# ---------------- Multi-bot hosting ----------------
+# Один процесс может обслуживать ботов многих кафе. Токены лежат в Redis
+# (bots:registry: hash -> {"token", "cafe_id"}), у каждого бота свой webhook-путь
+# по хешу токена и свой secret_token. Dispatcher, пул Redis и HTTP-сессия общие;
+# добавление/удаление бота рассылается остальным процессам через pubsub.
+MULTI_BOT = os.getenv("MULTI_BOT", "0") == "1"
+BOTS_REGISTRY_KEY = "bots:registry"
+BOTS_CHANNEL = "bots:events"
+MULTI_BOT_PATH = "/bots/{bot_hash}/webhook"
 
 
-async def on_startup_bot(bot: Bot):
-    global smart_task, subs_task
-    await sync_menu_from_redis()
-    
-    if smart_task is None or smart_task.done():
-        smart_task = asyncio.create_task(smart_return_loop(bot))
-        
-    # Временно отключено: старый subs_loop читает user:* и старые поля
-    # cafebotify_paid / cafebotify_valid_until, что конфликтует с новой
-    # моделью подписок по cafe:* / admin_subscription.
-    # if subs_task is None or subs_task.done():
-    #     subs_task = asyncio.create_task(subs_loop(bot))
+def _bot_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+def _bot_secret(token: str) -> str:
+    return hmac.new(WEBHOOK_SECRET.encode("utf-8"), token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+class BotRegistry:
+    def __init__(self, session: AiohttpSession):
+        self.session = session
+        self._bots: Dict[str, Bot] = {}
+        self._secrets: Dict[int, str] = {}
+        self._cafes: Dict[int, str] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def resolve(self, bot_hash: str) -> Optional[Bot]:
+        return self._bots.get(bot_hash)
+
+    def secret_for(self, bot: Bot) -> Optional[str]:
+        return self._secrets.get(bot.id)
+
+    def cafe_for(self, bot_id: int) -> Optional[str]:
+        return self._cafes.get(bot_id)
+
+    def bot_for(self, cafe_id: str) -> Optional[Bot]:
+        for bot in self._bots.values():
+            if self._cafes.get(bot.id) == cafe_id:
+                return bot
+        return None
+
+    def describe(self) -> Dict[str, str]:
+        return {h: self._cafes.get(b.id, "") for h, b in self._bots.items()}
+
+    def _attach(self, token: str, cafe_id: str) -> Tuple[str, Bot]:
+        bot_hash = _bot_hash(token)
+        bot = self._bots.get(bot_hash)
+        if bot is None:
+            bot = Bot(token=token, session=self.session, default=DefaultBotProperties(parse_mode="HTML"))
+            self._bots[bot_hash] = bot
+            self._secrets[bot.id] = _bot_secret(token)
+        self._cafes[bot.id] = cafe_id
+        return bot_hash, bot
+
+    def _detach(self, bot_hash: str) -> Optional[Bot]:
+        bot = self._bots.pop(bot_hash, None)
+        if bot is not None:
+            self._secrets.pop(bot.id, None)
+            self._cafes.pop(bot.id, None)
+        return bot
+
+    async def _set_webhook(self, bot_hash: str, bot: Bot):
+        url = f"https://{HOSTNAME}{MULTI_BOT_PATH.format(bot_hash=bot_hash)}"
+        await bot.set_webhook(url, secret_token=self._secrets[bot.id])
+
+    async def add(self, token: str, cafe_id: str) -> str:
+        bot_hash, bot = self._attach(token, cafe_id)
+        try:
+            await self._set_webhook(bot_hash, bot)
+        except Exception:
+            self._detach(bot_hash)
+            raise
+
+        # без записи в реестре бот не переживёт рестарт и не появится на
+        # других воркерах — вебхук снимается, чтобы апдейты не уходили в никуда
+        try:
+            r = await get_redis_client()
+            try:
+                pipe = r.pipeline(transaction=False)
+                pipe.hset(BOTS_REGISTRY_KEY, bot_hash, json.dumps({"token": token, "cafe_id": cafe_id}))
+                pipe.sadd(CAFES_SET_KEY, cafe_id)
+                pipe.publish(BOTS_CHANNEL, bot_hash)
+                await pipe.execute()
+            finally:
+                await r.aclose()
+        except Exception:
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.error(f"bot {bot_hash} delete_webhook: {e}")
+            self._detach(bot_hash)
+            raise
+        logger.info(f"bot {bot_hash} added for cafe {cafe_id}")
+        return bot_hash
+
+    async def remove(self, bot_hash: str) -> bool:
+        bot = self._detach(bot_hash)
+        try:
+            r = await get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            pipe.hdel(BOTS_REGISTRY_KEY, bot_hash)
+            pipe.publish(BOTS_CHANNEL, bot_hash)
+            removed, _ = await pipe.execute()
+            await r.aclose()
+        except Exception as e:
+            logger.error(f"bot registry remove {bot_hash}: {e}")
+            removed = 0
+        if bot is not None:
+            try:
+                await bot.delete_webhook()
+            except Exception:
+                pass
+        return bool(removed) or bot is not None
+
+    async def sync(self, set_webhooks: bool = False):
+        try:
+            r = await get_redis_client()
+            raw = await r.hgetall(BOTS_REGISTRY_KEY)
+            await r.aclose()
+        except Exception as e:
+            logger.error(f"bot registry sync: {e}")
+            return
+
+        wanted: Dict[str, Tuple[str, str]] = {}
+        for bot_hash, value in raw.items():
+            try:
+                entry = json.loads(value)
+                wanted[bot_hash] = (entry["token"], entry["cafe_id"])
+            except Exception:
+                continue
+
+        for bot_hash in list(self._bots):
+            if bot_hash not in wanted:
+                self._detach(bot_hash)
+
+        for bot_hash, (token, cafe_id) in wanted.items():
+            is_new = bot_hash not in self._bots
+            _, bot = self._attach(token, cafe_id)
+            if is_new and set_webhooks:
+                try:
+                    await self._set_webhook(bot_hash, bot)
+                except Exception as e:
+                    logger.error(f"bot {bot_hash} set_webhook: {e}")
+
+        logger.info(f"bot registry: {len(self._bots)} bots")
+
+    async def _listen(self):
+        while True:
+            try:
+                # клиент и подписка закрываются на каждой попытке, иначе
+                # каждый обрыв Redis оставлял бы висящее соединение
+                async with await get_redis_client() as r, r.pubsub() as pubsub:
+                    await pubsub.subscribe(BOTS_CHANNEL)
+                    # изменения, пропущенные пока не было подписки
+                    await self.sync()
+                    async for msg in pubsub.listen():
+                        if msg.get("type") == "message":
+                            await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"bot registry listener: {e}")
+                await asyncio.sleep(5)
+
+    async def start(self, set_webhooks: bool = True):
+        await self.sync(set_webhooks=set_webhooks)
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+
+
+class MultiBotRequestHandler(BaseRequestHandler):
+    def __init__(self, dispatcher: Dispatcher, registry: BotRegistry, handle_in_background: bool = True, **data: Any):
+        super().__init__(dispatcher=dispatcher, handle_in_background=handle_in_background, **data)
+        self.registry = registry
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        if "{bot_hash}" not in path:
+            raise ValueError("Path should contain '{bot_hash}' substring")
+        super().register(app, path=path, **kwargs)
+
+    async def resolve_bot(self, request: web.Request) -> Bot:
+        bot = self.registry.resolve(request.match_info["bot_hash"])
+        if bot is None:
+            raise web.HTTPNotFound()
+        return bot
+
+    def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+        secret = self.registry.secret_for(bot)
+        return bool(secret) and hmac.compare_digest(telegram_secret_token, secret)
+
+    async def close(self) -> None:
+        await self.registry.close()
+
+
+bot_registry: Optional[BotRegistry] = None
+
+
+# ---------------- Workers & metrics ----------------
+# WORKERS>1: супервизор форкает N процессов, каждый слушает PORT через
+# SO_REUSEPORT, ядро раскидывает соединения между ними. Управление вебхуком —
+# только в worker 0. Метрики каждый процесс сбрасывает в Redis
+# (metrics:workers), /metrics отдаёт их сумму.
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "30"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "10"))
+METRICS_KEY = "metrics:workers"
+WORKER_ID = 0
+
+
+def is_leader() -> bool:
+    return WORKER_ID == 0
+
+
+class WorkerMetrics:
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.started_at = time.time()
+
+    def incr(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "worker": WORKER_ID,
+            "pid": os.getpid(),
+            "ts": int(time.time()),
+            "uptime": int(time.time() - self.started_at),
+            "counters": dict(self.counters),
+        }
+
+
+metrics = WorkerMetrics()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    # заодно открывает бюджет апдейта: over_budget_<хендлер> — апдейт вышел за
+    # UPDATE_BUDGET_SECONDS, budget_killed_<хендлер> — снят после грейса
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        started = time.perf_counter()
+        metrics.incr("updates")
+        budget = UpdateBudget(deadline=time.monotonic() + UPDATE_BUDGET_SECONDS)
+        token = _update_budget.set(budget)
+        hard_limit = asyncio.timeout(UPDATE_BUDGET_SECONDS + UPDATE_BUDGET_GRACE_SECONDS)
+        try:
+            async with hard_limit:
+                return await handler(event, data)
+        except TimeoutError:
+            if not hard_limit.expired():
+                metrics.incr("errors")
+                raise
+            metrics.incr(f"budget_killed_{budget.handler}")
+            logger.warning(f"update {event.update_id} cancelled in {budget.handler}: over budget")
+            return None
+        except Exception:
+            metrics.incr("errors")
+            raise
+        finally:
+            _update_budget.reset(token)
+            if time.monotonic() > budget.deadline:
+                metrics.incr(f"over_budget_{budget.handler}")
+            metrics.incr("handle_ms", (time.perf_counter() - started) * 1000)
+
+
+class BudgetHandlerMiddleware(BaseMiddleware):
+    # inner-middleware роутера: хендлер уже выбран, подписываем им бюджет апдейта
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        budget = _update_budget.get()
+        if budget is not None:
+            target = data.get("button_handler") or data.get("handler")
+            budget.handler = getattr(getattr(target, "callback", None), "__name__", budget.handler)
+        return await handler(event, data)
+
+
+def _worker_field() -> str:
+    return f"{socket.gethostname()}:{WORKER_ID}"
+
+
+async def metrics_flush_loop():
+    while True:
+        try:
+            r = await get_redis_client()
+            await r.hset(METRICS_KEY, _worker_field(), json.dumps(metrics.snapshot()))
+            await r.aclose()
+        except Exception as e:
+            logger.error(f"metrics flush: {e}")
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+
+
+async def collect_metrics() -> Dict[str, Any]:
+    workers: Dict[str, Any] = {_worker_field(): metrics.snapshot()}
+    try:
+        r = await get_redis_client()
+        raw = await r.hgetall(METRICS_KEY)
+        await r.aclose()
+    except Exception:
+        raw = {}
+
+    # воркеры, не отчитавшиеся за 3 интервала, считаем умершими
+    stale_before = time.time() - 3 * METRICS_FLUSH_SECONDS
+    for field, value in raw.items():
+        if field in workers:
+            continue
+        try:
+            snap = json.loads(value)
+        except Exception:
+            continue
+        if snap.get("ts", 0) >= stale_before:
+            workers[field] = snap
+
+    total: Dict[str, float] = {}
+    for snap in workers.values():
+        for name, value in snap.get("counters", {}).items():
+            total[name] = total.get(name, 0) + value
+    return {"workers": workers, "total": total}
+
+
+async def metrics_handler(request: web.Request):
+    return web.json_response(await collect_metrics())
+
+
+def run_workers(count: int):
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(worker_id: int):
+        global WORKER_ID
+        pid = os.fork()
+        if pid == 0:
+            WORKER_ID = worker_id
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            code = 0
+            try:
+                asyncio.run(main())
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                logger.exception(f"worker {worker_id} crashed")
+                code = 1
+            os._exit(code)
+        children[pid] = worker_id
+        logger.info(f"worker {worker_id} started pid={pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(WORKER_SHUTDOWN_TIMEOUT)
+
+    def kill_rest(signum, frame):
+        for pid in list(children):
+            logger.error(f"worker pid={pid} did not stop in {WORKER_SHUTDOWN_TIMEOUT}s, killing")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, kill_rest)
+
+    for worker_id in range(count):
+        spawn(worker_id)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is None:
+            continue
+        if not stopping:
+            logger.error(f"worker {worker_id} exited with status {status}, restarting")
+            time.sleep(1)
+            spawn(worker_id)
+
+    logger.info("all workers stopped")
+
+
+# ---------------- Rate limiting ----------------
+# Скользящее окно на действие: не больше limit событий за window секунд.
+# Общий счёт — zset в Redis (ratelimit:<действие>:<субъект>), проверка и запись
+# одним Lua-скриптом, так что параллельные апдейты не проскакивают между GET и
+# SET. Перед Redis — локальная проверка: своих попаданий процесс видит не
+# больше, чем Redis, поэтому отказ по локальному окну всегда верен, и флуд
+# отсекается без сетевых вызовов. Redis недоступен — работаем на локальных окнах.
+# Middleware считает только общую политику "update"; политики действий
+# (заказ, бронь, оплата, /start) проверяет обработчик через rate_limit_hit —
+# там, где действие действительно совершается, после проверок корзины и
+# часов работы, так что отклонённая попытка не тратит лимит.
+RATE_LIMIT_LOCAL_KEYS = int(os.getenv("RATE_LIMIT_LOCAL_KEYS", "10000"))
+
+RATE_LIMIT_LUA = """
+local now = tonumber(ARGV[1])
+for i = 1, #KEYS do
+  local limit = tonumber(ARGV[1 + 2 * i])
+  local window = tonumber(ARGV[2 + 2 * i])
+  redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+  if redis.call('ZCARD', KEYS[i]) >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+    return {0, math.ceil(tonumber(oldest[2]) + window - now), i}
+  end
+end
+for i = 1, #KEYS do
+  redis.call('ZADD', KEYS[i], now, ARGV[2])
+  redis.call('PEXPIRE', KEYS[i], ARGV[2 + 2 * i])
+end
+return {1, 0, 0}
+"""
+
+
+@dataclass(frozen=True)
+class RatePolicy:
+    limit: int
+    window: float
+    message: str = ""
+
+
+RATE_POLICIES: Dict[str, RatePolicy] = {
+    "update": RatePolicy(30, 10, "⏳ Слишком много сообщений. Подождите {seconds} с."),
+    "start": RatePolicy(5, 60, "⏳ Слишком часто. Подождите {seconds} с."),
+    "order": RatePolicy(1, RATE_LIMIT_SECONDS, f"⏳ Между заказами — не меньше {RATE_LIMIT_SECONDS} с. Подождите {{seconds}} с."),
+    "booking": RatePolicy(20, 60, "⏳ Слишком часто. Подождите {seconds} с и попробуйте снова."),
+    "pay": RatePolicy(5, 60, "⏳ Ссылка на оплату уже отправлена. Подождите {seconds} с."),
+    # /pay-month, /pay-year: каждый запрос создаёт платёж в ЮKassa
+    "pay_link": RatePolicy(5, 600),
+}
+
+
+@dataclass
+class RateLimited:
+    action: str
+    key: str
+    retry_after: float
+
+
+class RateLimiter:
+    def __init__(self, policies: Dict[str, RatePolicy], max_keys: int):
+        self.policies = policies
+        self.max_keys = max_keys
+        self._hits: Dict[str, deque] = {}
+        self._blocked: Dict[str, float] = {}
+        self._warned: Dict[str, float] = {}
+
+    def _local_check(self, action: str, key: str, now: float) -> Optional[RateLimited]:
+        until = self._blocked.get(key, 0)
+        if until > now:
+            return RateLimited(action, key, until - now)
+        policy = self.policies[action]
+        hits = self._hits.get(key)
+        if hits:
+            while hits and hits[0] <= now - policy.window:
+                hits.popleft()
+            if len(hits) >= policy.limit:
+                return RateLimited(action, key, hits[0] + policy.window - now)
+        return None
 
+    def _prune(self, now: float):
+        if len(self._hits) + len(self._blocked) <= self.max_keys:
+            return
+        horizon = now - max(p.window for p in self.policies.values())
+        self._hits = {k: h for k, h in self._hits.items() if h and h[-1] > horizon}
+        self._blocked = {k: t for k, t in self._blocked.items() if t > now}
+        self._warned = {k: t for k, t in self._warned.items() if t > now}
+        if len(self._hits) > self.max_keys:
+            self._hits.clear()
+
+    async def check(self, checks) -> Optional[RateLimited]:
+        # checks: [(действие, субъект)]; событие засчитывается во все окна
+        # сразу или ни в одно
+        now = time.time()
+        keys = [(action, f"ratelimit:{action}:{subject}") for action, subject in checks]
+        for action, key in keys:
+            limited = self._local_check(action, key, now)
+            if limited is not None:
+                metrics.incr("ratelimit_local")
+                return limited
+
+        args: list = [int(now * 1000), uuid.uuid4().hex[:12]]
+        for action, _ in keys:
+            policy = self.policies[action]
+            args += [policy.limit, int(policy.window * 1000)]
+        try:
+            r = await get_redis_client()
+            allowed, retry_ms, index = await lua_eval(r, RATE_LIMIT_LUA, len(keys), *[k for _, k in keys], *args)
+            await r.aclose()
+        except Exception:
+            metrics.incr("ratelimit_redis_errors")
+            allowed, retry_ms, index = 1, 0, 0
+
+        if not allowed:
+            action, key = keys[index - 1]
+            self._blocked[key] = now + retry_ms / 1000
+            return RateLimited(action, key, retry_ms / 1000)
+        for _, key in keys:
+            self._hits.setdefault(key, deque()).append(now)
+        self._prune(now)
+        return None
+
+    def warn_once(self, limited: RateLimited) -> bool:
+        # о блокировке сообщаем один раз, дальше отказываем молча
+        now = time.time()
+        if self._warned.get(limited.key, 0) > now:
+            return False
+        self._warned[limited.key] = now + limited.retry_after
+        return True
+
+
+rate_limiter = RateLimiter(RATE_POLICIES, RATE_LIMIT_LOCAL_KEYS)
+
+
+async def rate_limit_hit(event: Union[Message, CallbackQuery], action: str) -> bool:
+    limited = await rate_limiter.check([(action, f"{event.bot.id}:{event.from_user.id}")])
+    if limited is None:
+        return False
+    metrics.incr(f"ratelimit_{action}")
+    text = None
+    if rate_limiter.warn_once(limited):
+        text = RATE_POLICIES[action].message.format(seconds=int(limited.retry_after) + 1)
+    # на callback отвечаем всегда, иначе у клиента крутится индикатор загрузки
+    if text is not None or isinstance(event, CallbackQuery):
+        await event.answer(text)
+    return True
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    # стоит до FSM-middleware: отклонённый апдейт не читает состояние из Redis
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        limited = await rate_limiter.check([("update", f"{data['bot'].id}:{user.id}")])
+        if limited is None:
+            return await handler(event, data)
+
+        metrics.incr(f"ratelimit_{limited.action}")
+        if not rate_limiter.warn_once(limited):
+            return None
+        text = RATE_POLICIES[limited.action].message.format(seconds=int(limited.retry_after) + 1)
+        if event.message is not None:
+            return event.message.answer(text)
+        if event.callback_query is not None:
+            return event.callback_query.answer(text)
+        return None
+
+
+async def check_pay_link_rate(request: web.Request):
+    # первые записи X-Forwarded-For задаёт клиент; последнюю дописал наш
+    # прокси — это адрес, с которого к нему пришли
+    ip = request.headers.get("X-Forwarded-For", "").split(",")[-1].strip() or request.remote or "-"
+    limited = await rate_limiter.check([("pay_link", ip)])
+    if limited is not None:
+        metrics.incr("ratelimit_pay_link")
+        raise web.HTTPTooManyRequests(headers={"Retry-After": str(int(limited.retry_after) + 1)})
+
+
+# ---------------- Startup warm-up ----------------
+# Независимые шаги старта идут параллельно: соединения пула Redis, загрузка
+# Lua-скриптов, профили и меню кафе с таблицами кнопок, реестр ботов и
+# вебхук. Время каждого шага пишется в лог и отдаётся в /ready; до окончания
+# прогрева /ready отвечает 503, чтобы балансировщик не слал трафик на холодный
+# процесс (/healthcheck при этом жив).
+REDIS_WARM_CONNECTIONS = int(os.getenv("REDIS_WARM_CONNECTIONS", "4"))
+WARMUP_STEP_TIMEOUT = float(os.getenv("WARMUP_STEP_TIMEOUT", "30"))
+
+startup_report: Dict[str, Any] = {}
+startup_ready = False
+
+
+def lua_scripts() -> list:
+    return [JOBS_POP_LUA, JOBS_ACK_LUA, BOOKING_RESERVE_LUA, BOOKING_CANCEL_LUA, RFM_UPDATE_LUA, RATE_LIMIT_LUA]
+
+
+async def _warm_redis_pool():
+    # одновременные PING заставляют пул открыть сразу N соединений
+    clients = [await get_redis_client() for _ in range(REDIS_WARM_CONNECTIONS)]
+    try:
+        await asyncio.gather(*(c.ping() for c in clients))
+    finally:
+        for c in clients:
+            await c.aclose()
+
+
+async def _warm_scripts():
+    r = await get_redis_client()
     try:
+        for script in lua_scripts():
+            await r.script_load(script)
+    finally:
+        await r.aclose()
+
+
+async def _warm_tenants():
+    await sync_menu_from_redis()
+    cafe_ids = (await tenants.known_ids())[:TENANT_CACHE_SIZE]
+    profiles = await asyncio.gather(*(tenants.get(cafe_id) for cafe_id in cafe_ids))
+    for profile in profiles:
+        buttons.warm(profile.menu)
+
+
+async def _warm_bots():
+    if bot_registry is not None:
+        await bot_registry.start(set_webhooks=is_leader())
+
+
+async def _set_webhook(bot: Bot):
+    if is_leader():
         await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+
+
+async def _timed_step(name: str, coro) -> Tuple[str, Any]:
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(coro, WARMUP_STEP_TIMEOUT)
+        return name, round((time.perf_counter() - started) * 1000, 1)
     except Exception as e:
-        logger.error(f"Webhook set error: {e}")
+        logger.error(f"warm-up {name}: {e!r}")
+        return name, f"error: {e!r}"
+
+
+async def warm_up(bot: Bot):
+    global startup_ready
+    started = time.perf_counter()
+    steps = await asyncio.gather(
+        _timed_step("redis_pool", _warm_redis_pool()),
+        _timed_step("scripts", _warm_scripts()),
+        _timed_step("tenants", _warm_tenants()),
+        _timed_step("bots", _warm_bots()),
+        _timed_step("webhook", _set_webhook(bot)),
+    )
+    startup_report.update(steps)
+    startup_report["total"] = round((time.perf_counter() - started) * 1000, 1)
+    # упавший шаг не держит процесс холодным: всё прогреется на первых апдейтах
+    startup_ready = True
+    logger.info(
+        f"warm-up done in {startup_report['total']} ms: "
+        + ", ".join(f"{name}={value}" for name, value in steps)
+    )
+
+
+async def readiness_handler(request: web.Request):
+    status = "ready" if startup_ready else "warming"
+    return web.json_response(
+        {"status": status, "worker": WORKER_ID, "redis": redis_breaker.state, "steps": startup_report},
+        status=200 if startup_ready else 503,
+    )
+
+
+# ---------------- Startup / webhook ----------------
+async def on_startup_bot(bot: Bot):
+    # прогрев не держит запуск HTTP-сервера: /ready отдаёт 503, пока он идёт
+    spawn_background(warm_up(bot))
 
 
 async def main():
+    global bot_registry
+
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN not set")
         return
@@ -2528,9 +5952,23 @@ async def main():
         logger.error("REDIS_URL not set")
         return
 
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    storage = RedisStorage.from_url(REDIS_URL)
+    # одна HTTP-сессия (и пул соединений к Bot API) на все боты процесса
+    session = BudgetSession(timeout=TELEGRAM_REQUEST_TIMEOUT)
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    storage = RedisStorage(redis=GuardedRedis(connection_pool=get_redis_pool()))
+    if FSM_LOCAL_CACHE_SIZE > 0:
+        storage = LocalCacheStorage(storage, FSM_LOCAL_CACHE_SIZE, FSM_LOCAL_CACHE_TTL)
+        storage.start()
     dp = Dispatcher(storage=storage)
+    # метрики первыми: загрузка и блокировка FSM и лимитер идут под бюджетом
+    # апдейта и входят в handle_ms; лимитер — до FSM, отклонённый апдейт не
+    # читает состояние
+    dp.update.outer_middleware(MetricsMiddleware())
+    dp.update.outer_middleware(RateLimitMiddleware())
+    install_cached_fsm(dp)
+    dp.update.outer_middleware(TenantMiddleware())
+    router.message.middleware(BudgetHandlerMiddleware())
+    router.callback_query.middleware(BudgetHandlerMiddleware())
     dp.include_router(router)
     dp.startup.register(on_startup_bot)
 
@@ -2542,6 +5980,9 @@ async def main():
 
     app.router.add_get("/", healthcheck)
     app.router.add_get("/healthcheck", healthcheck)
+    app.router.add_get("/ready", readiness_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/export/orders.csv", export_orders_handler)
     app.router.add_get("/pay-month", pay_month_handler)
     app.router.add_get("/pay-year", pay_year_handler)
     app.router.add_post("/yookassa_webhook", yookassa_webhook)
@@ -2550,27 +5991,32 @@ async def main():
         dispatcher=dp,
         bot=bot,
         secret_token=WEBHOOK_SECRET,
-        handle_in_background=True,
+        handle_in_background=not WEBHOOK_REPLY_INLINE,
     ).register(app, path=WEBHOOK_PATH)
 
+    if MULTI_BOT:
+        bot_registry = BotRegistry(session)
+        MultiBotRequestHandler(
+            dispatcher=dp,
+            registry=bot_registry,
+            handle_in_background=not WEBHOOK_REPLY_INLINE,
+        ).register(app, path=MULTI_BOT_PATH)
+
     setup_application(app, dp, bot=bot)
 
     async def on_shutdown(a: web.Application):
-        global smart_task, subs_task
-        try:
-            if smart_task and not smart_task.done():
-                smart_task.cancel()
-        except Exception:
-            pass
-        try:
-            if subs_task and not subs_task.done():
-                subs_task.cancel()
-        except Exception:
-            pass
-        try:
-            await bot.delete_webhook()
-        except Exception:
-            pass
+        metrics_task.cancel()
+        config_task.cancel()
+        await config_writer.drain()
+        await close_yookassa_http()
+        scheduler_task.cancel()
+        if analytics_task is not None:
+            analytics_task.cancel()
+        if is_leader():
+            try:
+                await bot.delete_webhook()
+            except Exception:
+                pass
         try:
             await storage.close()
         except Exception:
@@ -2582,14 +6028,31 @@ async def main():
 
     app.on_shutdown.append(on_shutdown)
 
+    metrics_task = asyncio.create_task(metrics_flush_loop())
+    config_task = asyncio.create_task(config_reload_loop())
+    # задачи забираются атомарно, так что планировщик крутится во всех воркерах
+    scheduler_task = asyncio.create_task(run_scheduler(bot))
+    analytics_task = asyncio.create_task(AnalyticsConsumer(_worker_field()).run()) if ANALYTICS_ENABLED else None
+
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    site = web.TCPSite(runner, "0.0.0.0", PORT, reuse_port=WORKERS > 1)
     await site.start()
 
-    logger.info("Bot started on 0.0.0.0:%s", PORT)
-    await asyncio.Event().wait()
+    logger.info("Bot started on 0.0.0.0:%s (worker %s/%s)", PORT, WORKER_ID, WORKERS)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+    logger.info("worker %s stopping", WORKER_ID)
+    await runner.cleanup()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        asyncio.run(main())